@@ -2,12 +2,27 @@ import os
 import json
 import time
 import re
-from google import genai
-from google.genai import types
+import asyncio
+import weakref
+import copy
+import contextlib
 from pymongo import MongoClient
 from dotenv import load_dotenv
 import uuid
+import hashlib
+import mimetypes
 from datetime import datetime
+from claim_cache import ResultCache, content_key
+from scale_of_finance import estimate_claim, parse_area_or_none, MARATHI_DIGITS
+import image_prep
+import audio_prep
+import satbara
+import evidence_gate
+from llm_backend import backend_from_env, LLMResponse
+from json_stream import IncrementalJSONParser
+import structured_output
+import resilience
+from tracing import span, traced, claim_trace
 
 load_dotenv()
 
@@ -22,28 +37,75 @@ except Exception as e:
     print(f"⚠️ MongoDB Connection Failed: {e}")
     DB_CONNECTED = False
 
-client = genai.Client(api_key=os.getenv("GOOGLE_API_KEY"))
+# Model backend (Gemini by default, LLM_BACKEND=fake for offline load tests)
+backend = backend_from_env()
+# Upstream health and the Gemini quota, shared by every claim in this process (see resilience.py)
+breaker = resilience.CircuitBreaker()
+rate_limiter = resilience.TokenBucket()
+
+def set_backend(new_backend):
+    """Swaps the model backend (e.g. llm_backend.FakeBackend for benchmarks); the breaker starts closed."""
+    global backend, breaker
+    backend = new_backend
+    breaker = resilience.CircuitBreaker()
+
+MODEL_NAME = "gemini-2.5-flash" # Switch to 2.0-flash or 1.5-flash
+
+# --- CONCURRENCY SETTINGS (override via .env) ---
+# Max model calls in flight per event loop, and the deadline for any single call
+MAX_CONCURRENT_MODEL_CALLS = int(os.getenv("MAX_CONCURRENT_MODEL_CALLS", 8))
+MODEL_CALL_TIMEOUT_SECONDS = float(os.getenv("MODEL_CALL_TIMEOUT_SECONDS", 90))
+# Extra model calls allowed when an answer is unusable even after local JSON repair
+MAX_OUTPUT_RETRIES = int(os.getenv("MAX_OUTPUT_RETRIES", 1))
+
+# asyncio.Semaphore is bound to one event loop, so keep one per loop
+# (the sync wrapper creates a fresh loop on every call)
+_model_semaphores = weakref.WeakKeyDictionary()
+
 
 # --- HELPER FUNCTIONS ---
-def clean_json_text(text):
-    text = re.sub(r'```json\s*', '', text)
-    text = re.sub(r'```', '', text)
-    return text.strip()
+class UploadedBlob:
+    """
+    Minimal stand-in for Streamlit's UploadedFile (.getvalue() / .type / .name),
+    so batch jobs and workers can feed process_claim from disk or memory.
+    """
+    def __init__(self, data, mime_type, name="upload"):
+        self._data = data
+        self.type = mime_type
+        self.name = name
+
+    @classmethod
+    def from_path(cls, path, mime_type=None):
+        with open(path, "rb") as f:
+            data = f.read()
+        return cls(data, mime_type or mimetypes.guess_type(path)[0] or "application/octet-stream", os.path.basename(path))
+
+    def getvalue(self):
+        return self._data
 
-def save_claim_to_db(merged_data, ai_confidence):
+APPLICATION_ID_PATTERN = re.compile(r"^PMFBY-\d{4}-[0-9A-F]{6}$")
+
+def new_application_id():
+    """Issued at submission time (job_queue.py), or here when the claim is processed inline."""
+    return f"PMFBY-{datetime.now().year}-{uuid.uuid4().hex[:6].upper()}"
+
+@traced("db.save_claim")
+def save_claim_to_db(merged_data, ai_confidence, usage=None, application_id=None):
     if not DB_CONNECTED:
-        return f"OFFLINE-{uuid.uuid4().hex[:6].upper()}"
+        return application_id or f"OFFLINE-{uuid.uuid4().hex[:6].upper()}"
     
-    app_id = f"PMFBY-{datetime.now().year}-{uuid.uuid4().hex[:6].upper()}"
+    app_id = application_id or new_application_id()
     claim_record = {
         "application_id": app_id,
         "farmer_mobile": merged_data.get("mobile", "Unknown"),
         "timestamp": datetime.now(),
         "status": "Submitted",
-        "claim_data": merged_data
+        "claim_data": merged_data,
+        "usage": usage  # Tokens / bytes / wall time (see build_usage_record, usage_report.py)
     }
     try:
-        claims_col.insert_one(claim_record)
+        # Upsert: a queued claim that is retried (job_queue.py) keeps one record under its application_id
+        claims_col.update_one({"application_id": app_id}, {"$set": claim_record}, upsert=True)
         return app_id
     except:
         return app_id
@@ -52,13 +114,427 @@ def get_farmer_from_db(mobile_number):
     if not DB_CONNECTED: return None
     return farmers_col.find_one({"mobile_number": mobile_number.replace("+91", "").strip()})
 
+# --- STAGE PROMPTS ---
+# Each stage sees ONE input, so its result can be cached by that input's hash alone.
+# Cross-modal decisions (which farmer, crop match, payout) are made locally in join_stages().
+
+DOCUMENT_PROMPT = """
+You are a Senior Talathi (Revenue Officer). The attached DOCUMENT is a 7/12 Extract (Satbara). Scan the ENTIRE document.
+- "Village Form 7" (Namuna 7 - Ownership) is usually on Page 1.
+- "Village Form 12" (Namuna 12 - Crop History) is usually at the end (Page 2 or 3).
+
+--- STEP A: OCCUPANTS (Namuna 7) ---
+- List EVERY occupant (Bhogvatadar) in Namuna 7.
+- **⛔ EXCLUSION RULE**: If a name is enclosed in **Square Brackets `[...]`** (e.g., `[Name]`), **Parentheses `(...)`**, or has a **Strike-through**, it is a CANCELLED/DELETED entry. **DO NOT LIST IT.**
+- For each active occupant extract the "Khate Kramank" (Account No) usually found in the column before the name (e.g., '330' or '108').
+- For each active occupant extract the area (Kshetra) on the **same row/block** as that name. Do NOT simply pick the largest number.
+
+--- STEP B: LOCATION ---
+Village, Taluka, District, Survey/Gat No.
+
+--- STEP C: CROP HISTORY (Namuna 12) ---
+- Scan the table "गाव नमुना बारा" (Village Form 12).
+- List the entries for the **LATEST AVAILABLE YEAR** first (e.g., 2025-26, 2024-25).
+- For each entry extract Year, Season, Crop Name and the area (Pikache Kshetra, blank if not written).
+
+--- JSON OUTPUT FORMAT ---
+Return ONLY valid JSON. Provide the value as found in the document (Marathi/Hindi) AND an "_english" transliteration.
+{
+    "occupants": [
+        {"name": "Active name from Namuna 7", "name_english": "Name in English", "khate_number": "e.g. 330", "area_hectare": "e.g. 0.38.00"}
+    ],
+    "address_village": "Extract Village",
+    "address_village_english": "Village in English",
+    "address_taluka": "Extract Taluka",
+    "address_taluka_english": "Taluka in English",
+    "address_district": "Extract District",
+    "survey_number": "Extract Survey/Gat No",
+    "crop_history": [
+        {"year": "e.g. 2025-26", "season": "Kharif/Rabi", "crop_name": "As written", "crop_name_english": "Crop in English", "area_hectare": "Pikache Kshetra"}
+    ]
+}
+"""
+
+VOICE_PROMPT = """
+You are a Senior Talathi (Revenue Officer). The attached audio is a farmer's crop-loss complaint in **Hindi, Marathi, or English**. (Assume current year is 2025).
+
+- Extract the farmer's name as spoken (their name on the 7/12).
+- Extract the damaged crop.
+- Extract the disaster / cause of loss (e.g. Flood, Hailstorm, Unseasonal Rain, Landslide, Cyclone).
+- Write a short empathetic response in the SAME language as the farmer.
+
+--- JSON OUTPUT FORMAT ---
+Return ONLY valid JSON, with the keys in exactly this order ("voice_response" FIRST - it is played back while the rest is generated).
+{
+    "voice_response": "Short empathetic response in the same language as input (Hindi/Marathi/English).",
+    "language": "Marathi / Hindi / English",
+    "farmer_name": "Name as spoken",
+    "farmer_name_english": "Name in English",
+    "crop_name": "Crop as spoken",
+    "crop_name_english": "Crop in English",
+    "cause_of_loss": "Cause as spoken",
+    "cause_of_loss_english": "Cause in English"
+}
+"""
+
+VISUAL_PROMPT = """
+You are an Insurance Field Inspector. The attached image is the EVIDENCE photo of a damaged farm.
+
+**Task**: Verify if the EVIDENCE image is *related* to agriculture or disaster.
+
+**ACCEPT AS VALID IF**:
+- Wide shots of fields (Green, Dry, or Harvested).
+- **Flooded land / Waterlogged soil** (CRITICAL: Accept this for flood claims).
+- **Broken plants / Hailstones on ground**.
+- **Muddy / Barren soil** (Post-disaster).
+- **Close-ups** of leaves, cotton bolls, or roots.
+
+**REJECT ONLY IF**:
+- The image is CLEARLY irrelevant (e.g., Selfie, Car, Dog inside house, Laptop screen, Pitch Black).
+
+**RULE**: If the image is ambiguous (e.g., just dirty water), **GIVE THE BENEFIT OF DOUBT** and accept it.
+
+--- JSON OUTPUT FORMAT ---
+Return ONLY valid JSON.
+{
+    "is_valid": true,
+    "visual_finding": "Short description of what is seen in photo (e.g. 'Standing water visible', 'Hailstones on ground', 'Wilted leaves').",
+    "rejection_reason": "Empty unless is_valid is false"
+}
+"""
+
+def _fingerprint(spec):
+    # Any change to a stage prompt, response schema, the model or upload pre-processing
+    # gives a new fingerprint, so stale entries are never served
+    prep = spec["prepare_version"] if spec.get("prepare") else ""
+    schema = json.dumps(spec["schema"], sort_keys=True)
+    return hashlib.sha256(f"{MODEL_NAME}\n{prep}\n{schema}\n{spec['prompt']}".encode("utf-8")).hexdigest()[:12]
+
+# stage name -> prompt, cache, optional upload pre-processing and version.
+# Each stage is memoized on the hash of its own (raw) input only,
+# so re-shooting the crop photo reuses the (expensive) 7/12 document pass.
+STAGES = {
+    "document": {"prompt": DOCUMENT_PROMPT, "cache": ResultCache("document"),
+                 "prepare": satbara.prepare_land_document, "prepare_version": satbara.settings_fingerprint()},
+    "voice": {"prompt": VOICE_PROMPT, "cache": ResultCache("voice"),
+              "prepare": audio_prep.prepare_voice, "prepare_version": audio_prep.settings_fingerprint()},
+    "visual": {"prompt": VISUAL_PROMPT, "cache": ResultCache("visual"),
+               "prepare": image_prep.prepare_photo, "prepare_version": image_prep.settings_fingerprint()},
+}
+for _name, _spec in STAGES.items():
+    _spec["schema"] = structured_output.SCHEMAS[_name]
+    _spec["version"] = _fingerprint(_spec)
+
+def set_cache_enabled(enabled):
+    """Turns the stage caches on/off (load tests want every claim to reach the backend)."""
+    for spec in STAGES.values():
+        spec["cache"].enabled = enabled
+
+def get_cache_stats():
+    """Per-stage hit/miss counters and model seconds saved by the result caches."""
+    return {name: spec["cache"].stats() for name, spec in STAGES.items()}
+
+def configure_concurrency(max_calls=None, timeout_seconds=None):
+    """Changes the in-flight limit / per-call deadline for model calls (applies to new loops)."""
+    global MAX_CONCURRENT_MODEL_CALLS, MODEL_CALL_TIMEOUT_SECONDS
+    if max_calls is not None:
+        MAX_CONCURRENT_MODEL_CALLS = int(max_calls)
+        _model_semaphores.clear()
+    if timeout_seconds is not None:
+        MODEL_CALL_TIMEOUT_SECONDS = float(timeout_seconds)
+
+def _model_semaphore():
+    loop = asyncio.get_running_loop()
+    sem = _model_semaphores.get(loop)
+    if sem is None:
+        sem = _model_semaphores[loop] = asyncio.Semaphore(MAX_CONCURRENT_MODEL_CALLS)
+    return sem
+
+def _notify(callback, *args):
+    # Progress callbacks are best-effort: a broken UI hook must never fail the claim
+    if callback is None: return
+    try:
+        callback(*args)
+    except Exception as e:
+        print(f"⚠️ Update callback failed: {e}")
+
+async def _generate_streaming(stage, prompt, data, mime_type, schema, on_field):
+    """Streams one stage, reporting each top-level field as soon as its value is complete."""
+    parser = IncrementalJSONParser()
+    parts, usage, model = [], {}, MODEL_NAME
+    async for chunk in backend.generate_stream(stage, prompt, data, mime_type, MODEL_NAME, temperature=0.2, schema=schema):
+        parts.append(chunk.text)
+        usage, model = chunk.usage or usage, chunk.model
+        for key, value in parser.feed(chunk.text).items():
+            _notify(on_field, stage, key, value)
+    return LLMResponse("".join(parts), model, usage)
+
+async def _call_model(stage, spec, data, mime_type, on_field):
+    """
+    One model call with deadline, transient-error retries, optional hedging and the circuit breaker.
+    Returns (LLMResponse, seconds).
+    """
+    semaphore = _model_semaphore()
+
+    @contextlib.asynccontextmanager
+    async def admit():
+        # Each attempt (retry or hedge) takes quota and its own slot, and gives the slot back while
+        # backing off. Both before the attempt's deadline starts: waiting locally is not an upstream timeout
+        with span(f"{stage}.queue"):
+            await rate_limiter.acquire_async()
+            try:
+                await semaphore.acquire()
+            except asyncio.CancelledError:
+                rate_limiter.refund()  # Cancelled before the call was made: the token was never used
+                raise
+        try:
+            yield
+        finally:
+            semaphore.release()
+
+    async def attempt():
+        with span(f"{stage}.model"):
+            if on_field is None:
+                return await backend.generate(stage, spec["prompt"], data, mime_type, MODEL_NAME,
+                                              temperature=0.2, schema=spec["schema"])
+            return await _generate_streaming(stage, spec["prompt"], data, mime_type, spec["schema"], on_field)
+
+    started = time.perf_counter()
+    response = await resilience.call(
+        attempt, name=f"{stage} stage", timeout=MODEL_CALL_TIMEOUT_SECONDS, breaker=breaker, admit=admit,
+        # A hedged duplicate of a streamed answer would report every field twice
+        hedge_after=None if on_field else resilience.HEDGE_AFTER_SECONDS
+    )
+    return response, time.perf_counter() - started
+
+async def run_stage_async(stage, data, mime_type, on_field=None):
+    """
+    Runs ONE extraction stage on ONE input, memoized by content hash.
+    Returns (result_dict, meta) where meta has 'cache_hit' and (on a miss) 'prep' upload stats,
+    plus 'usage' / 'model' / 'model_seconds' / 'bytes_sent' when the model was actually called.
+    With on_field(stage, key, value) the model answer is streamed and each field reported as it completes.
+    """
+    spec = STAGES[stage]
+    # Backend name is part of the key: fake load-test answers must never be served as real ones
+    cache_key = content_key(data, fingerprint=f"{backend.name}:{spec['version']}")
+    cached = spec["cache"].get(cache_key)
+    if cached is not None:
+        print(f"⚡ Cache Hit [{stage}] ({cache_key[:10]}) -> Skipping Gemini call")
+        for key, value in cached.items():
+            _notify(on_field, stage, key, value)
+        return cached, {"cache_hit": True}
+
+    meta = {"cache_hit": False}
+    if spec["prepare"]:
+        # Pillow / numpy work is CPU-bound: keep it off the event loop
+        with span(f"{stage}.prepare"):
+            data, mime_type, meta["prep"] = await asyncio.to_thread(spec["prepare"], data, mime_type)
+
+        # Pre-processing could answer the stage by itself (e.g. a digital 7/12's text layer)
+        local_result = meta["prep"].pop("local_result", None)
+        if local_result is not None:
+            print(f"📄 [{stage}] Read locally from the text layer -> Skipping Gemini call")
+            meta["local"] = True
+            spec["cache"].put(cache_key, local_result)
+            for key, value in local_result.items():
+                _notify(on_field, stage, key, value)
+            return local_result, meta
+
+    # The inline request limit applies to what is actually sent, one stage at a time
+    evidence_gate.check_payload(stage, data)
+
+    # Unusable answers (not JSON even after local repair, or off-schema) get MAX_OUTPUT_RETRIES more calls
+    usage, model_seconds = {}, 0.0
+    for attempt in range(1 + MAX_OUTPUT_RETRIES):
+        response, seconds = await _call_model(stage, spec, data, mime_type, on_field)
+        model_seconds += seconds
+        for key, value in response.usage.items():
+            usage[key] = usage.get(key, 0) + value
+        try:
+            result, repairs = structured_output.parse_stage_output(stage, response.text)
+        except structured_output.StageOutputError as e:
+            if attempt == MAX_OUTPUT_RETRIES:
+                if attempt: structured_output.note_retry(recovered=False)
+                raise
+            print(f"🔁 [{stage}] Unusable model answer ({e}) -> Retrying")
+            structured_output.note_retry()
+            continue
+        if attempt: structured_output.note_retry(recovered=True)
+        if repairs:
+            print(f"🩹 [{stage}] Repaired model JSON locally: {', '.join(repairs)}")
+        break
+
+    # Only parsed, successful answers are cached (errors must stay retryable)
+    spec["cache"].put(cache_key, result, cost_seconds=model_seconds)
+    meta.update(model=response.model, usage=usage, model_seconds=round(model_seconds, 3),
+                bytes_sent=len(data), attempts=attempt + 1)
+    return result, meta
+
+def build_usage_record(stage_meta, upload_bytes, wall_seconds):
+    """
+    Per-claim cost accounting stored on the claims document:
+    tokens and bytes actually sent per stage, raw upload sizes and end-to-end time.
+    """
+    totals = {"input_tokens": 0, "output_tokens": 0, "thinking_tokens": 0, "total_tokens": 0}
+    stages = {}
+    for name, meta in stage_meta.items():
+        usage = meta.get("usage") or {}
+        for key in totals:
+            totals[key] += usage.get(key, 0)
+        stages[name] = {
+            "source": "cache" if meta["cache_hit"] else "local" if meta.get("local") else "model",
+            "bytes_sent": meta.get("bytes_sent", 0),
+            "model_seconds": meta.get("model_seconds", 0.0),
+            **{key: usage.get(key, 0) for key in totals},
+        }
+    return {
+        "model": MODEL_NAME,
+        "backend": backend.name,
+        **totals,
+        "upload_bytes": upload_bytes,
+        "bytes_sent": sum(s["bytes_sent"] for s in stages.values()),
+        "wall_seconds": round(wall_seconds, 3),
+        "stages": stages,
+    }
+
+# --- LOCAL JOIN LOGIC (Formerly done by the model in one giant prompt) ---
+SCHEME_NAME = "प्रधानमंत्री पीक विमा योजना (PMFBY)"
+
+def _norm(text):
+    # Only strips punctuation: \w would also drop Devanagari vowel signs (matras)
+    return re.sub(r"[\[\](){}.,:;!?'\"/\\-]", " ", str(text or "").lower()).split()
+
+def _match_occupant(occupants, voice):
+    """Picks the active Namuna 7 occupant whose name best matches the spoken name (else the first)."""
+    if not occupants: return {}
+    spoken = set(_norm(voice.get("farmer_name_english"))) | set(_norm(voice.get("farmer_name")))
+    best, best_score = occupants[0], 0
+    for occ in occupants:
+        names = set(_norm(occ.get("name_english"))) | set(_norm(occ.get("name")))
+        score = len(spoken & names)
+        if score > best_score:
+            best, best_score = occ, score
+    return best
+
+def _crops_match(voice_crop, doc_crop):
+    v, d = " ".join(_norm(voice_crop)), " ".join(_norm(doc_crop))
+    return bool(v and d) and (v in d or d in v)
+
+def join_stages(document, voice, visual, today=None):
+    """
+    Combines the three stage results into the same JSON shape the monolithic prompt used to return.
+    """
+    today = today or datetime.now().strftime('%d/%m/%Y')
+    occupant = _match_occupant(document.get("occupants") or [], voice)
+    history = document.get("crop_history") or []
+    latest = history[0] if history else {}
+
+    # --- Recency Check (The "Outdated" Rule) ---
+    year_match = re.search(r"\d{4}", str(latest.get("year", "")).translate(MARATHI_DIGITS))
+    is_current = bool(year_match) and int(year_match.group()) >= 2024
+
+    # --- Crop Verification ---
+    doc_crop_en = latest.get("crop_name_english") or ""
+    voice_crop_en = voice.get("crop_name_english") or ""
+    if not is_current:
+        status = "Verified (Voice Override)"
+        reason = f"7/12 crop history is outdated ({latest.get('year') or 'no year found'}); trusting the voice crop '{voice_crop_en}'."
+        crop_name, crop_name_en = voice.get("crop_name"), voice_crop_en
+    elif (_crops_match(voice_crop_en, doc_crop_en) or _crops_match(voice.get("crop_name"), latest.get("crop_name"))) \
+            and "fallow" not in doc_crop_en.lower():
+        status = "Verified"
+        reason = f"Voice crop '{voice_crop_en}' matches the Namuna 12 entry for {latest.get('year')}."
+        crop_name, crop_name_en = latest.get("crop_name"), doc_crop_en or voice_crop_en
+    else:
+        status = "Mismatch"
+        reason = f"Voice crop '{voice_crop_en}' does not match Namuna 12 crop '{doc_crop_en or latest.get('crop_name')}' for {latest.get('year')}."
+        crop_name, crop_name_en = latest.get("crop_name"), doc_crop_en
+
+    # --- Area: Namuna 12 (Pikache Kshetra), fallback to the occupant's Namuna 7 area ---
+    area_text = latest.get("area_hectare") if parse_area_or_none(latest.get("area_hectare")) else occupant.get("area_hectare")
+    # Deterministic Scale-of-Finance maths (the model only supplies crop, area and season)
+    estimation = estimate_claim(crop_name_en or crop_name, area_text, latest.get("season"))
+
+    return {
+        "status": "success",
+        "voice_response": voice.get("voice_response"),
+        "verification": {
+            "status": status,
+            "reason": f"{reason} Cause of loss (voice): {voice.get('cause_of_loss_english') or voice.get('cause_of_loss')}.",
+            "visual_finding": visual.get("visual_finding")
+        },
+        "claim_estimation": {k: v for k, v in estimation.items() if k != "premium_amount"},
+        "form_fields": {
+            "farmer_full_name": occupant.get("name"),
+            "farmer_full_name_english": occupant.get("name_english"),
+            "address_village": document.get("address_village"),
+            "address_village_english": document.get("address_village_english"),
+            "address_taluka": document.get("address_taluka"),
+            "address_taluka_english": document.get("address_taluka_english"),
+            "address_district": document.get("address_district"),
+            "survey_number": document.get("survey_number"),
+            "khate_number": occupant.get("khate_number"),
+            "crop_name": crop_name,
+            "crop_name_english": crop_name_en,
+            "sown_area_hectare": area_text,
+            "scheme_name": SCHEME_NAME,
+            "premium_amount": estimation["premium_amount"],
+            "cause_of_loss": voice.get("cause_of_loss"),
+            "date_of_loss": today,
+            "season": latest.get("season"),
+            "financial_year": latest.get("year")
+        }
+    }
+
+def _spool(audio_bytes, audio_mime, land_bytes, land_mime, crop_bytes, crop_mime, mobile_number, spool, date_of_loss=None):
+    if not spool:
+        return {"status": "error", "reason": f"AI Error: model service unavailable (circuit open, retry in {breaker.retry_after():.0f}s)",
+                "retry_after_seconds": round(breaker.retry_after())}
+    uploads = {"audio": (audio_bytes, audio_mime), "land": (land_bytes, land_mime), "photo": (crop_bytes, crop_mime)}
+    try:
+        spool_id = resilience.spool_claim(uploads, mobile_number, reason="circuit open", date_of_loss=date_of_loss)
+    except OSError as e:
+        return {"status": "error", "reason": f"AI Error: model service unavailable and the claim could not be saved ({e})"}
+    return {
+        "status": "queued",
+        "reason": "The verification service is busy. Your claim has been saved and will be processed automatically; no need to submit again.",
+        "spool_id": spool_id,
+        "retry_after_seconds": round(breaker.retry_after())
+    }
+
 # --- CORE FUNCTION (UPDATED) ---
-def process_claim(audio_file, land_file, crop_file, mobile_number="9922001122"):
+async def process_claim_async(audio_file, land_file, crop_file, mobile_number="9922001122", on_update=None, spool=True,
+                              date_of_loss=None, application_id=None):
     """
     Accepts THREE files: Audio, Land Doc (PDF/Img), and Crop Photo.
     Dynamically detects MIME types to prevent '400 INVALID_ARGUMENT'.
+    The three stages run concurrently; many claims can share one event loop.
+    Every step is timed into the caller's trace (or a new one, see tracing.py).
+
+    on_update(event, payload) streams the model answers and reports progress early:
+      "voice_response" (str)   as soon as the voice stage has written it
+      "evidence"       (dict)  crop photo verdict
+      "verification"   (dict)  status / reason / visual_finding, right after the join
+      "form_fields"    (dict)  {"form_fields", "full_report_data"} before the DB write,
+                               so PDF layout can start while the claim is being saved
+
+    While the model circuit breaker is open the claim is spooled to disk and
+    {"status": "queued", "spool_id", ...} is returned (spool=False: an error instead).
+
+    date_of_loss (dd/mm/YYYY) goes on the form; unknown = today.
+    application_id: the id already handed to the farmer (job_queue.py); a new one is issued if None.
     """
+    with claim_trace() as trace:
+        result = await _process_claim_async(audio_file, land_file, crop_file, mobile_number, on_update, spool,
+                                            date_of_loss, application_id)
+        trace.bind(result.get("data", {}).get("application_id"), status=result.get("status"))
+        result["trace_id"] = trace.trace_id
+        return result
+
+async def _process_claim_async(audio_file, land_file, crop_file, mobile_number, on_update, spool, date_of_loss=None,
+                               application_id=None):
     print(f"🔄 Processing Claim for {mobile_number}...")
+    claim_started = time.perf_counter()
 
     # --- 1. GET BYTES & DYNAMIC MIME TYPES ---
     # Streamlit file objects have a .type attribute (e.g., 'application/pdf', 'image/png')
@@ -77,163 +553,103 @@ def process_claim(audio_file, land_file, crop_file, mobile_number="9922001122"):
 
     print(f"📂 Debug Types -> Land: {land_mime}, Crop: {crop_mime}, Audio: {audio_mime}")
 
-        # --- STEP 2: CONSTRUCT THE PROMPT (The Final Master Version) ---
-    prompt = f"""
-    You are a Senior Talathi (Revenue Officer) and Insurance Expert.
-    
-    --- INPUTS ---
-    1. **DOCUMENT**: A 7/12 Extract (Satbara). Scan the ENTIRE document.
-       - "Village Form 7" (Namuna 7 - Ownership) is usually on Page 1.
-       - "Village Form 12" (Namuna 12 - Crop History) is usually at the end (Page 2 or 3).
-    2. **EVIDENCE**: Photo of the damaged farm.
-    3. **VOICE CLAIM**: Farmer's complaint in **Hindi, Marathi, or English**: "{audio_file}" (Assume current year is 2025).
-
-    --- 1. VISUAL VERIFICATION (CONTEXT AWARE) ---
-    **Task**: Verify if the EVIDENCE image is *related* to agriculture or disaster.
-    
-    **ACCEPT AS VALID IF**:
-    - Wide shots of fields (Green, Dry, or Harvested).
-    - **Flooded land / Waterlogged soil** (CRITICAL: Accept this for flood claims).
-    - **Broken plants / Hailstones on ground**.
-    - **Muddy / Barren soil** (Post-disaster).
-    - **Close-ups** of leaves, cotton bolls, or roots.
-    
-    **REJECT ONLY IF**:
-    - The image is CLEARLY irrelevant (e.g., Selfie, Car, Dog inside house, Laptop screen, Pitch Black).
-    
-    **RULE**: If the image is ambiguous (e.g., just dirty water), **GIVE THE BENEFIT OF DOUBT** and proceed.
-
-   --- 2. DOCUMENT & DATA EXTRACTION ---
-    - **Step A: Identify Target Farmer (CRITICAL EXCLUSION RULE)**:
-        - Listen to the **VOICE CLAIM** for the farmer's name.
-        - Search the "Namuna 7" (Occupant/Bhogvatadar) column for this name.
-        - **⛔ EXCLUSION RULE**: If a name is enclosed in **Square Brackets `[...]`** (e.g., `[Name]`), **Parentheses `(...)`**, or has a **Strike-through**, it is a CANCELLED/DELETED entry. **IGNORE IT COMPLETELY.**
-        - You must find the **Active Entry** (Name without brackets) for this farmer.
-        - If found, extract that name. If NOT found, use the FIRST name listed in Namuna 7.
-        - **EXTRACT**: The "Khate Kramank" (Account No) usually found in the column before to the name (e.g., '330' or '108').
-        
-    - **Step B: Extract Location**: Village, Taluka, District, Survey/Gat No.
-    
-    - **Step C: Extract Exact Area (CRITICAL)**:
-        - Look for the area (Kshetra) specifically associated with the **Target Farmer's Name** or Account Number (Khate No).
-        - Do NOT simply pick the largest number. Pick the number on the **same row/block** as the un-bracketed Farmer's Name.
-
-    - **Step D: Locate Crop Info (Namuna 12)**: 
-        - Scan the table "गाव नमुना बारा" (Village Form 12).
-        - Look for the **LATEST AVAILABLE YEAR** (e.g., 2025-26, 2024-25).
-        - Extract the Crop Name & Season.
-        - **Area Check**: Use the area found in Namuna 12 (Pikache Kshetra). If it is blank or 0, fallback to the Area found in Step C.
-
-    --- 3. VERIFICATION & LOGIC CHECKS ---
-    - **Step A: Recency Check (The "Outdated" Rule)**: 
-       - If the Latest Year in Namuna 12 is **2024 or 2025**: The document is CURRENT.
-       - If the Latest Year is **Older than 2024**: The document is OUTDATED.
-    
-    - **Step B: Crop Verification**:
-       - **If CURRENT**: Compare Voice Crop vs. Document Crop.
-         - If Match -> Status: "Verified".
-         - If Document says "Fallow" or different crop -> Status: "Mismatch".
-       - **If OUTDATED**: Ignore Document Crop. Trust the Voice Crop. Status: "Verified (Voice Override)".
-
-    - **Step C: Cause Match**: Extract the disaster (Flood/Hail) from Voice.
-
-    --- 4. FINANCIAL CALCULATIONS (SCALE OF FINANCE 2025) ---
-    - **Step A: Determine Rate**:
-       - Cotton / Potato / Onion: ₹60,000 per Hectare.
-       - Soybean / Rice / Maize: ₹45,000 per Hectare.
-       - **Jowar / Bajra / Wheat: ₹35,000 per Hectare**.
-       - Others: ₹40,000 per Hectare.
-    
-    - **Step B: Calculate Sum Insured**: Area (Ha) * Rate.
+    # --- 2. LOCAL GATE (Reject clearly unusable uploads before paying for a model call) ---
+    with span("gate"):
+        problem = await asyncio.to_thread(evidence_gate.check_claim_inputs,
+                                          audio_bytes, audio_mime, land_bytes, land_mime, crop_bytes, crop_mime)
+    if problem:
+        print(f"🚫 Rejected locally ({problem['check']}): {problem['reason']}")
+        return {"status": "error", "reason": problem["reason"], "rejected_by": "local_gate", "check": problem["check"]}
 
-    - **Step C: Calculate Premium (For PDF Field 'c')**:
-       - **Rule**:
-         - Commercial (Cotton/Potato): 5% of Sum Insured.
-         - Kharif (Soybean/Rice): 2% of Sum Insured.
-         - Rabi (Jowar/Wheat): 1.5% of Sum Insured.
-       - **Example**: (Cotton 0.5 Ha * 60,000 Rate = 30,000 Sum Insured) -> 30,000 * 0.05 = ₹1,500 Premium.
+    # --- 3. CIRCUIT OPEN? (Model service known to be failing: keep the claim, don't make the farmer wait) ---
+    if breaker.is_open():
+        return _spool(audio_bytes, audio_mime, land_bytes, land_mime, crop_bytes, crop_mime, mobile_number, spool,
+                      date_of_loss)
 
-    - **Step D: Calculate Estimated Payout**: Sum Insured * 100% (Assuming Full Loss).
+    # --- 4. RUN STAGES CONCURRENTLY (Each cached on its own input hash) ---
+    on_field = None
+    if on_update is not None:
+        def on_field(stage, key, value):
+            if stage == "voice" and key == "voice_response" and value:
+                _notify(on_update, "voice_response", value)
 
-    --- JSON OUTPUT FORMAT ---
-    Return ONLY valid JSON. 
-    For the "form_fields" section, you MUST provide the standard value (in Marathi/Hindi as found in doc) AND an "_english" key with the transliteration.
-    {{
-        "status": "success",
-        "voice_response": "Short empathetic response in the same language as input (Hindi/Marathi/English).",
-        "verification": {{
-           "status": "Verified / Mismatch",
-            "reason": "Full explanation logic.",
-            "visual_finding": "Short description of what is seen in photo (e.g. 'Standing water visible', 'Hailstones on ground', 'Wilted leaves')."
-        }}
-        "claim_estimation": {{
-            "estimated_payout": "Calculated in Step D (e.g. ₹30,000)",
-            "rate_applied": "e.g. ₹ 60,000 / Ha (Cotton)",  # <--- ADD THIS LINE
-            "deductible_rule": "e.g. 2% (Kharif Strategy)", # <--- ADD THIS LINE
-            "logic": "Show the math (e.g. 0.5 Ha * ₹60,000)",
-            "disclaimer": "This is an estimate based on district averages."
-        }},
-        "form_fields": {{
-            "farmer_full_name": "Extract from Namuna 7",
-            "farmer_full_name_english": "Name Transliterated to English",
-            "address_village": "Extract Village",
-            "address_village_english": "Village in English",
-            "address_taluka": "Extract Taluka",
-            "address_taluka_english": "Taluka in English",
-            "address_district": "Extract District",
-            "survey_number": "Extract Survey/Gat No",
-            "khate_number": "Extract Khate Kramank/Account Number from Namuna 7 (e.g. 330)",
-            "crop_name": "FINAL CROP DECISION (If Verified -> Doc Crop. If Outdated -> Voice Crop)",
-            "crop_name_english": "Crop Name in English",
-            "sown_area_hectare": "Extract Area from Namuna 12",
-            "scheme_name": "प्रधानमंत्री पीक विमा योजना (PMFBY)",
-            "premium_amount": "Calculated in Step C (e.g. ₹1,500)",
-            "cause_of_loss": "Extract from Voice",
-            "date_of_loss": "{datetime.now().strftime('%d/%m/%Y')}",
-            "season": "Extract Season (Kharif/Rabi) from Namuna 12",
-            "financial_year": "Extract Year (e.g. 2025-26) from Namuna 12"
-        }}
-    }}
-    """
-
-    # --- 3. CALL GEMINI (With Correct MIME Types) ---
+    model_started = time.perf_counter()
+    visual_task = asyncio.ensure_future(run_stage_async("visual", crop_bytes, crop_mime, on_field))
+    document_task = asyncio.ensure_future(run_stage_async("document", land_bytes, land_mime, on_field))
+    voice_task = asyncio.ensure_future(run_stage_async("voice", audio_bytes, audio_mime, on_field))
     try:
-        response = client.models.generate_content(
-            model="gemini-2.5-flash", # Switch to 2.0-flash or 1.5-flash
-            contents=[
-                prompt,
-                types.Part.from_bytes(data=land_bytes, mime_type=land_mime), # 7/12 (PDF/Img)
-                types.Part.from_bytes(data=crop_bytes, mime_type=crop_mime), # Evidence (Img)
-                types.Part.from_bytes(data=audio_bytes, mime_type=audio_mime) # Voice
-            ],
-            config=types.GenerateContentConfig(
-                response_mime_type="application/json", 
-                temperature=0.2
-            )
-        )
-        
-        text_response = clean_json_text(response.text)
-        ai_data = json.loads(text_response)
+        visual, visual_meta = await visual_task
+        _notify(on_update, "evidence", visual)
+        if visual.get("is_valid") is False:
+            return {"status": "error", "reason": f"Evidence Rejected: {visual.get('rejection_reason') or visual.get('visual_finding')}"}
 
+        (document, document_meta), (voice, voice_meta) = await asyncio.gather(document_task, voice_task)
+    except resilience.CircuitOpenError:
+        return _spool(audio_bytes, audio_mime, land_bytes, land_mime, crop_bytes, crop_mime, mobile_number, spool,
+                      date_of_loss)
+    except evidence_gate.PayloadTooLargeError as e:
+        evidence_gate.note_rejection(e.check)
+        print(f"🚫 Rejected locally ({e.check}): {e.reason}")
+        return {"status": "error", "reason": e.reason, "rejected_by": "local_gate", "check": e.check}
     except Exception as e:
         return {"status": "error", "reason": f"AI Error: {str(e)}"}
+    finally:
+        # Rejected evidence or a failed stage: stop paying for the others
+        for task in (visual_task, document_task, voice_task):
+            if not task.done(): task.cancel()
+            elif not task.cancelled(): task.exception()  # Mark sibling failures as seen (no "never retrieved" noise)
+
+    # --- 5. JOIN LOCALLY ---
+    with span("join"):
+        ai_data = join_stages(document, voice, visual, today=date_of_loss)
+    _notify(on_update, "verification", ai_data["verification"])
+    stage_meta = {"document": document_meta, "voice": voice_meta, "visual": visual_meta}
+    stage_cache_hits = {name: meta["cache_hit"] for name, meta in stage_meta.items()}
+    if not all(stage_cache_hits.values()):
+        evidence_gate.note_model_latency(time.perf_counter() - model_started)
+
+    # Upload pre-processing report (only stages that actually called the model)
+    preprocessing = {name: meta["prep"] for name, meta in stage_meta.items() if meta.get("prep")}
+    bytes_saved = sum(p["bytes_saved"] for p in preprocessing.values())
+    if bytes_saved:
+        print(f"🗜️ Upload shrunk by {bytes_saved / 1024:.0f} KB")
+    seconds_removed = preprocessing.get("voice", {}).get("seconds_removed")
+    if seconds_removed:
+        print(f"🔇 Voice note trimmed by {seconds_removed:.1f}s (silence / over {audio_prep.MAX_SECONDS:.0f}s)")
+
+    usage = build_usage_record(stage_meta, {"audio": len(audio_bytes), "land": len(land_bytes), "photo": len(crop_bytes)},
+                               time.perf_counter() - claim_started)
+    if usage["total_tokens"]:
+        print(f"🪙 Tokens: {usage['input_tokens']} in / {usage['output_tokens'] + usage['thinking_tokens']} out")
 
-    # --- 4. MERGE & RETURN (Existing Logic) ---
+    # --- 6. MERGE & RETURN (Existing Logic) ---
     final_data = ai_data.get("form_fields", {})
     if "claim_estimation" in ai_data:
         final_data["estimated_payout"] = ai_data["claim_estimation"].get("estimated_payout")
 
     # DB Fallback logic (Keep your existing logic here)
     final_data["mobile"] = mobile_number
-    
-    real_app_id = save_claim_to_db(final_data, 0.95)
-    final_data["application_id"] = real_app_id
+    # Everything the PDFs need is known now; only the application_id is still to come
+    _notify(on_update, "form_fields", {"form_fields": copy.deepcopy(final_data), "full_report_data": copy.deepcopy(ai_data)})
 
-    # ... inside agent_engine.py, at the very bottom ...
+    # pymongo is blocking: keep it off the event loop
+    real_app_id = await asyncio.to_thread(save_claim_to_db, final_data, 0.95, usage, application_id)
+    final_data["application_id"] = real_app_id
 
     return {
         "status": "success", 
         "data": final_data,            # For App Display & Marathi Form
         "full_report_data": ai_data,   # For English PDF Report
-        "voice_response": ai_data.get("voice_response")
-    }
\ No newline at end of file
+        "voice_response": ai_data.get("voice_response"),
+        "cache_hit": all(stage_cache_hits.values()),
+        "stage_cache_hits": stage_cache_hits,
+        "preprocessing": preprocessing,
+        "upload_bytes_saved": bytes_saved,
+        "usage": usage
+    }
+
+def process_claim(audio_file, land_file, crop_file, mobile_number="9922001122", on_update=None, date_of_loss=None,
+                  spool=True, application_id=None):
+    """Blocking wrapper around process_claim_async (for scripts and claim_worker workers)."""
+    return asyncio.run(process_claim_async(audio_file, land_file, crop_file, mobile_number, on_update, spool,
+                                           date_of_loss, application_id))
@@ -6,6 +6,8 @@ import json
 from datetime import datetime
 import pymongo
 import pytz
+import secrets
+import threading
 from authlib.integrations.requests_client import OAuth2Session
 
 # BRIDGE: Inject Streamlit Secrets into OS Environment for agent_engine.py
@@ -16,9 +18,17 @@ if hasattr(st, "secrets"):
         os.environ["GOOGLE_API_KEY"] = st.secrets["GOOGLE_API_KEY"]
 
 # --- Custom Modules ---
-from pdf_generator import generate_filled_pdf
-from agent_engine import process_claim, db
-from report_gen import generate_best_report 
+from agent_engine import db, APPLICATION_ID_PATTERN
+from job_queue import JobQueue
+from claim_worker import worker_loop
+from claim_pipeline import PROFILE_FIELDS
+import tracing
+
+JOB_EMBEDDED_WORKERS = int(os.getenv("JOB_EMBEDDED_WORKERS", 1))
+UI_POLL_SECONDS = 2  # How often the status page re-checks a queued claim
+
+if tracing.METRICS_PORT:
+    tracing.start_metrics_server(tracing.METRICS_PORT)  # Idempotent: Streamlit re-runs this script per interaction
 
 # -----------------------------------------------------------------------------
 # 1. PAGE CONFIGURATION
@@ -192,50 +202,34 @@ def register_user_db(data):
         return True
     except: return False
 
-def log_claim_to_db(final_data, ai_response, mobile, confidence=0.99):
-    """
-    Logs the claim to MongoDB using Upsert to prevent duplicates.
-    This ensures the 'Calculating...' record is overwritten with final data.
-    """
-    if db is None: return None
-    claims_col = db["claims"]
-    app_id = final_data.get("application_id", f"PMFBY-{int(time.time())}")
-    
-    # Extract Voice Response Safely
-    voice_msg = ai_response.get("voice_response") or final_data.get("voice_response") or "Claim processed successfully."
-    
-    IST = pytz.timezone('Asia/Kolkata')
-
-    claim_document = {
-        "application_id": app_id,
-        "farmer_mobile": mobile,
-        "timestamp": datetime.now(IST),
-        "status": "Approved" if ai_response.get("status") == "success" else "Rejected",
-        "ai_confidence_score": confidence,
-        "voice_response": voice_msg,
-        "submitted_data": final_data # final_data now contains the forced payout
-    }
-    
-    # FIX: Use update_one with upsert=True instead of insert_one
-    claims_col.update_one(
-        {"application_id": app_id},
-        {"$set": claim_document},
-        upsert=True
-    )
-    return app_id
+@st.cache_resource
+def get_job_queue():
+    """Claims are processed by claim_worker.py processes (or the embedded workers below), not in this script."""
+    queue = JobQueue()
+    # Single-box deploys (e.g. Streamlit Cloud) can't run a separate worker: JOB_EMBEDDED_WORKERS=0 once they do
+    for i in range(JOB_EMBEDDED_WORKERS):
+        threading.Thread(target=worker_loop, args=(f"app-{os.getpid()}-{i}", queue), daemon=True).start()
+    return queue
 
 def get_claim_from_db(app_id):
     if db is None: return None
     return db["claims"].find_one({"application_id": app_id})
 
+def load_pdf(path):
+    """(file_name, bytes) for st.download_button, or None if the worker did not produce it."""
+    if not path or not os.path.exists(path): return None
+    with open(path, "rb") as f:
+        return os.path.basename(path), f.read()
+
 # -----------------------------------------------------------------------------
 # 4. SESSION & AUTH
 # -----------------------------------------------------------------------------
 
 if 'mongo_user' not in st.session_state: st.session_state.mongo_user = None
 if 'current_app_id' not in st.session_state: st.session_state.current_app_id = None
-if 'report_path' not in st.session_state: st.session_state.report_path = None
-if 'form_path' not in st.session_state: st.session_state.form_path = None
+if 'report_pdf' not in st.session_state: st.session_state.report_pdf = None  # (file_name, bytes)
+if 'form_pdf' not in st.session_state: st.session_state.form_pdf = None
+if 'pending_app_id' not in st.session_state: st.session_state.pending_app_id = None
 
 # A. Helper to generate Login URL
 def get_google_auth_url():
@@ -244,8 +238,11 @@ def get_google_auth_url():
         redirect_uri = st.secrets["google"]["redirect_uri"]
         
         oauth = OAuth2Session(client_id, redirect_uri=redirect_uri)
+        # A refresh ends the session: ?claim= rides through the Google login in the OAuth state
+        claim = st.query_params.get("claim")
+        state = f"{secrets.token_urlsafe(16)}.{claim}" if claim and APPLICATION_ID_PATTERN.match(claim) else None
         auth_url, state = oauth.create_authorization_url(
-            'https://accounts.google.com/o/oauth2/v2/auth',
+            'https://accounts.google.com/o/oauth2/v2/auth', state=state,
             access_type="offline", prompt="select_account", scope="openid email profile"
         )
         return auth_url
@@ -274,7 +271,10 @@ if "code" in st.query_params:
                 st.session_state.temp_reg_email = email
                 st.session_state.show_register = True
             
+            claim = str(st.query_params.get("state", "")).partition(".")[2]
             st.query_params.clear()
+            if APPLICATION_ID_PATTERN.match(claim):
+                st.query_params["claim"] = claim  # Back to polling the claim the farmer was following
             st.rerun()
             
     except Exception as e:
@@ -437,130 +437,76 @@ else:
         with c1: st.info("📄 **7/12 Extract**"); land_file = st.file_uploader("Upload PDF/Img", type=['pdf','jpg','png'], key="land")
         with c2: st.info("🌱 **Crop Photo**"); crop_image = st.file_uploader("Upload Photo", type=['jpg','png'], key="crop")
 
+        # Date of loss: decides the 72-hour claim window (and the claim's place in the queue)
+        today_ist = datetime.now(pytz.timezone('Asia/Kolkata')).date()
+        loss_date = st.date_input("📅 Date of Loss (नुकसानीची तारीख)", value=today_ist, max_value=today_ist, format="DD/MM/YYYY")
+
         st.markdown("<br>", unsafe_allow_html=True)
 
        # --- SUBMIT LOGIC ---
+        # The claim is queued and processed by a worker; this script only polls its status
         if st.button("🚀 Submit Claim (Arj Kara)"):
             if not (audio_input and land_file and crop_image):
                 st.error("⚠️ Please provide Audio, 7/12 Extract, and Crop Photo.")
             else:
+                db_user = st.session_state.mongo_user
+                uploads = {
+                    "audio": (audio_input.getvalue(), audio_input.type or "audio/wav"),
+                    "land": (land_file.getvalue(), land_file.type),
+                    "photo": (crop_image.getvalue(), crop_image.type),
+                }
+                app_id = get_job_queue().enqueue(uploads, db_user.get("mobile_number"),
+                                                 date_of_loss=loss_date.strftime('%d/%m/%Y'),
+                                                 profile={k: db_user.get(k) for k in PROFILE_FIELDS})
                 st.session_state.current_app_id = None
-                
-                with st.status("🔄 AI Agent Working...", expanded=True) as status:
-                    try:
-                        # --- 1. FIX MOBILE AUDIO FORMATS ---
-                        # Convert whatever mobile format (WebM/M4A) to standard WAV
-                        st.write("🎧 Processing Audio...")
-                        audio_bytes = audio_input.read()
-                        
-                        # Create a temporary file to hold the raw upload
-                        temp_in = f"temp_input_{int(time.time())}"
-                        temp_out = f"temp_clean_{int(time.time())}.wav"
-                        
-                        with open(temp_in, "wb") as f:
-                            f.write(audio_bytes)
-                            
-                        # Use FFmpeg directly (Bypasses pydub/Python 3.13 issues)
-                        try:
-                            import subprocess
-                            subprocess.run([
-                                "ffmpeg", 
-                                "-i", temp_in, 
-                                "-ac", "1",       # Force Mono
-                                "-ar", "16000",   # Force 16kHz (Ideal for AI)
-                                temp_out, 
-                                "-y"              # Overwrite
-                            ], check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-                            
-                            # Re-open the clean WAV file for the AI Agent
-                            clean_audio = open(temp_out, "rb")
-                        except Exception as e:
-                            st.warning(f"Audio conversion skipped (using raw): {e}")
-                            # Reset pointer if reading failed
-                            audio_input.seek(0)
-                            clean_audio = audio_input
-                            
-                        # -----------------------------------
-
-                        user_mobile = st.session_state.mongo_user.get("mobile_number")
-                        st.write("🤖 AI Agent Analyzing...")
-                        
-                        # Pass the CLEAN audio to your processor
-                        ai_result = process_claim(clean_audio, land_file, crop_image, user_mobile)
-                        
-                        # Cleanup temp files
-                        if os.path.exists(temp_in): os.remove(temp_in)
-                        if os.path.exists(temp_out): os.remove(temp_out)
-
-                        if ai_result.get("status") == "success":
-                            # VISUAL STEP 3
-                            st.write("✅ Verification Complete. Calculating Payout...")
-                            
-                            full_report_data = ai_result.get("full_report_data", {}) 
-                            final_data = ai_result.get("data", {})
-
-                            # --- FIX: INJECT LOGIC TRACE FOR REPORT ---
-                            if "reasoning" not in full_report_data:
-                                full_report_data["reasoning"] = ai_result.get("reasoning", "AI verification complete based on provided evidence.")
-                            
-                            full_report_data["logic_trace"] = full_report_data["reasoning"]
-                            # ------------------------------------------
-
-                            # --- ADD THIS BLOCK: INJECT DB USER DETAILS ---
-                            db_user = st.session_state.mongo_user
-                        
-                            final_data["mobile_number"] = db_user.get("mobile_number")
-                            final_data["email"] = db_user.get("email")
-                            final_data["bank_account_number"] = db_user.get("bank_account_number")
-                            final_data["bank_name"] = db_user.get("bank_name")
-                            # ---------------------------------------------
-
-                            # For Report (report_gen)
-                            full_report_data["filer_name"] = db_user.get("Applicant_full_name", "")
-                            
-                            # --- FIX: DATA SYNC START ---
-                            est_block = full_report_data.get("claim_estimation", {})
-                            payout_val = est_block.get("estimated_payout", "Under Assessment")
-                            final_data["estimated_payout"] = payout_val
-                            
-                            voice_val = full_report_data.get("voice_response") or ai_result.get("voice_response")
-                            if not voice_val:
-                                voice_val = "Your claim has been received and verified."
-                            ai_result["voice_response"] = voice_val
-                            # --- FIX: DATA SYNC END ---
-
-                            app_id = final_data.get("application_id")
-                            
-                            # 2. Log to MongoDB
-                            st.write("💾 Logging to Government Ledger...")
-                            log_claim_to_db(final_data, ai_result, user_mobile)
-                            
-                            # 3. Generate PDFs
-                            st.write("📄 Generating Official Documents...")
-                            temp_img = f"temp_{user_mobile}.jpg"
-                            with open(temp_img, "wb") as f: f.write(crop_image.getvalue())
-                            
-                            r_path = generate_best_report(full_report_data, temp_img, output_filename=f"Report_{app_id}.pdf")
-                            f_path = generate_filled_pdf({"form_fields": final_data}, output_path=f"Claim_{app_id}.pdf")
-                            
-                            if os.path.exists(temp_img): os.remove(temp_img)
-                            
-                            # 4. Update Session
-                            st.session_state.current_app_id = app_id
-                            st.session_state.report_path = r_path
-                            st.session_state.form_path = f_path
-                            
-                            # FINAL SUCCESS STATE (Closes the box neatly)
-                            status.update(label="✅ Claim Processed Successfully!", state="complete", expanded=False)
-                            st.balloons()
-                            
+                st.session_state.pending_app_id = app_id
+                st.query_params["claim"] = app_id  # A browser refresh keeps polling it (carried through the login, see get_google_auth_url)
+
+        # --- JOB STATUS (polled until a worker has finished the claim) ---
+        pending_id = st.session_state.pending_app_id or st.query_params.get("claim")
+        user_mobile = clean_mobile_number((st.session_state.mongo_user or {}).get("mobile_number"))
+        if pending_id:
+            queue = get_job_queue()
+            job = queue.get(pending_id)
+            # ?claim= comes from the URL: only the farmer who submitted the claim may follow it
+            if job is not None and (not user_mobile or clean_mobile_number(job.get("mobile")) != user_mobile):
+                job = None
+            if job is None:
+                st.session_state.pending_app_id = None
+                st.query_params.pop("claim", None)
+            elif job["status"] in ("queued", "running"):
+                progress = job.get("progress") or {}
+                with st.status(f"🔄 AI Agent Working... (Application ID: {pending_id})", expanded=True):
+                    if job["status"] == "queued":
+                        wait = queue.predicted_wait(pending_id)
+                        ahead = queue.position(pending_id)
+                        if wait is None:
+                            st.write(f"⏳ In queue ({ahead} ahead): waiting for a verification worker to come online")
                         else:
-                            status.update(label="❌ Claim Failed", state="error", expanded=True)
-                            st.error(f"Failed: {ai_result.get('reason')}")
-                            
-                    except Exception as e:
-                        status.update(label="❌ System Error", state="error", expanded=True)
-                        st.error(f"System Error: {e}")
+                            st.write(f"⏳ In queue: {ahead} claim(s) ahead, about {wait:.0f}s")
+                    else:
+                        st.write("🤖 AI Agent Analyzing...")
+                    if progress.get("voice_response"):
+                        st.info(f"🗣️ {progress['voice_response']}")
+                    if progress.get("verification"):
+                        st.write(f"🔎 Verification: {progress['verification'].get('status')}")
+                    if progress.get("stage") == "documents":
+                        st.write("📄 Generating Official Documents...")
+                    st.caption("You can close this page; your claim keeps processing under the Application ID above.")
+                time.sleep(UI_POLL_SECONDS)
+                st.rerun()
+            else:
+                st.session_state.pending_app_id = None
+                st.query_params.pop("claim", None)
+                result = job.get("result") or {}
+                if job["status"] == "done" and result.get("status") == "success":
+                    st.session_state.current_app_id = pending_id
+                    # The worker (maybe another process) stored the PDFs; read them once, serve from memory
+                    st.session_state.report_pdf = load_pdf(result.get("report_path"))
+                    st.session_state.form_pdf = load_pdf(result.get("form_path"))
+                    st.balloons()
+                else:
+                    st.error(f"Failed: {result.get('reason') or job.get('error') or 'Unknown error'}")
 
         # --- PERSISTENT BLOCK (READ FROM DB) ---
         if st.session_state.current_app_id:
@@ -591,28 +537,26 @@ else:
                 dl_col1, dl_col2 = st.columns(2, gap="medium")
                 
                 with dl_col1:
-                    r_path = st.session_state.report_path
-                    if r_path and os.path.exists(r_path):
-                        with open(r_path, "rb") as f:
-                            st.download_button(
-                                label="📊 Download Intelligence Report",
-                                data=f,
-                                file_name=os.path.basename(r_path),
-                                mime="application/pdf",
-                                use_container_width=True
-                            )
+                    if st.session_state.report_pdf:
+                        r_name, r_bytes = st.session_state.report_pdf
+                        st.download_button(
+                            label="📊 Download Intelligence Report",
+                            data=r_bytes,
+                            file_name=r_name,
+                            mime="application/pdf",
+                            use_container_width=True
+                        )
                 
                 with dl_col2:
-                    f_path = st.session_state.form_path
-                    if f_path and os.path.exists(f_path):
-                        with open(f_path, "rb") as f:
-                            st.download_button(
-                                label="📄 Download Official Form",
-                                data=f,
-                                file_name=os.path.basename(f_path),
-                                mime="application/pdf",
-                                use_container_width=True
-                            )
+                    if st.session_state.form_pdf:
+                        f_name, f_bytes = st.session_state.form_pdf
+                        st.download_button(
+                            label="📄 Download Official Form",
+                            data=f_bytes,
+                            file_name=f_name,
+                            mime="application/pdf",
+                            use_container_width=True
+                        )
                 # ---------------------------------
         st.markdown("<br><br>", unsafe_allow_html=True)
         if st.button("Logout", type="secondary"):
@@ -0,0 +1,249 @@
+# audio_prep.py
+# Normalizes the farmer's voice recording to 16 kHz mono 16-bit PCM WAV, entirely in memory.
+# WAV uploads (what st.audio_input records) are decoded and resampled in-process with numpy;
+# anything else (WebM / M4A / OGG from phones) is streamed through ffmpeg's stdin/stdout pipes.
+# No temp files, so concurrent claims cannot collide. If conversion fails the raw upload is
+# used unchanged (Gemini accepts most formats; the conversion only makes it smaller/uniform).
+#
+# prepare_voice() then runs just before upload (voice stage, cache misses only): energy-based VAD
+# trims leading/trailing silence and shortens long pauses, the clip is capped at AUDIO_MAX_SECONDS,
+# and it is encoded as FLAC (lossless) or Opus. Gemini bills ~32 tokens per second of audio, so
+# every second of silence removed is saved on every claim.
+
+import io
+import os
+import wave
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+# --- SETTINGS (override via .env) ---
+SAMPLE_RATE = 16000  # Ideal for speech models
+FFMPEG_BIN = os.getenv("FFMPEG_BIN", "ffmpeg")
+FFMPEG_WORKERS = int(os.getenv("AUDIO_FFMPEG_WORKERS", 2))              # ffmpeg processes at once
+FFMPEG_TIMEOUT_SECONDS = float(os.getenv("AUDIO_FFMPEG_TIMEOUT_SECONDS", 30))
+# Voice activity detection (loose on purpose: a soft-spoken farmer must never be cut off)
+VAD_FRAME_MS = 30
+VAD_MARGIN_DB = float(os.getenv("AUDIO_VAD_MARGIN_DB", 12))          # Speech: this far above the noise floor...
+VAD_PEAK_RANGE_DB = 20                                              # ...or within this of the loudest speech
+VAD_MIN_DBFS = -50.0                                                # Never treat quieter than this as speech
+VAD_PAD_MS = int(os.getenv("AUDIO_VAD_PAD_MS", 250))                # Kept around speech (soft onsets / endings)
+VAD_MAX_PAUSE_MS = int(os.getenv("AUDIO_VAD_MAX_PAUSE_MS", 700))    # Longer pauses are shortened to this
+MAX_SECONDS = float(os.getenv("AUDIO_MAX_SECONDS", 90))             # Name + crop + cause fit in well under this
+CODEC = os.getenv("AUDIO_CODEC", "flac")                            # flac | opus | wav
+OPUS_BITRATE = os.getenv("AUDIO_OPUS_BITRATE", "24k")
+
+# Bounded: a surge of compressed uploads queues here instead of forking one ffmpeg per claim
+_ffmpeg_pool = ThreadPoolExecutor(max_workers=FFMPEG_WORKERS, thread_name_prefix="ffmpeg")
+
+
+# --- 1. PCM HELPERS ---
+def decode_wav(data):
+    """PCM WAV bytes -> (float32 mono samples in int16 units, sample rate); None if not a PCM WAV."""
+    if data[:4] != b"RIFF" or data[8:12] != b"WAVE":
+        return None
+    try:
+        with wave.open(io.BytesIO(data), "rb") as wav:
+            rate, width, channels = wav.getframerate(), wav.getsampwidth(), wav.getnchannels()
+            raw = wav.readframes(wav.getnframes())
+    except (wave.Error, EOFError):
+        return None  # e.g. float / A-law WAV: leave it to ffmpeg
+    if width == 1:
+        samples = (np.frombuffer(raw, dtype=np.uint8).astype(np.float32) - 128.0) * 256.0
+    elif width == 2:
+        samples = np.frombuffer(raw[: len(raw) - len(raw) % 2], dtype="<i2").astype(np.float32)
+    elif width == 4:
+        samples = np.frombuffer(raw[: len(raw) - len(raw) % 4], dtype="<i4").astype(np.float32) / 65536.0
+    else:
+        return None
+    if channels > 1:
+        samples = samples[: len(samples) - len(samples) % channels].reshape(-1, channels).mean(axis=1)
+    return samples, rate
+
+
+def resample(samples, rate, target=SAMPLE_RATE):
+    """Linear resampling, with a box pre-filter when downsampling (keeps speech, limits aliasing)."""
+    if rate == target or samples.size == 0:
+        return samples
+    if rate > target:
+        width = int(round(rate / target))
+        if width > 1:
+            samples = np.convolve(samples, np.ones(width, dtype=np.float32) / width, mode="same")
+    n_out = int(round(samples.size * target / float(rate)))
+    return np.interp(np.arange(n_out) * (rate / float(target)), np.arange(samples.size), samples).astype(np.float32)
+
+
+def encode_wav(samples, rate=SAMPLE_RATE):
+    """float samples (int16 units) -> 16-bit mono PCM WAV bytes."""
+    pcm = np.clip(np.round(samples), -32768, 32767).astype("<i2")
+    out = io.BytesIO()
+    with wave.open(out, "wb") as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(rate)
+        wav.writeframes(pcm.tobytes())
+    return out.getvalue()
+
+
+def _ffmpeg_pcm(data):
+    """Any container/codec -> raw s16le 16 kHz mono via pipes (stdin in, stdout out)."""
+    proc = subprocess.run(
+        [FFMPEG_BIN, "-hide_banner", "-loglevel", "error", "-i", "pipe:0",
+         "-ac", "1", "-ar", str(SAMPLE_RATE), "-f", "s16le", "pipe:1"],
+        input=data, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=FFMPEG_TIMEOUT_SECONDS, check=False)
+    if proc.returncode != 0 or not proc.stdout:
+        raise RuntimeError(proc.stderr.decode("utf-8", "replace").strip()[-200:] or f"ffmpeg exited {proc.returncode}")
+    return np.frombuffer(proc.stdout[: len(proc.stdout) - len(proc.stdout) % 2], dtype="<i2").astype(np.float32)
+
+
+def decode_audio(data, mime_type=None):
+    """Any upload -> (float32 mono samples at SAMPLE_RATE, method). Raises if it cannot be decoded."""
+    decoded = decode_wav(data)
+    if decoded is not None:
+        samples, rate = decoded
+        return resample(samples, rate), "in-process"
+    return _ffmpeg_pool.submit(_ffmpeg_pcm, data).result(), "ffmpeg"
+
+
+# --- 2. NORMALIZATION ---
+def normalize_audio(data, mime_type):
+    """
+    Returns (bytes, mime_type, info): 16 kHz mono 16-bit WAV, or the raw upload if it cannot be converted.
+    info: bytes_in / bytes_out / seconds / method (or skipped).
+    """
+    info = {"bytes_in": len(data), "bytes_out": len(data)}
+    if data[:4] == b"RIFF" and data[8:12] == b"WAVE":
+        try:
+            with wave.open(io.BytesIO(data), "rb") as wav:
+                if (wav.getframerate(), wav.getnchannels(), wav.getsampwidth()) == (SAMPLE_RATE, 1, 2):
+                    info.update(method="already normalized", seconds=round(wav.getnframes() / float(SAMPLE_RATE), 2))
+                    return data, "audio/wav", info
+        except (wave.Error, EOFError):
+            pass
+    try:
+        samples, info["method"] = decode_audio(data, mime_type)
+    except Exception as e:
+        print(f"⚠️ Audio conversion skipped (using raw): {e}")
+        info["skipped"] = str(e)
+        return data, mime_type, info
+    normalized = encode_wav(samples)
+    info.update(bytes_out=len(normalized), seconds=round(samples.size / float(SAMPLE_RATE), 2))
+    return normalized, "audio/wav", info
+
+
+# --- 3. SILENCE TRIMMING + COMPRESSION (voice stage pre-processing) ---
+def speech_frames(samples, rate=SAMPLE_RATE):
+    """Per-frame speech flags (VAD_FRAME_MS frames, padded by VAD_PAD_MS) and the frame length."""
+    frame = int(rate * VAD_FRAME_MS / 1000)
+    n = samples.size // frame
+    if n == 0:
+        return np.zeros(0, dtype=bool), frame
+    frames = samples[: n * frame].reshape(n, frame)
+    db = 20 * np.log10(np.sqrt(np.mean(frames ** 2, axis=1)) / 32768.0 + 1e-9)
+    floor, peak = np.percentile(db, 10), np.percentile(db, 95)
+    speech = db > max(min(floor + VAD_MARGIN_DB, peak - VAD_PEAK_RANGE_DB), VAD_MIN_DBFS)
+    pad = int(round(VAD_PAD_MS / float(VAD_FRAME_MS)))
+    if pad and speech.any():
+        speech = np.convolve(speech.astype(np.float32), np.ones(2 * pad + 1, dtype=np.float32), mode="same") > 0
+    return speech, frame
+
+
+def trim_silence(samples, rate=SAMPLE_RATE):
+    """Drops leading/trailing non-speech and shortens pauses to VAD_MAX_PAUSE_MS. No speech found: unchanged."""
+    speech, frame = speech_frames(samples, rate)
+    if not speech.any():
+        return samples
+    keep = np.zeros(speech.size, dtype=bool)
+    first, last = np.flatnonzero(speech)[[0, -1]]
+    keep[first:last + 1] = True
+    max_pause = int(round(VAD_MAX_PAUSE_MS / float(VAD_FRAME_MS)))
+    # Runs of silence inside the speech span: keep max_pause frames of each (half at either end)
+    edges = np.flatnonzero(np.diff(speech[first:last + 1].astype(np.int8))) + first + 1
+    for start, end in zip(edges[::2], edges[1::2]):  # Alternating speech->silence, silence->speech
+        if end - start > max_pause:
+            keep[start + max_pause // 2:end - (max_pause - max_pause // 2)] = False
+    mask = np.repeat(keep, frame)
+    tail = samples[mask.size:] if keep[-1] else samples[:0]  # Partial last frame goes with the last frame
+    return np.concatenate([samples[: mask.size][mask], tail])
+
+
+def _ffmpeg_encode(wav_bytes, codec):
+    args = ["-c:a", "flac", "-f", "flac"] if codec == "flac" else \
+           ["-c:a", "libopus", "-b:a", OPUS_BITRATE, "-application", "voip", "-f", "ogg"]
+    proc = subprocess.run([FFMPEG_BIN, "-hide_banner", "-loglevel", "error", "-f", "wav", "-i", "pipe:0"] + args + ["pipe:1"],
+                          input=wav_bytes, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                          timeout=FFMPEG_TIMEOUT_SECONDS, check=False)
+    if proc.returncode != 0 or not proc.stdout:
+        raise RuntimeError(proc.stderr.decode("utf-8", "replace").strip()[-200:] or f"ffmpeg exited {proc.returncode}")
+    return proc.stdout
+
+
+def encode_voice(samples, codec=None):
+    """-> (bytes, mime_type, codec actually used). FLAC / Opus need ffmpeg; without it the clip stays WAV."""
+    codec = codec or CODEC
+    wav_bytes = encode_wav(samples)
+    if codec not in ("flac", "opus"):
+        return wav_bytes, "audio/wav", "wav"
+    try:
+        encoded = _ffmpeg_pool.submit(_ffmpeg_encode, wav_bytes, codec).result()
+    except Exception as e:
+        print(f"⚠️ {codec} encoding unavailable, sending WAV: {e}")
+        return wav_bytes, "audio/wav", "wav"
+    return encoded, ("audio/flac" if codec == "flac" else "audio/ogg"), codec
+
+
+def prepare_voice(data, mime_type):
+    """
+    Voice stage pre-processing: VAD trim -> duration cap -> FLAC/Opus.
+    Returns (bytes, mime_type, info) with seconds_in / seconds_out / seconds_removed and bytes_saved.
+    Undecodable uploads are passed through untouched.
+    """
+    info = {"bytes_in": len(data), "bytes_out": len(data), "bytes_saved": 0}
+    try:
+        samples, _ = decode_audio(data, mime_type)
+    except Exception as e:
+        info["skipped"] = f"decode failed: {e}"
+        return data, mime_type, info
+
+    seconds_in = samples.size / float(SAMPLE_RATE)
+    voiced = trim_silence(samples)
+    cap = int(MAX_SECONDS * SAMPLE_RATE)
+    info["capped"] = voiced.size > cap
+    voiced = voiced[:cap]
+    seconds_out = voiced.size / float(SAMPLE_RATE)
+
+    prepared, prepared_mime, info["codec"] = encode_voice(voiced)
+    if len(prepared) >= len(data) and seconds_out >= seconds_in:
+        info["skipped"] = "already compact"
+        return data, mime_type, info
+    info.update(seconds_in=round(seconds_in, 2), seconds_out=round(seconds_out, 2),
+                seconds_removed=round(seconds_in - seconds_out, 2),
+                bytes_out=len(prepared), bytes_saved=len(data) - len(prepared))
+    return prepared, prepared_mime, info
+
+
+def audio_seconds(data):
+    """Duration from the container header (WAV / FLAC / Ogg Opus) without decoding; None if unknown."""
+    try:
+        if data[:4] == b"RIFF" and data[8:12] == b"WAVE":
+            with wave.open(io.BytesIO(data), "rb") as wav:
+                return wav.getnframes() / float(wav.getframerate())
+        if data[:4] == b"fLaC":
+            info = data[8:8 + 34]  # STREAMINFO follows the 4-byte block header
+            rate = (info[10] << 12) | (info[11] << 4) | (info[12] >> 4)
+            total = ((info[13] & 0x0F) << 32) | int.from_bytes(info[14:18], "big")
+            return total / float(rate) if rate and total else None
+        if data[:4] == b"OggS":
+            last = data.rfind(b"OggS")
+            granule = int.from_bytes(data[last + 6:last + 14], "little")
+            return granule / 48000.0 if b"OpusHead" in data[:64] else None
+    except (wave.Error, EOFError, IndexError):
+        return None
+    return None
+
+
+def settings_fingerprint():
+    """Part of the voice stage cache key: results from differently-prepared audio are not reused."""
+    return (f"vad={VAD_MARGIN_DB}/{VAD_PAD_MS}/{VAD_MAX_PAUSE_MS};max={MAX_SECONDS};"
+            f"codec={CODEC}/{OPUS_BITRATE if CODEC == 'opus' else ''}")
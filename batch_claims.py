@@ -0,0 +1,354 @@
+# batch_claims.py
+# Processes a day's worth of offline CSC claims in one go.
+#
+# Usage:
+#   python batch_claims.py claims.jsonl --out batch_output --workers 4
+#   python batch_claims.py claims_folder/ --out batch_output
+#
+# JSONL manifest: one claim per line (paths are relative to the manifest file)
+#   {"claim_id": "C-001", "audio": "c1/voice.wav", "land": "c1/712.pdf", "photo": "c1/crop.jpg", "mobile": "9922001122",
+#    "date_of_loss": "14/10/2026"}
+#
+# Directory manifest: one sub-folder per claim containing
+#   audio.*  |  land.* / 712.* / satbara.*  |  photo.* / crop.*  |  mobile.txt, date_of_loss.txt (optional)
+# A folder named after an application id (job_queue's claim_jobs/<app_id>/) is replayed under that id,
+# so the claim's Mongo record is updated instead of duplicated.
+#
+# Claims closest to their 72-hour intimation deadline (from date_of_loss) are processed first.
+#
+# Results are appended to <out>/results.jsonl as each claim finishes, so an
+# interrupted run picks up where it left off (claims that succeeded are skipped).
+
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import threading
+from datetime import datetime
+from collections import Counter
+
+import agent_engine
+from agent_engine import UploadedBlob, APPLICATION_ID_PATTERN, process_claim_async, configure_concurrency, get_cache_stats, get_farmer_from_db
+from llm_backend import FakeBackend
+from claim_pipeline import convert_audio, start_pdfs, collect_post_stages, save_pdf
+from satbara import get_document_stats
+from evidence_gate import get_gate_stats
+from structured_output import get_output_stats
+from resilience import get_resilience_stats
+from tracing import claim_trace
+from resilience import TokenBucket
+from claim_scheduler import claim_deadline
+
+RESULTS_FILE = "results.jsonl"
+
+# File-name prefixes accepted in directory mode
+ROLE_PREFIXES = {
+    "audio": ("audio", "voice"),
+    "land": ("land", "712", "satbara"),
+    "photo": ("photo", "crop"),
+}
+
+
+# --- 1. MANIFEST LOADING ---
+def load_jsonl_manifest(path):
+    base_dir = os.path.dirname(os.path.abspath(path))
+    claims = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line_no, line in enumerate(f, start=1):
+            line = line.strip()
+            if not line or line.startswith("#"): continue
+            entry = json.loads(line)
+            claim = {"claim_id": str(entry.get("claim_id") or f"line-{line_no}"), "mobile": str(entry.get("mobile", "")),
+                     "date_of_loss": entry.get("date_of_loss")}
+            for role in ("audio", "land", "photo"):
+                claim[role] = os.path.join(base_dir, entry[role])
+            claims.append(claim)
+    return claims
+
+
+def load_directory_manifest(path):
+    claims = []
+    for name in sorted(os.listdir(path)):
+        claim_dir = os.path.join(path, name)
+        if not os.path.isdir(claim_dir): continue
+
+        claim = {"claim_id": name, "mobile": "", "date_of_loss": None,
+                 "application_id": name if APPLICATION_ID_PATTERN.match(name) else None}
+        for file_name in sorted(os.listdir(claim_dir)):
+            stem = os.path.splitext(file_name)[0].lower()
+            for role, prefixes in ROLE_PREFIXES.items():
+                if role not in claim and stem.startswith(prefixes):
+                    claim[role] = os.path.join(claim_dir, file_name)
+
+        mobile_path = os.path.join(claim_dir, "mobile.txt")
+        if os.path.exists(mobile_path):
+            with open(mobile_path, "r", encoding="utf-8") as f:
+                claim["mobile"] = f.read().strip()
+        mime_path = os.path.join(claim_dir, "mime_types.json")  # Written for spooled / queued claims
+        if os.path.exists(mime_path):
+            with open(mime_path, "r", encoding="utf-8") as f:
+                claim["mime_types"] = json.load(f)
+        date_path = os.path.join(claim_dir, "date_of_loss.txt")
+        if os.path.exists(date_path):
+            with open(date_path, "r", encoding="utf-8") as f:
+                claim["date_of_loss"] = f.read().strip() or None
+
+        missing = [role for role in ROLE_PREFIXES if role not in claim]
+        if missing:
+            print(f"⚠️ Skipping {name}: missing {', '.join(missing)}")
+            continue
+        claims.append(claim)
+    return claims
+
+
+def load_manifest(path):
+    return load_directory_manifest(path) if os.path.isdir(path) else load_jsonl_manifest(path)
+
+
+# --- 2. CHECKPOINTING ---
+def load_checkpoint(out_dir):
+    """Returns {claim_id: last_result} from a previous (possibly interrupted) run."""
+    done = {}
+    path = os.path.join(out_dir, RESULTS_FILE)
+    if not os.path.exists(path): return done
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue  # Torn last line from a crash
+            done[record["claim_id"]] = record
+    return done
+
+
+class CheckpointWriter:
+    def __init__(self, out_dir):
+        self._file = open(os.path.join(out_dir, RESULTS_FILE), "a", encoding="utf-8")
+        self._lock = threading.Lock()
+
+    def write(self, record):
+        line = json.dumps(record, ensure_ascii=False, default=str)
+        with self._lock:
+            self._file.write(line + "\n")
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def close(self):
+        self._file.close()
+
+
+# --- 3. PER-CLAIM PIPELINE ---
+def enrich_with_farmer_profile(final_data, mobile):
+    """Same profile injection app.py does for logged-in users."""
+    farmer = None
+    try:
+        farmer = get_farmer_from_db(mobile) if mobile else None
+    except Exception as e:
+        print(f"⚠️ Farmer lookup failed for {mobile}: {e}")
+    farmer = farmer or {}
+    final_data["mobile_number"] = farmer.get("mobile_number", mobile)
+    final_data["email"] = farmer.get("email")
+    final_data["bank_account_number"] = farmer.get("bank_account_number")
+    final_data["bank_name"] = farmer.get("bank_name")
+    return farmer
+
+
+def render_pdfs(claim, ai_result, out_dir):
+    """Both PDFs in parallel on claim_pipeline's shared pool; raises PostProcessingError if either fails."""
+    final_data = ai_result["data"]
+    full_report_data = ai_result.get("full_report_data", {})
+    app_id = final_data.get("application_id") or claim["claim_id"]
+    pdfs, _ = collect_post_stages(start_pdfs(full_report_data, final_data, claim["photo"]))
+    return (save_pdf(pdfs["report"], os.path.join(out_dir, f"Report_{app_id}.pdf")),
+            save_pdf(pdfs["form"], os.path.join(out_dir, f"Claim_{app_id}.pdf")))
+
+
+def load_uploads(claim):
+    """Reads a claim's files and prepares them exactly as the online path does (normalized audio)."""
+    mime_types = claim.get("mime_types", {})
+    audio, land, photo = (UploadedBlob.from_path(claim[role], mime_types.get(role)) for role in ("audio", "land", "photo"))
+    return convert_audio(audio), land, photo
+
+
+async def run_one(claim, out_dir, make_pdfs):
+    # One trace per claim, so the PDF spans land next to the model stages in traces.jsonl
+    with claim_trace(channel="batch", claim_id=claim["claim_id"]) as trace:
+        started = time.perf_counter()
+        record = {"claim_id": claim["claim_id"], "mobile": claim["mobile"]}
+        try:
+            # File reads and ffmpeg both block: keep them off the event loop
+            audio, land, photo = await asyncio.to_thread(load_uploads, claim)
+            ai_result = await process_claim_async(
+                audio, land, photo,
+                claim["mobile"],
+                spool=False,  # Already on disk: a failed claim is simply retried on the next run
+                date_of_loss=claim.get("date_of_loss"), application_id=claim.get("application_id")
+            )
+            if ai_result.get("status") != "success":
+                record.update(status="failed", reason=ai_result.get("reason", "Unknown error"))
+            else:
+                farmer = await asyncio.to_thread(enrich_with_farmer_profile, ai_result["data"], claim["mobile"])
+                if farmer.get("Applicant_full_name"):  # Report falls back to the 7/12 owner as filer
+                    ai_result.get("full_report_data", {})["filer_name"] = farmer["Applicant_full_name"]
+                record.update(status="success", application_id=ai_result["data"].get("application_id"),
+                              cache_hit=ai_result.get("cache_hit"), data=ai_result["data"], usage=ai_result.get("usage"))
+                if make_pdfs:
+                    r_path, f_path = await asyncio.to_thread(render_pdfs, claim, ai_result, out_dir)
+                    record.update(report_pdf=r_path, form_pdf=f_path)
+        except Exception as e:
+            record.update(status="failed", reason=f"{type(e).__name__}: {e}")
+        record["latency_s"] = round(time.perf_counter() - started, 3)
+        record["trace_id"] = trace.trace_id
+        trace.bind(record.get("application_id"), status=record["status"])
+        return record
+
+
+async def run_batch(claims, out_dir, workers=4, make_pdfs=True, resume=True):
+    os.makedirs(out_dir, exist_ok=True)
+    previous = load_checkpoint(out_dir) if resume else {}
+    pending = [c for c in claims if previous.get(c["claim_id"], {}).get("status") != "success"]
+    # Earliest intimation deadline first (stable: undated claims keep manifest order, last).
+    # Claims already past it go after the ones that can still make it, in manifest order
+    now = datetime.now()
+    deadlines = {id(c): claim_deadline(c.get("date_of_loss"), submitted_at=now) for c in pending}
+    pending.sort(key=lambda c: (deadlines[id(c)] < now, deadlines[id(c)] if deadlines[id(c)] >= now else now))
+    skipped = len(claims) - len(pending)
+    if skipped:
+        print(f"⏩ Resuming: {skipped} claim(s) already done, {len(pending)} to go")
+
+    queue = asyncio.Queue()
+    for claim in pending:
+        queue.put_nowait(claim)
+
+    checkpoint = CheckpointWriter(out_dir)
+    records = []
+
+    async def worker():
+        while True:
+            try:
+                claim = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            record = await run_one(claim, out_dir, make_pdfs)
+            checkpoint.write(record)
+            records.append(record)
+            icon = "✅" if record["status"] == "success" else "❌"
+            print(f"{icon} [{len(records)}/{len(pending)}] {record['claim_id']} ({record['latency_s']}s) {record.get('reason', '')}")
+
+    started = time.perf_counter()
+    try:
+        await asyncio.gather(*(worker() for _ in range(max(1, workers))))
+    finally:
+        checkpoint.close()
+    return records, skipped, time.perf_counter() - started
+
+
+# --- 4. SUMMARY ---
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values: return 0.0
+    rank = max(1, int(round(pct / 100.0 * len(sorted_values))))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def summarize(records, skipped, wall_seconds):
+    latencies = sorted(r["latency_s"] for r in records)
+    failures = Counter(r.get("reason", "Unknown") for r in records if r["status"] != "success")
+    succeeded = len(records) - sum(failures.values())
+    summary = {
+        "processed": len(records),
+        "succeeded": succeeded,
+        "failed": sum(failures.values()),
+        "skipped_from_checkpoint": skipped,
+        "wall_seconds": round(wall_seconds, 2),
+        "throughput_per_min": round(len(records) / wall_seconds * 60, 2) if wall_seconds > 0 else 0.0,
+        "latency_s": {p: percentile(latencies, int(p[1:])) for p in ("p50", "p90", "p95", "p99")},
+        "failure_reasons": dict(failures.most_common()),
+    }
+    summary["latency_s"]["max"] = latencies[-1] if latencies else 0.0
+    usages = [r["usage"] for r in records if r.get("usage")]
+    summary["tokens"] = {key: sum(u.get(key, 0) for u in usages) for key in ("input_tokens", "output_tokens", "thinking_tokens", "total_tokens")}
+    summary["tokens"]["per_claim"] = round(summary["tokens"]["total_tokens"] / len(usages)) if usages else 0
+    summary["bytes_sent"] = sum(u.get("bytes_sent", 0) for u in usages)
+    return summary
+
+
+def print_summary(summary, cache_stats, document_stats=None, gate_stats=None, output_stats=None, resilience_stats=None):
+    print("\n" + "=" * 60)
+    print("📊 BATCH SUMMARY")
+    print("=" * 60)
+    print(f"Processed : {summary['processed']}  (✅ {summary['succeeded']}  ❌ {summary['failed']}  ⏩ {summary['skipped_from_checkpoint']} skipped)")
+    print(f"Wall time : {summary['wall_seconds']}s  |  Throughput: {summary['throughput_per_min']} claims/min")
+    lat = summary["latency_s"]
+    print(f"Latency   : p50 {lat['p50']}s | p90 {lat['p90']}s | p95 {lat['p95']}s | p99 {lat['p99']}s | max {lat['max']}s")
+    if summary["failure_reasons"]:
+        print("Failures  :")
+        for reason, count in summary["failure_reasons"].items():
+            print(f"   {count:>4} x {reason}")
+    tokens = summary.get("tokens") or {}
+    if tokens.get("total_tokens"):
+        print(f"Tokens    : {tokens['input_tokens']} in / {tokens['output_tokens'] + tokens['thinking_tokens']} out "
+              f"({tokens['per_claim']} per claim)  |  {summary['bytes_sent'] / 1e6:.1f} MB sent to the model")
+    for stage, stats in cache_stats.items():
+        print(f"Cache [{stage}]: {stats['hits']} hits / {stats['misses']} misses, {stats['seconds_saved']}s model time saved")
+    if document_stats and document_stats["documents"]:
+        print(f"7/12      : {document_stats['text_layer_fast_path']}/{document_stats['documents']} read from text layer, "
+              f"{document_stats['pages_sent']}/{document_stats['pages_total']} PDF pages sent to the model")
+    if gate_stats and gate_stats["rejected"]:
+        print(f"Local gate: {gate_stats['rejected']}/{gate_stats['checked']} rejected before the model "
+              f"(~{gate_stats['model_seconds_saved']}s model time saved) {gate_stats['reasons']}")
+    if output_stats and (output_stats["repaired"] or output_stats["retries"]):
+        print(f"Model JSON: {output_stats['repaired']}/{output_stats['responses']} repaired locally {output_stats['repairs']}, "
+              f"{output_stats['retries']} retried ({output_stats['retry_recovered']} recovered, {output_stats['failed']} failed)")
+    if resilience_stats and resilience_stats["rate_limited"]:
+        print(f"Quota     : {resilience_stats['rate_limited']} calls held back by the rate limit "
+              f"({resilience_stats['rate_limit_seconds']}s in total)")
+    if resilience_stats and (resilience_stats["retries"] or resilience_stats["hedges"] or resilience_stats["fast_failures"]):
+        print(f"Upstream  : {resilience_stats['retries']} retries, {resilience_stats['timeouts']} timeouts, "
+              f"{resilience_stats['hedges']} hedges ({resilience_stats['hedge_wins']} won), "
+              f"{resilience_stats['fast_failures']} fast-failed (breaker {resilience_stats['breaker']['state']}, opened {resilience_stats['breaker']['opens']}x)")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Batch-process offline PMFBY claims through the Viksit Kisan agent.")
+    parser.add_argument("manifest", help="JSONL manifest file or a directory with one sub-folder per claim")
+    parser.add_argument("--out", default="batch_output", help="Output folder for results.jsonl and PDFs")
+    parser.add_argument("--workers", type=int, default=4, help="Claims processed concurrently")
+    parser.add_argument("--max-model-calls", type=int, default=None, help="Cap on concurrent Gemini calls")
+    parser.add_argument("--calls-per-minute", type=float, default=None, help="Gemini quota (requests/min), overrides MODEL_CALLS_PER_MINUTE")
+    parser.add_argument("--no-pdf", action="store_true", help="Skip report/form PDF generation")
+    parser.add_argument("--no-resume", action="store_true", help="Re-run claims that already succeeded")
+    parser.add_argument("--no-cache", action="store_true", help="Bypass the stage result caches")
+    parser.add_argument("--fake-backend", action="store_true", help="Load test: replay canned answers instead of calling Gemini")
+    parser.add_argument("--fake-latency", type=float, default=1.0, help="Fake backend median latency (s)")
+    parser.add_argument("--fake-error-rate", type=float, default=0.0, help="Fake backend error probability per call")
+    parser.add_argument("--fake-malformed-rate", type=float, default=0.0, help="Fake backend probability of a damaged JSON answer")
+    args = parser.parse_args(argv)
+
+    if args.fake_backend:
+        agent_engine.set_backend(FakeBackend(median_latency_s=args.fake_latency, error_rate=args.fake_error_rate,
+                                              malformed_rate=args.fake_malformed_rate))
+    if args.no_cache:
+        agent_engine.set_cache_enabled(False)
+    if args.calls_per_minute is not None:
+        agent_engine.rate_limiter = TokenBucket(args.calls_per_minute)
+
+    claims = load_manifest(args.manifest)
+    print(f"📦 Loaded {len(claims)} claim(s) from {args.manifest}")
+    configure_concurrency(max_calls=args.max_model_calls or args.workers * 3)
+
+    records, skipped, wall = asyncio.run(run_batch(claims, args.out, args.workers, not args.no_pdf, not args.no_resume))
+    summary = summarize(records, skipped, wall)
+    summary["model_output"] = get_output_stats()
+    summary["upstream"] = get_resilience_stats(agent_engine.breaker)
+    print_summary(summary, get_cache_stats(), get_document_stats(), get_gate_stats(), summary["model_output"], summary["upstream"])
+
+    with open(os.path.join(args.out, "summary.json"), "w", encoding="utf-8") as f:
+        json.dump(summary, f, indent=2, ensure_ascii=False)
+    return 0 if summary["failed"] == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,143 @@
+# bench_forms.py
+# Microbenchmark for the claim form renderer (pdf_generator.FormRenderer).
+#
+#   python bench_forms.py              (50 forms per mode)
+#   python bench_forms.py --forms 200
+#   python bench_forms.py --shaping    (HarfBuzz shaping cache off vs on, over a varied bulk batch)
+#   python bench_forms.py --fonts      (fpdf's per-form font subsetting vs the pre-built subset: size + time)
+#
+# "cold": a new renderer per form - font + template parsed every time (the old generate_filled_pdf).
+# "warm": one long-lived renderer, font + template parsed once (what the app and workers use now).
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+import statistics
+import contextlib
+
+from pdf_generator import FormRenderer
+from form_layouts import get_layout
+from shaping_cache import shaping_cache
+
+SAMPLE_FIELDS = {
+    "farmer_full_name": "रामराव शंकर पाटील", "address_village": "शिरूर", "address_taluka": "हवेली",
+    "address_district": "पुणे", "mobile_number": "9922001122", "email": "farmer@example.com",
+    "financial_year": "2025-26", "season": "खरीप", "bank_account_number": "123456789012",
+    "bank_name": "State Bank of India", "premium_amount": "1200", "survey_number": "45/2",
+    "crop_name": "सोयाबीन", "sown_area_hectare": "1.5", "cause_of_loss": "अवकाळी पाऊस",
+    "date_of_loss": "14/10/2026",
+}
+
+# A bulk batch is many farmers from a handful of villages: names change, most other strings repeat
+BULK_NAMES = ["रामराव शंकर पाटील", "सुनीता विठ्ठल जाधव", "गणेश दत्तात्रय शिंदे", "मीरा बाळासाहेब पवार",
+              "विजय नामदेव कदम", "अनिता प्रकाश गायकवाड", "संतोष मारुती भोसले", "कविता रमेश देशमुख"]
+BULK_VILLAGES = ["शिरूर", "लोणी काळभोर", "उरुळी कांचन", "थेऊर", "वाघोली"]
+BULK_CROPS = ["सोयाबीन", "कापूस", "तूर", "बाजरी"]
+
+
+def bulk_fields(i):
+    return {**SAMPLE_FIELDS, "farmer_full_name": BULK_NAMES[i % len(BULK_NAMES)],
+            "address_village": BULK_VILLAGES[i % len(BULK_VILLAGES)], "crop_name": BULK_CROPS[i % len(BULK_CROPS)],
+            "mobile_number": f"99220{i:05d}", "survey_number": f"{10 + i % 90}/{1 + i % 3}"}
+
+
+def time_forms(get_renderer, forms, fields=lambda i: SAMPLE_FIELDS):
+    """Milliseconds per form (rendered in memory); the renderers' progress prints are silenced."""
+    times = []
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        for i in range(forms):
+            started = time.perf_counter()
+            data = get_renderer().render({"form_fields": fields(i)})
+            times.append((time.perf_counter() - started) * 1000)
+            if data is None:
+                raise RuntimeError("render failed (run from the repo root so assets/ is found)")
+    return times
+
+
+def report(label, times):
+    ordered = sorted(times)
+    p95 = ordered[min(len(ordered) - 1, int(0.95 * len(ordered)))]
+    print(f"  {label:<5} mean {statistics.mean(times):6.1f} ms | median {statistics.median(times):6.1f} ms | "
+          f"p95 {p95:6.1f} ms")
+    return statistics.mean(times)
+
+
+def bench_shaping(renderer, forms):
+    """Same varied batch with the shaping cache off, then on (cold cache, as in a fresh bulk worker)."""
+    results = {}
+    for label, enabled in (("off", False), ("on", True)):
+        shaping_cache.enabled = enabled
+        shaping_cache.clear()
+        shaping_cache.reset_stats()
+        results[label] = (report(label, time_forms(lambda: renderer, forms, bulk_fields)), shaping_cache.stats())
+    shaping_cache.enabled = True
+
+    off_ms, off_stats = results["off"]
+    on_ms, on_stats = results["on"]
+    off_shaping = off_stats["shaping_seconds"] * 1000 / forms
+    on_shaping = on_stats["shaping_seconds"] * 1000 / forms
+    print(f"🔤 HarfBuzz time per form: {off_shaping:.2f} ms -> {on_shaping:.2f} ms "
+          f"(hit rate {on_stats['hit_rate']:.0%}, {on_stats['entries']} strings cached)")
+    print(f"⚡ Shaping cache: {off_ms - on_ms:.1f} ms saved per form ({off_ms / on_ms:.2f}x)")
+
+
+def bench_fonts(plan, forms):
+    """Single forms, then a bulk file of `forms` claims: fpdf embedding the full font vs the pre-built subset."""
+    import bulk_forms
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        renderers = {"fpdf": FormRenderer(plan, presubset=False), "pre": FormRenderer(plan, presubset=True)}
+    if not renderers["pre"]._presubsets:
+        print("⚠️ No pre-built font subset in this layout (python form_fonts.py, then \"subset\" in its fonts)")
+        return
+
+    single = {}
+    for label, renderer in renderers.items():
+        time_forms(lambda: renderer, 3)
+        ms = report(label, time_forms(lambda: renderer, forms, bulk_fields))
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            single[label] = (ms, len(renderer.render({"form_fields": bulk_fields(0)})))
+    print(f"📄 One form: {single['fpdf'][1] / 1024:.0f} KB -> {single['pre'][1] / 1024:.0f} KB, "
+          f"{single['fpdf'][0]:.1f} -> {single['pre'][0]:.1f} ms")
+
+    bulk = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for label, flag in (("fpdf", "0"), ("pre", "1")):
+            os.environ["FORM_PRESUBSET_FONTS"] = flag  # Read by the (spawned) bulk processes
+            with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+                bulk[label] = bulk_forms.render_bulk((bulk_fields(i) for i in range(forms)),
+                                                     os.path.join(tmp, f"{label}.pdf"), processes=1)
+    os.environ.pop("FORM_PRESUBSET_FONTS")
+    print(f"🖨️ {forms} forms in one file: {bulk['fpdf']['bytes'] / 1024:.0f} KB -> {bulk['pre']['bytes'] / 1024:.0f} KB, "
+          f"{bulk['fpdf']['pages_per_second']} -> {bulk['pre']['pages_per_second']} pages/s (1 process)")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Per-form render time: cold renderer vs warm (cached) renderer.")
+    parser.add_argument("--forms", type=int, default=50, help="Forms rendered per mode")
+    parser.add_argument("--year", type=int, help="Form layout in force in this year (default: newest)")
+    parser.add_argument("--shaping", action="store_true", help="Compare the HarfBuzz shaping cache off vs on")
+    parser.add_argument("--fonts", action="store_true", help="Compare per-form font subsetting vs the pre-built subset")
+    args = parser.parse_args(argv)
+
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        plan = get_layout(year=args.year)
+        warm = FormRenderer(plan)
+    time_forms(lambda: warm, 3)  # Warm-up (imports, HarfBuzz face, first-use caches)
+
+    print(f"📄 {args.forms} forms per mode ({plan.id})")
+    if args.shaping:
+        bench_shaping(warm, args.forms)
+        return 0
+    if args.fonts:
+        bench_fonts(plan, args.forms)
+        return 0
+    cold_ms = report("cold", time_forms(lambda: FormRenderer(plan), args.forms))
+    warm_ms = report("warm", time_forms(lambda: warm, args.forms))
+    print(f"⚡ Cached renderer: {cold_ms - warm_ms:.1f} ms saved per form ({cold_ms / warm_ms:.2f}x)")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
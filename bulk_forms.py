@@ -0,0 +1,289 @@
+# bulk_forms.py
+# The day's filled PMFBY forms for a whole taluka as ONE printable file.
+#
+#   python bulk_forms.py batch_output/results.jsonl --out haveli.pdf
+#   python bulk_forms.py --from-db --date 18/10/2026 --taluka हवेली --out haveli.pdf
+#   python bulk_forms.py batch_output/results.jsonl --out forms.zip      (one PDF per claim)
+#
+# Overlays (just the filled-in values) are rendered across a process pool, one FormRenderer per
+# process. The parent streams them into the output file as they arrive: the template page's
+# objects are written once and every claim page reuses them, with its overlay drawn on top as a
+# Form XObject. Only a bounded window of claims is in flight and written objects are not kept,
+# so memory stays flat however many claims there are (only the xref offsets grow). Fonts with a
+# pre-built subset (form_fonts) are left out of the overlays and written once, shared by every page.
+
+import io
+import os
+import sys
+import json
+import time
+import zlib
+import zipfile
+import argparse
+import collections
+import multiprocessing
+from datetime import datetime, timedelta
+from concurrent.futures import ProcessPoolExecutor
+
+from pypdf import PdfReader
+from pypdf.generic import (ArrayObject, DictionaryObject, IndirectObject, NameObject, NumberObject,
+                           StreamObject, DecodedStreamObject, RectangleObject)
+
+import form_layouts
+import form_fonts
+
+# --- SETTINGS (override via .env) ---
+BULK_PROCESSES = int(os.getenv("BULK_FORM_PROCESSES", max(1, (os.cpu_count() or 2) - 1)))
+IN_FLIGHT_PER_PROCESS = 4  # Claims queued ahead per process: bounds memory, keeps every process busy
+OVERLAY_NAME = NameObject("/VKOverlay")
+
+
+# --- 1. WORKER PROCESSES ---
+def _render(task):
+    """(fields, zip mode) -> (layout id, overlay bytes | full form bytes, detached fonts). Runs in a pool process."""
+    import contextlib
+    from pdf_generator import get_form_renderer
+    fields, full_form = task
+    plan = form_layouts.layout_for_claim(fields)
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):  # Per-form prints, x thousands
+        renderer = get_form_renderer(plan)
+        if full_form:
+            return plan.id, renderer.render({"form_fields": fields}), {}
+        data, fonts = renderer.render_overlay({"form_fields": fields}, detach_fonts=True)
+    return plan.id, data, fonts
+
+
+def render_stream(claims, processes=BULK_PROCESSES, full_form=False):
+    """
+    Yields (fields, layout id, bytes, detached fonts) in input order, with at most IN_FLIGHT_PER_PROCESS
+    claims per process queued.
+    """
+    window = collections.deque()
+    ctx = multiprocessing.get_context("spawn")  # Same as claim_worker: no forked Mongo clients
+    with ProcessPoolExecutor(max_workers=processes, mp_context=ctx) as pool:
+        for fields in claims:
+            window.append((fields, pool.submit(_render, (fields, full_form))))
+            if len(window) >= processes * IN_FLIGHT_PER_PROCESS:
+                fields, future = window.popleft()
+                yield (fields,) + future.result()
+        while window:
+            fields, future = window.popleft()
+            yield (fields,) + future.result()
+
+
+# --- 2. STREAMING PDF WRITER ---
+class StreamingPdfWriter:
+    """
+    Appends template + overlay pages to a PDF on disk. Objects are serialized as soon as they are
+    copied; only their offsets (and the shared template objects' numbers) stay in memory.
+    """
+
+    def __init__(self, path):
+        self._f = open(path, "wb")
+        self._f.write(b"%PDF-1.7\n%\xe2\xe3\xcf\xd3\n")
+        self._offsets = [0, None, None]  # Object 1 = Catalog, 2 = Pages (written by close())
+        self._page_ids = []
+        self._shared = {}      # (template key, object number) -> our object number
+        self._templates = {}   # layout id -> (page template dict, content refs)
+        self._wrap = None      # Shared "q" / "Q q /VKOverlay Do Q" content streams
+        self._fonts = {}       # subset path -> [object number, PresubsetFont, glyphs used so far]
+
+    def _new_id(self):
+        self._offsets.append(None)
+        return len(self._offsets) - 1
+
+    def _write(self, obj_id, obj):
+        self._offsets[obj_id] = self._f.tell()
+        self._f.write(f"{obj_id} 0 obj\n".encode())
+        obj.write_to_stream(self._f)
+        self._f.write(b"\nendobj\n")
+
+    def _add(self, obj):
+        obj_id = self._new_id()
+        self._write(obj_id, obj)
+        return IndirectObject(obj_id, 0, None)
+
+    def _copy(self, obj, ids):
+        """Deep-copies a pypdf object, writing each referenced object once (ids: source number -> ours)."""
+        if isinstance(obj, IndirectObject):
+            if obj.idnum not in ids:
+                ids[obj.idnum] = self._new_id()
+                self._write(ids[obj.idnum], self._copy(obj.get_object(), ids))
+            return IndirectObject(ids[obj.idnum], 0, None)
+        if isinstance(obj, StreamObject):
+            copied = obj.__class__()
+            copied._data = obj._data  # Still encoded: no decompress / recompress
+            for key, value in obj.items():
+                if key != "/Length": copied[NameObject(key)] = self._copy(value, ids)
+            return copied
+        if isinstance(obj, DictionaryObject):
+            copied = DictionaryObject()
+            for key, value in obj.items():
+                if key != "/Parent": copied[NameObject(key)] = self._copy(value, ids)
+            return copied
+        if isinstance(obj, ArrayObject):
+            return ArrayObject(self._copy(value, ids) for value in obj)
+        return obj
+
+    def _stream(self, data):
+        stream = DecodedStreamObject()
+        stream.set_data(data)
+        return self._add(stream)
+
+    def _template(self, layout_id, template_path):
+        """Writes a layout's template page objects once; returns (resources, media box, content refs)."""
+        if layout_id not in self._templates:
+            page = PdfReader(template_path).pages[0]
+            ids = self._shared.setdefault(layout_id, {})
+            contents = page["/Contents"]
+            contents = contents if isinstance(contents, ArrayObject) else ArrayObject([contents])
+            self._templates[layout_id] = (self._copy(page["/Resources"].get_object(), ids),
+                                          RectangleObject(page.mediabox), [self._copy(c, ids) for c in contents])
+        if self._wrap is None:
+            self._wrap = (self._stream(b"q\n"), self._stream(b"\nQ\nq " + OVERLAY_NAME.encode() + b" Do Q\n"))
+        return self._templates[layout_id]
+
+    def _shared_font(self, layout, family, glyphs):
+        """Object number of the file's one copy of a family's pre-built subset (written by close())."""
+        font = next(font for font in layout.fonts.values() if font["family"] == family and font.get("subset"))
+        if font["subset"] not in self._fonts:
+            self._fonts[font["subset"]] = [self._new_id(), form_fonts.load_presubset(font["subset"], font["file"]), {}]
+        shared = self._fonts[font["subset"]]
+        form_fonts.merge_glyphs(shared[2], glyphs)
+        return shared[0]
+
+    def add_form_page(self, layout, overlay_bytes, fonts=None):
+        """
+        One claim page: the layout's template with the overlay drawn on top (like pypdf merge_page).
+        fonts: the overlay's detached fonts ({resource name: (family, glyphs)}), pointed at the shared copy.
+        """
+        resources, media_box, contents = self._template(layout.id, layout.template)
+        overlay_page = PdfReader(io.BytesIO(overlay_bytes)).pages[0]
+
+        # Detached fonts: the overlay's placeholder reference is copied as the shared font instead
+        ids = {}
+        overlay_fonts = overlay_page["/Resources"].get("/Font", DictionaryObject()).get_object()
+        for name, (family, glyphs) in (fonts or {}).items():
+            placeholder = overlay_fonts.raw_get(name) if name in overlay_fonts else None
+            if isinstance(placeholder, IndirectObject):
+                ids[placeholder.idnum] = self._shared_font(layout, family, glyphs)
+
+        # The overlay page becomes a Form XObject with its own resources
+        xobject = StreamObject()
+        xobject._data = zlib.compress(overlay_page.get_contents().get_data())
+        xobject.update({
+            NameObject("/Type"): NameObject("/XObject"), NameObject("/Subtype"): NameObject("/Form"),
+            NameObject("/BBox"): RectangleObject(overlay_page.mediabox), NameObject("/Filter"): NameObject("/FlateDecode"),
+            NameObject("/Resources"): self._copy(overlay_page["/Resources"].get_object(), ids),
+        })
+        page_resources = DictionaryObject(resources)  # Shallow: the template's fonts / images stay shared
+        xobjects = DictionaryObject(page_resources.get("/XObject", DictionaryObject()))
+        xobjects[OVERLAY_NAME] = self._add(xobject)
+        page_resources[NameObject("/XObject")] = xobjects
+
+        page = DictionaryObject({
+            NameObject("/Type"): NameObject("/Page"), NameObject("/Parent"): IndirectObject(2, 0, None),
+            NameObject("/MediaBox"): media_box, NameObject("/Resources"): page_resources,
+            NameObject("/Contents"): ArrayObject([self._wrap[0]] + contents + [self._wrap[1]]),
+        })
+        self._page_ids.append(self._add(page))
+
+    def close(self):
+        for font_id, presubset, glyphs in self._fonts.values():
+            self._write(font_id, presubset.font_dict(self._add, glyphs))
+        self._write(2, DictionaryObject({NameObject("/Type"): NameObject("/Pages"),
+                                         NameObject("/Kids"): ArrayObject(self._page_ids),
+                                         NameObject("/Count"): NumberObject(len(self._page_ids))}))
+        self._write(1, DictionaryObject({NameObject("/Type"): NameObject("/Catalog"),
+                                         NameObject("/Pages"): IndirectObject(2, 0, None)}))
+        xref = self._f.tell()
+        self._f.write(f"xref\n0 {len(self._offsets)}\n0000000000 65535 f \n".encode())
+        for offset in self._offsets[1:]:
+            self._f.write(f"{offset:010d} 00000 n \n".encode())
+        self._f.write(f"trailer\n<< /Size {len(self._offsets)} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode())
+        self._f.close()
+        return len(self._page_ids)
+
+
+# --- 3. BULK API ---
+def render_bulk(claims, out_path, processes=BULK_PROCESSES):
+    """
+    Renders every claim's form_fields (any iterable, consumed lazily) into out_path:
+    one merged PDF, or one PDF per claim inside a zip if out_path ends in .zip.
+    Returns {"forms", "pages", "seconds", "pages_per_second", "bytes"}.
+    """
+    started = time.perf_counter()
+    as_zip = out_path.lower().endswith(".zip")
+    stream = render_stream(claims, processes, full_form=as_zip)
+    forms = 0
+    if as_zip:
+        with zipfile.ZipFile(out_path, "w", zipfile.ZIP_STORED) as archive:  # PDFs are already compressed
+            for fields, _, data, _ in stream:
+                forms += 1
+                archive.writestr(f"Claim_{fields.get('application_id') or forms}.pdf", data)
+        pages = forms
+    else:
+        writer = StreamingPdfWriter(out_path)
+        layouts = {}
+        for fields, layout_id, overlay, fonts in stream:
+            forms += 1
+            if layout_id not in layouts: layouts[layout_id] = form_layouts.find_layout(layout_id)
+            writer.add_form_page(layouts[layout_id], overlay, fonts)
+        pages = writer.close()
+    seconds = time.perf_counter() - started
+    stats = {"forms": forms, "pages": pages, "seconds": round(seconds, 2),
+             "pages_per_second": round(pages / seconds, 1) if seconds else 0.0, "bytes": os.path.getsize(out_path)}
+    print(f"🖨️ {forms} form(s) -> {out_path}: {pages} pages in {seconds:.1f}s "
+          f"({stats['pages_per_second']} pages/s, {stats['bytes'] / 1024 / 1024:.1f} MB)")
+    return stats
+
+
+# --- 4. SOURCES ---
+def iter_results_file(path, taluka=None):
+    """form_fields of the successful claims in a batch_claims results.jsonl (or any JSONL of form_fields)."""
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if not line.strip(): continue
+            record = json.loads(line)
+            if record.get("status", "success") != "success": continue
+            fields = record.get("data") or record.get("submitted_data") or record.get("form_fields") or record
+            if taluka and fields.get("address_taluka") != taluka: continue
+            yield fields
+
+
+def iter_claims_from_db(day=None, taluka=None):
+    """Approved claims logged on `day` (date; default today, IST) from MongoDB, streamed from a cursor."""
+    import agent_engine
+    if not agent_engine.DB_CONNECTED:
+        raise RuntimeError("MongoDB is not connected (MONGO_URI)")
+    start = datetime.combine(day or datetime.now(form_layouts.IST).date(), datetime.min.time())
+    start = form_layouts.IST.localize(start)
+    query = {"status": "Approved", "timestamp": {"$gte": start, "$lt": start + timedelta(days=1)}}
+    if taluka: query["submitted_data.address_taluka"] = taluka
+    for claim in agent_engine.db["claims"].find(query, {"submitted_data": 1}).sort("timestamp", 1):
+        yield claim["submitted_data"]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Render many claims' PMFBY forms into one PDF (or a zip).")
+    parser.add_argument("results", nargs="?", help="batch_claims results.jsonl (or JSONL of form_fields)")
+    parser.add_argument("--from-db", action="store_true", help="Read the day's approved claims from MongoDB")
+    parser.add_argument("--date", help="Day for --from-db (dd/mm/YYYY, default today)")
+    parser.add_argument("--taluka", help="Only claims from this taluka (as written on the form)")
+    parser.add_argument("--out", default="forms.pdf", help="Output .pdf (merged) or .zip (one PDF per claim)")
+    parser.add_argument("--processes", type=int, default=BULK_PROCESSES)
+    args = parser.parse_args(argv)
+
+    if args.from_db:
+        day = datetime.strptime(args.date, "%d/%m/%Y").date() if args.date else None
+        claims = iter_claims_from_db(day, args.taluka)
+    elif args.results:
+        claims = iter_results_file(args.results, args.taluka)
+    else:
+        parser.error("give a results.jsonl or --from-db")
+    stats = render_bulk(claims, args.out, max(1, args.processes))
+    return 0 if stats["forms"] else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,186 @@
+# claim_cache.py
+# Caches the model's answer for each claim stage (document / voice / visual), keyed by the exact
+# upload bytes, so a resubmitted or retried claim does not pay for the same Gemini call twice.
+# The key also covers the backend and the stage's prompt version: changing either invalidates it.
+# Entries live in memory (LRU) and on disk under CLAIM_CACHE_DIR, and expire after CLAIM_CACHE_TTL_SECONDS.
+
+import os
+import json
+import time
+import copy
+import hashlib
+import threading
+from collections import OrderedDict
+
+# --- CACHE SETTINGS (override via .env) ---
+CACHE_DIR = os.getenv("CLAIM_CACHE_DIR", ".claim_cache")
+CACHE_TTL_SECONDS = float(os.getenv("CLAIM_CACHE_TTL_SECONDS", 24 * 3600))
+CACHE_MAX_ENTRIES = int(os.getenv("CLAIM_CACHE_MAX_ENTRIES", 256))
+CACHE_MAX_DISK_ENTRIES = int(os.getenv("CLAIM_CACHE_MAX_DISK_ENTRIES", 4096))
+
+
+def content_key(*blobs, fingerprint=""):
+    """
+    SHA-256 over the raw upload bytes plus a fingerprint (prompt/model version).
+    Each blob is length-prefixed so (b"ab", b"c") and (b"a", b"bc") never collide.
+    """
+    h = hashlib.sha256()
+    h.update(fingerprint.encode("utf-8"))
+    for blob in blobs:
+        h.update(len(blob).to_bytes(8, "big"))
+        h.update(blob)
+    return h.hexdigest()
+
+
+class ResultCache:
+    """
+    Two-tier LRU + TTL cache for model results.
+    Tier 1: in-memory OrderedDict (fast, lost on restart).
+    Tier 2: one JSON file per key on disk (survives restarts).
+    Values must be JSON-serializable.
+    """
+
+    def __init__(self, name, max_entries=CACHE_MAX_ENTRIES, ttl_seconds=CACHE_TTL_SECONDS,
+                 cache_dir=CACHE_DIR, max_disk_entries=CACHE_MAX_DISK_ENTRIES):
+        self.name = name
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.max_disk_entries = max_disk_entries
+        self.disk_dir = os.path.join(cache_dir, name) if cache_dir else None
+        self.enabled = True
+
+        self._memory = OrderedDict()  # key -> (created_at, cost_seconds, value)
+        self._lock = threading.Lock()
+        self._puts_since_prune = 0
+        self._stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "expired": 0, "seconds_saved": 0.0}
+
+        if self.disk_dir:
+            try:
+                os.makedirs(self.disk_dir, exist_ok=True)
+            except OSError as e:
+                print(f"⚠️ Cache dir unavailable ({e}), using memory only.")
+                self.disk_dir = None
+
+    # --- HELPERS ---
+    def _path(self, key):
+        return os.path.join(self.disk_dir, f"{key}.json")
+
+    def _is_fresh(self, created_at):
+        return (time.time() - created_at) < self.ttl_seconds
+
+    def _remember(self, key, entry):
+        self._memory[key] = entry
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def _read_disk(self, key):
+        if not self.disk_dir: return None
+        try:
+            with open(self._path(key), "r", encoding="utf-8") as f:
+                raw = json.load(f)
+            return raw["created_at"], raw.get("cost_seconds", 0.0), raw["value"]
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def _write_disk(self, key, entry):
+        if not self.disk_dir: return
+        created_at, cost_seconds, value = entry
+        tmp_path = f"{self._path(key)}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"created_at": created_at, "cost_seconds": cost_seconds, "value": value},
+                          f, ensure_ascii=False)
+            os.replace(tmp_path, self._path(key))  # Atomic: readers never see half a file
+        except (OSError, TypeError, ValueError) as e:
+            print(f"⚠️ Cache write skipped: {e}")
+            if os.path.exists(tmp_path): os.remove(tmp_path)
+
+    def _drop_disk(self, key):
+        if not self.disk_dir: return
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def _prune_disk(self):
+        """Evicts expired files, then the oldest ones beyond max_disk_entries."""
+        if not self.disk_dir: return
+        try:
+            files = [os.path.join(self.disk_dir, n) for n in os.listdir(self.disk_dir) if n.endswith(".json")]
+            files = sorted(files, key=os.path.getmtime)
+        except OSError:
+            return
+        cutoff = time.time() - self.ttl_seconds
+        overflow = len(files) - self.max_disk_entries
+        for i, path in enumerate(files):
+            try:
+                if i < overflow or os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+            except OSError:
+                pass
+
+    # --- PUBLIC API ---
+    def get(self, key):
+        """Returns a private copy of the cached value, or None on miss/expiry."""
+        if not self.enabled:
+            with self._lock:
+                self._stats["misses"] += 1
+            return None
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                if self._is_fresh(entry[0]):
+                    self._memory.move_to_end(key)
+                    self._stats["memory_hits"] += 1
+                    self._stats["seconds_saved"] += entry[1]
+                    return copy.deepcopy(entry[2])
+                del self._memory[key]
+                self._stats["expired"] += 1
+
+        entry = self._read_disk(key)
+        with self._lock:
+            if entry is not None:
+                if self._is_fresh(entry[0]):
+                    self._remember(key, entry)  # Promote to memory tier
+                    self._stats["disk_hits"] += 1
+                    self._stats["seconds_saved"] += entry[1]
+                    return copy.deepcopy(entry[2])
+                self._stats["expired"] += 1
+            self._stats["misses"] += 1
+
+        if entry is not None:
+            self._drop_disk(key)
+        return None
+
+    def put(self, key, value, cost_seconds=0.0):
+        """Stores value; cost_seconds is the model time a future hit will save."""
+        if not self.enabled: return
+        entry = (time.time(), float(cost_seconds), copy.deepcopy(value))
+        with self._lock:
+            self._remember(key, entry)
+            self._puts_since_prune += 1
+            prune = self._puts_since_prune >= 32
+            if prune: self._puts_since_prune = 0
+        self._write_disk(key, entry)
+        if prune: self._prune_disk()
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+        if self.disk_dir:
+            for name in os.listdir(self.disk_dir):
+                if name.endswith(".json"):
+                    self._drop_disk(name[:-5])
+
+    def stats(self):
+        with self._lock:
+            s = dict(self._stats)
+            s["memory_entries"] = len(self._memory)
+        hits = s["memory_hits"] + s["disk_hits"]
+        lookups = hits + s["misses"]
+        s["name"] = self.name
+        s["hits"] = hits
+        s["hit_rate"] = round(hits / lookups, 3) if lookups else 0.0
+        s["seconds_saved"] = round(s["seconds_saved"], 2)
+        return s
@@ -0,0 +1,211 @@
+# claim_pipeline.py
+# Everything "Submit Claim" does, outside Streamlit, so it can run in a worker process
+# (claim_worker.py) as well as inline:
+#
+#   audio normalization (audio_prep) -> agent_engine.process_claim -> ledger write + both PDFs
+#
+# Post-AI stages share one thread pool and overlap: both PDFs start from the agent's "form_fields"
+# update (while the agent is still saving the claim), the ledger write joins them as soon as the
+# agent returns, and every failure is reported together once all of them have finished.
+# PDFs are built in memory; they are written to disk once, under their final name, only if asked.
+
+import os
+import time
+import contextvars
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+import pytz
+
+import agent_engine
+import audio_prep
+from agent_engine import UploadedBlob, process_claim, _notify
+from pdf_generator import generate_filled_pdf
+from report_gen import generate_best_report
+from tracing import span, traced
+
+# PDF layout is tens of ms and the ledger write is network-bound, so threads are enough
+POST_POOL_WORKERS = int(os.getenv("POST_POOL_WORKERS", 6))
+_post_pool = ThreadPoolExecutor(max_workers=POST_POOL_WORKERS, thread_name_prefix="post")
+
+# Farmer profile fields copied onto the documents (the rest of the Mongo user doc is not needed)
+PROFILE_FIELDS = ("mobile_number", "email", "bank_account_number", "bank_name", "Applicant_full_name")
+
+
+# --- 1. AUDIO ---
+def convert_audio(audio_file):
+    """Any mobile recording (WebM/M4A...) -> 16 kHz mono WAV for the model, in memory; the raw upload if that fails."""
+    with span("audio.normalize"):
+        data, mime_type, info = audio_prep.normalize_audio(audio_file.getvalue(), getattr(audio_file, "type", None))
+    if info.get("skipped"):
+        return audio_file
+    return UploadedBlob(data, mime_type, "clean.wav")
+
+
+# --- 2. LEDGER ---
+@traced("db.log_claim")
+def log_claim_to_db(final_data, ai_response, mobile, confidence=0.99):
+    """
+    Logs the claim to MongoDB using Upsert to prevent duplicates.
+    This ensures the 'Calculating...' record is overwritten with final data.
+    """
+    if not agent_engine.DB_CONNECTED: return None
+    claims_col = agent_engine.db["claims"]
+    app_id = final_data.get("application_id", f"PMFBY-{int(time.time())}")
+
+    # Extract Voice Response Safely
+    voice_msg = ai_response.get("voice_response") or final_data.get("voice_response") or "Claim processed successfully."
+
+    IST = pytz.timezone('Asia/Kolkata')
+
+    claim_document = {
+        "application_id": app_id,
+        "farmer_mobile": mobile,
+        "timestamp": datetime.now(IST),
+        "status": "Approved" if ai_response.get("status") == "success" else "Rejected",
+        "ai_confidence_score": confidence,
+        "voice_response": voice_msg,
+        "submitted_data": final_data # final_data now contains the forced payout
+    }
+    if ai_response.get("usage"):
+        claim_document["usage"] = ai_response["usage"]  # Token / byte accounting (agent_engine.build_usage_record)
+
+    # FIX: Use update_one with upsert=True instead of insert_one
+    claims_col.update_one(
+        {"application_id": app_id},
+        {"$set": claim_document},
+        upsert=True
+    )
+    return app_id
+
+
+# --- 3. DOCUMENTS ---
+def prepare_document_data(full_report_data, final_data, db_user):
+    """Adds the logic trace, the farmer's DB profile and the payout to the report / form data (in place)."""
+    # --- FIX: INJECT LOGIC TRACE FOR REPORT ---
+    if "reasoning" not in full_report_data:
+        full_report_data["reasoning"] = "AI verification complete based on provided evidence."
+    full_report_data["logic_trace"] = full_report_data["reasoning"]
+
+    # --- INJECT DB USER DETAILS ---
+    final_data["mobile_number"] = db_user.get("mobile_number")
+    final_data["email"] = db_user.get("email")
+    final_data["bank_account_number"] = db_user.get("bank_account_number")
+    final_data["bank_name"] = db_user.get("bank_name")
+    full_report_data["filer_name"] = db_user.get("Applicant_full_name", "")  # For Report (report_gen)
+
+    # --- DATA SYNC: payout shown in the app, the form and the report must agree ---
+    est_block = full_report_data.get("claim_estimation", {})
+    final_data["estimated_payout"] = est_block.get("estimated_payout", "Under Assessment")
+
+
+class PostProcessingError(Exception):
+    """One or more post-AI stages failed; .errors = {stage: exception}. Raised once all stages have finished."""
+
+    def __init__(self, errors):
+        self.errors = errors
+        super().__init__("; ".join(f"{stage}: {type(e).__name__}: {e}" for stage, e in errors.items()))
+
+
+def _timed(fn, *args):
+    started = time.perf_counter()
+    value = fn(*args)
+    return value, time.perf_counter() - started
+
+
+def submit_post_stage(fn, *args):
+    """Runs fn(*args) on the shared post-processing pool; the future yields (value, seconds)."""
+    # copy_context(): the stage's span belongs to this claim's trace (tracing.py)
+    return _post_pool.submit(contextvars.copy_context().run, _timed, fn, *args)
+
+
+def start_pdfs(full_report_data, final_data, image_path):
+    """Starts both PDFs in parallel, in memory; returns {"report": future, "form": future} (PDF bytes)."""
+    return {
+        "report": submit_post_stage(generate_best_report, full_report_data, image_path, None),
+        "form": submit_post_stage(generate_filled_pdf, {"form_fields": final_data}, None, None),  # Layout by claim year
+    }
+
+
+def collect_post_stages(jobs, expect_value=("report", "form")):
+    """
+    Waits for EVERY job in {stage: future} (none is left running behind an early failure).
+    Returns ({stage: value}, {stage: seconds}); raises PostProcessingError listing all failures.
+    A stage in expect_value that returns None (the PDF generators' failure signal) counts as failed.
+    """
+    values, seconds, errors = {}, {}, {}
+    with span("post.wait"):
+        for stage, future in jobs.items():
+            try:
+                values[stage], seconds[stage] = future.result()
+                if values[stage] is None and stage in expect_value:
+                    errors[stage] = RuntimeError("no file written")
+            except Exception as e:
+                errors[stage] = e
+    if errors:
+        raise PostProcessingError(errors)
+    return values, seconds
+
+
+def save_pdf(data, path):
+    """Writes rendered PDF bytes (for storage / another process); returns the path."""
+    with open(path, "wb") as f:
+        f.write(data)
+    return path
+
+
+# --- 4. FULL SUBMISSION ---
+def run_claim(audio_file, land_file, crop_file, photo_path, mobile, profile, out_dir=".", application_id=None,
+              date_of_loss=None, on_update=None, spool=True):
+    """
+    Runs one claim end to end. Returns the agent result, plus report_pdf / form_pdf (bytes) on success.
+    out_dir: also save them there (report_path / form_path); None keeps them in memory only.
+    photo_path: the crop photo on disk (embedded in the report). on_update: see process_claim_async.
+    """
+    profile = profile or {}
+    pdf_jobs = {}
+    post_started = []
+
+    def relay(event, payload):
+        if event == "form_fields":
+            post_started.append(time.perf_counter())
+            # Start PDF layout now; the claim is saved to the DB in parallel
+            report_data, form_data = payload["full_report_data"], payload["form_fields"]
+            prepare_document_data(report_data, form_data, profile)
+            pdf_jobs.update(start_pdfs(report_data, form_data, photo_path))
+        _notify(on_update, event, payload)
+
+    ai_result = process_claim(convert_audio(audio_file), land_file, crop_file, mobile, on_update=relay,
+                              date_of_loss=date_of_loss, spool=spool, application_id=application_id)
+    if ai_result.get("status") != "success":
+        return ai_result
+
+    full_report_data = ai_result.get("full_report_data", {})
+    final_data = ai_result.get("data", {})
+    prepare_document_data(full_report_data, final_data, profile)
+
+    voice_val = full_report_data.get("voice_response") or ai_result.get("voice_response")
+    if not voice_val:
+        voice_val = "Your claim has been received and verified."
+    ai_result["voice_response"] = voice_val
+
+    app_id = final_data.get("application_id")
+
+    # Ledger write overlaps the PDFs (normally already started by the "form_fields" update)
+    if not pdf_jobs:
+        post_started.append(time.perf_counter())
+        pdf_jobs.update(start_pdfs(full_report_data, final_data, photo_path))
+    jobs = dict(pdf_jobs, ledger=submit_post_stage(log_claim_to_db, final_data, ai_result, mobile))
+    pdfs, seconds = collect_post_stages(jobs)
+
+    wall = time.perf_counter() - post_started[0]
+    ai_result["post_timing"] = {"stages": {k: round(v, 3) for k, v in seconds.items()}, "wall_seconds": round(wall, 3),
+                                "sequential_seconds": round(sum(seconds.values()), 3)}
+    print(f"⏱️ Post-processing: {wall:.2f}s wall for {sum(seconds.values()):.2f}s of work "
+          f"({', '.join(f'{k} {v:.2f}s' for k, v in seconds.items())})")
+
+    ai_result["report_pdf"], ai_result["form_pdf"] = pdfs["report"], pdfs["form"]
+    if out_dir is not None:
+        ai_result["report_path"] = save_pdf(pdfs["report"], os.path.join(out_dir, f"Report_{app_id}.pdf"))
+        ai_result["form_path"] = save_pdf(pdfs["form"], os.path.join(out_dir, f"Claim_{app_id}.pdf"))
+    return ai_result
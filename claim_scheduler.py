@@ -0,0 +1,38 @@
+# claim_scheduler.py
+# Claim deadlines for the earliest-deadline-first queue (job_queue.py).
+#
+# PMFBY gives a farmer RULES["time_limit_hours"] (72h) from the date of loss to intimate a claim.
+# After a disaster every CSC submits at once, so job_queue hands claims to the workers in order of
+# this deadline instead of "whichever Streamlit session clicked first". The Gemini quota itself is
+# enforced per model call by agent_engine.rate_limiter (MODEL_CALLS_PER_MINUTE).
+#
+#   claim_deadline("14/10/2026")   -> datetime by which the claim must be intimated
+
+from datetime import datetime, timedelta
+
+from config import RULES
+
+DATE_FORMATS = ("%d/%m/%Y", "%Y-%m-%d", "%d-%m-%Y")
+
+
+def parse_date_of_loss(value):
+    """dd/mm/YYYY (form format), ISO date, datetime/date -> datetime, or None if unknown."""
+    if value is None or value == "": return None
+    if isinstance(value, datetime): return value
+    if hasattr(value, "year"): return datetime(value.year, value.month, value.day)
+    for fmt in DATE_FORMATS:
+        try:
+            return datetime.strptime(str(value).strip(), fmt)
+        except ValueError:
+            continue
+    return None
+
+
+def claim_deadline(date_of_loss=None, submitted_at=None):
+    """
+    Intimation deadline = date of loss + time_limit_hours.
+    Unknown date of loss: assume the loss happened at submission (latest possible deadline).
+    """
+    loss = parse_date_of_loss(date_of_loss) or submitted_at or datetime.now()
+    return loss + timedelta(hours=RULES["time_limit_hours"])
+
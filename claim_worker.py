@@ -0,0 +1,170 @@
+# claim_worker.py
+# Processes submitted claims from job_queue.py, in processes separate from the Streamlit UI.
+#
+#   python claim_worker.py                    (4 worker processes)
+#   python claim_worker.py --processes 8
+#   python claim_worker.py --fake-backend     (load test: canned answers, no Gemini quota used)
+#
+# Start as many as the machine allows (even on several machines sharing JOB_DB_PATH / JOB_DIR);
+# they coordinate through the SQLite queue. MODEL_CALLS_PER_MINUTE is the quota for this command
+# as a whole, so it is split between its processes.
+
+import os
+import sys
+import glob
+import json
+import time
+import socket
+import argparse
+import threading
+import multiprocessing
+
+import agent_engine
+import claim_pipeline
+from agent_engine import UploadedBlob
+from job_queue import JobQueue
+from llm_backend import FakeBackend
+from resilience import TokenBucket, MODEL_CALLS_PER_MINUTE, MODEL_CALLS_BURST
+import tracing
+from tracing import claim_trace
+
+JOB_POLL_SECONDS = float(os.getenv("JOB_POLL_SECONDS", 1.0))
+HEARTBEAT_SECONDS = 10
+JOB_RETRY_DELAY_SECONDS = float(os.getenv("JOB_RETRY_DELAY_SECONDS", 30))
+PROGRESS_EVENTS = ("voice_response", "evidence", "verification")
+# What the UI needs from a finished claim (the full agent result stays in Mongo / traces)
+RESULT_FIELDS = ("status", "reason", "rejected_by", "voice_response", "report_path", "form_path", "trace_id", "post_timing")
+
+
+def load_uploads(job_dir):
+    """{role: UploadedBlob} from the folder written by resilience.write_claim_folder (original MIME types kept)."""
+    mime_path = os.path.join(job_dir, "mime_types.json")
+    mime_types = {}
+    if os.path.exists(mime_path):
+        with open(mime_path, "r", encoding="utf-8") as f:
+            mime_types = json.load(f)
+    uploads = {}
+    for role in ("audio", "land", "photo"):
+        matches = sorted(glob.glob(os.path.join(job_dir, f"{role}.*")))
+        if matches: uploads[role] = UploadedBlob.from_path(matches[0], mime_types.get(role))
+    return uploads
+
+
+def run_job(queue, job):
+    app_id, worker_id = job["application_id"], job["worker"]
+    uploads = load_uploads(job["job_dir"])
+    if len(uploads) < 3:
+        queue.fail(app_id, worker_id, f"Uploads missing in {job['job_dir']}")
+        return
+
+    # Early updates become the job's progress, which the UI polls
+    progress, progress_lock = {"stage": "analysing"}, threading.Lock()
+
+    def on_update(event, payload):
+        with progress_lock:
+            if event in PROGRESS_EVENTS: progress[event] = payload
+            elif event == "form_fields": progress["stage"] = "documents"
+            snapshot = dict(progress)
+        queue.heartbeat(app_id, worker_id, snapshot)
+
+    queue.heartbeat(app_id, worker_id, progress)
+    stop = threading.Event()
+
+    def keep_lease():
+        while not stop.wait(HEARTBEAT_SECONDS):
+            queue.heartbeat(app_id, worker_id)
+
+    threading.Thread(target=keep_lease, daemon=True).start()
+    with claim_trace(app_id, channel="worker") as trace:
+        try:
+            result = claim_pipeline.run_claim(
+                uploads["audio"], uploads["land"], uploads["photo"],
+                os.path.join(job["job_dir"], uploads["photo"].name), job["mobile"], job["profile"],
+                out_dir=job["job_dir"], application_id=app_id, date_of_loss=job["date_of_loss"],
+                on_update=on_update,
+                spool=False  # Already durable: a circuit-open claim just goes back to the queue
+            )
+        except Exception as e:
+            # e.g. Mongo briefly unreachable: try again later, up to JOB_MAX_ATTEMPTS
+            trace.bind(app_id, status="error")
+            print(f"⚠️ {app_id}: {type(e).__name__}: {e}")
+            queue.retry_later(app_id, worker_id, JOB_RETRY_DELAY_SECONDS * job["attempts"], f"{type(e).__name__}: {e}",
+                              count_attempt=True)
+            return
+        finally:
+            stop.set()
+        trace.bind(app_id, status=result.get("status"))
+
+    if result.get("status") != "success" and result.get("retry_after_seconds") is not None:
+        print(f"⏳ {app_id}: model service unavailable, back in the queue")
+        queue.retry_later(app_id, worker_id, max(result["retry_after_seconds"], JOB_POLL_SECONDS), result.get("reason"))
+        return
+    summary = {key: result.get(key) for key in RESULT_FIELDS}
+    summary["verification"] = result.get("full_report_data", {}).get("verification")
+    summary["estimated_payout"] = result.get("data", {}).get("estimated_payout")
+    if not queue.complete(app_id, worker_id, summary): return
+    print(f"{'✅' if summary['status'] == 'success' else '❌'} {app_id}: {summary['status']} {summary.get('reason') or ''}")
+
+
+def worker_loop(worker_id, queue=None, stop_event=None):
+    """Claims and runs jobs until stop_event is set (forever if None)."""
+    queue = queue or JobQueue()
+    print(f"👷 Worker {worker_id} polling {queue.db_path}")
+    while stop_event is None or not stop_event.is_set():
+        if agent_engine.breaker.is_open():  # Don't pull claims just to put them back
+            time.sleep(max(agent_engine.breaker.retry_after(), JOB_POLL_SECONDS))
+            continue
+        try:
+            job = queue.claim(worker_id)
+        except Exception as e:
+            print(f"⚠️ Worker {worker_id}: queue unavailable ({e})")
+            job = None
+        if job is None:
+            time.sleep(JOB_POLL_SECONDS)
+            continue
+        run_job(queue, job)
+
+
+def _process_main(worker_id, processes, fake_latency=None):
+    if fake_latency is not None:
+        agent_engine.set_backend(FakeBackend(median_latency_s=fake_latency))
+    agent_engine.rate_limiter = TokenBucket(MODEL_CALLS_PER_MINUTE / processes, max(1, MODEL_CALLS_BURST // processes))
+    try:
+        worker_loop(worker_id)
+    except KeyboardInterrupt:
+        pass
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Process queued Viksit Kisan claims (see job_queue.py).")
+    parser.add_argument("--processes", type=int, default=4, help="Worker processes (each runs one claim at a time)")
+    parser.add_argument("--fake-backend", action="store_true", help="Load test: replay canned answers instead of calling Gemini")
+    parser.add_argument("--fake-latency", type=float, default=1.0, help="Fake backend median latency (s)")
+    args = parser.parse_args(argv)
+
+    processes = max(1, args.processes)
+    fake_latency = args.fake_latency if args.fake_backend else None
+    prefix = f"{socket.gethostname()}-{os.getpid()}"
+    if tracing.METRICS_PORT:
+        # Only this process binds the port; with several workers it serves all their metrics files
+        tracing.start_metrics_server(tracing.METRICS_PORT,
+                                     tracing.render_metrics if processes == 1 else tracing.render_fleet_metrics)
+    if processes == 1:
+        _process_main(f"{prefix}-0", 1, fake_latency)
+        return 0
+
+    # spawn: each worker opens its own Mongo client (pymongo clients must not cross a fork)
+    ctx = multiprocessing.get_context("spawn")
+    workers = [ctx.Process(target=_process_main, args=(f"{prefix}-{i}", processes, fake_latency), name=f"claim-worker-{i}")
+               for i in range(processes)]
+    for p in workers: p.start()
+    try:
+        for p in workers: p.join()
+    except KeyboardInterrupt:
+        print("🛑 Stopping workers...")
+        for p in workers: p.join(timeout=30)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,172 @@
+# evidence_gate.py
+# Cheap local checks that run BEFORE any Gemini call.
+# Catches the uploads the model would reject anyway (pitch-black photo, empty recording,
+# wrong file as 7/12) in milliseconds, and tells the farmer exactly what to fix.
+# Thresholds are deliberately loose: a muddy / waterlogged field must still pass
+# ("benefit of the doubt"); only clearly unusable inputs are stopped here.
+
+import io
+import os
+import time
+import wave
+import threading
+from collections import Counter
+
+import numpy as np
+from PIL import Image
+
+# --- THRESHOLDS (override via .env) ---
+PHOTO_MIN_SIDE = int(os.getenv("GATE_PHOTO_MIN_SIDE", 200))          # px
+PHOTO_MIN_BRIGHTNESS = float(os.getenv("GATE_PHOTO_MIN_BRIGHTNESS", 18))   # mean grey level 0-255
+PHOTO_MAX_BRIGHTNESS = float(os.getenv("GATE_PHOTO_MAX_BRIGHTNESS", 248))
+PHOTO_MIN_ENTROPY = float(os.getenv("GATE_PHOTO_MIN_ENTROPY", 2.5))       # bits (8 = max detail)
+PHOTO_MIN_SHARPNESS = float(os.getenv("GATE_PHOTO_MIN_SHARPNESS", 8))     # Laplacian variance at 256 px
+AUDIO_MIN_SECONDS = float(os.getenv("GATE_AUDIO_MIN_SECONDS", 1.5))
+AUDIO_MIN_RMS = float(os.getenv("GATE_AUDIO_MIN_RMS", 80))              # int16 units (~ -52 dBFS)
+AUDIO_MIN_BYTES = int(os.getenv("GATE_AUDIO_MIN_BYTES", 2048))          # for compressed formats we cannot decode
+DOCUMENT_MIN_BYTES = int(os.getenv("GATE_DOCUMENT_MIN_BYTES", 1024))
+MAX_UPLOAD_BYTES = int(os.getenv("GATE_MAX_UPLOAD_BYTES", 20 * 1024 * 1024))  # Gemini inline request limit (per stage call)
+
+STAGE_UPLOADS = {"document": "7/12 extract", "voice": "Voice recording", "visual": "Crop photo"}
+DOCUMENT_MIMES = {"application/pdf": (b"%PDF-",), "image/jpeg": (b"\xff\xd8\xff",), "image/png": (b"\x89PNG",)}
+
+ANALYSIS_SIDE = 256
+
+_stats_lock = threading.Lock()
+_stats = {"checked": 0, "rejected": 0, "gate_seconds": 0.0, "model_seconds_saved": 0.0}
+_reasons = Counter()
+_model_latency = {"ewma": None}
+
+
+def note_model_latency(seconds):
+    """agent_engine reports how long the model phase of a claim took; used to estimate time saved."""
+    with _stats_lock:
+        prev = _model_latency["ewma"]
+        _model_latency["ewma"] = seconds if prev is None else 0.8 * prev + 0.2 * seconds
+
+
+def get_gate_stats():
+    with _stats_lock:
+        s = dict(_stats)
+        s["reasons"] = dict(_reasons.most_common())
+    s["rejection_rate"] = round(s["rejected"] / s["checked"], 3) if s["checked"] else 0.0
+    s["gate_seconds"] = round(s["gate_seconds"], 3)
+    s["model_seconds_saved"] = round(s["model_seconds_saved"], 2)
+    return s
+
+
+# --- 1. CROP PHOTO ---
+def check_photo(data):
+    """Returns (check_name, message) for an unusable photo, else None."""
+    try:
+        img = Image.open(io.BytesIO(data))
+        size = img.size
+        img.draft("L", (ANALYSIS_SIDE * 2, ANALYSIS_SIDE * 2))  # JPEG: decode at reduced scale (fast)
+        grey = img.convert("L")
+        grey.thumbnail((ANALYSIS_SIDE, ANALYSIS_SIDE))
+    except Exception:
+        return "photo_unreadable", "Crop photo could not be opened. Please upload a JPG or PNG photo."
+
+    if min(size) < PHOTO_MIN_SIDE:
+        return "photo_too_small", f"Crop photo is too small ({size[0]}x{size[1]}). Please upload the original camera photo."
+
+    pixels = np.asarray(grey, dtype=np.float32)
+    brightness = float(pixels.mean())
+    if brightness < PHOTO_MIN_BRIGHTNESS:
+        return "photo_too_dark", "Crop photo is too dark to see the field. Please retake it in daylight."
+    if brightness > PHOTO_MAX_BRIGHTNESS:
+        return "photo_overexposed", "Crop photo is washed out (almost completely white). Please retake it."
+
+    hist = np.bincount(pixels.astype(np.uint8).ravel(), minlength=256).astype(np.float64)
+    p = hist[hist > 0] / hist.sum()
+    entropy = float(-(p * np.log2(p)).sum())
+    if entropy < PHOTO_MIN_ENTROPY:
+        return "photo_blank", "Crop photo looks blank (no visible detail). Please photograph the damaged crop."
+
+    # Variance of a 4-neighbour Laplacian: low = out of focus / motion blur
+    lap = (pixels[1:-1, :-2] + pixels[1:-1, 2:] + pixels[:-2, 1:-1] + pixels[2:, 1:-1] - 4 * pixels[1:-1, 1:-1])
+    if lap.size and float(lap.var()) < PHOTO_MIN_SHARPNESS:
+        return "photo_blurry", "Crop photo is too blurry. Please hold the phone steady and retake it."
+    return None
+
+
+# --- 2. VOICE RECORDING ---
+def check_audio(data, mime_type):
+    if len(data) < AUDIO_MIN_BYTES:
+        return "audio_too_short", "Voice recording is empty or too short. Please record your claim again."
+    if data[:4] != b"RIFF" or data[8:12] != b"WAVE":
+        return None  # Compressed formats: size check only (decoding needs ffmpeg)
+
+    try:
+        with wave.open(io.BytesIO(data), "rb") as wav:
+            rate, width, channels, frames = wav.getframerate(), wav.getsampwidth(), wav.getnchannels(), wav.getnframes()
+            raw = wav.readframes(frames)
+    except Exception:
+        return None  # Unusual WAV flavour: let the model try
+
+    duration = frames / float(rate or 1)
+    if duration < AUDIO_MIN_SECONDS:
+        return "audio_too_short", f"Voice recording is only {duration:.1f}s. Please say your name, crop and cause of loss."
+    if width == 2 and raw:
+        samples = np.frombuffer(raw[: len(raw) - len(raw) % 2], dtype="<i2").astype(np.float32)
+        rms = float(np.sqrt(np.mean(samples ** 2))) if samples.size else 0.0
+        if rms < AUDIO_MIN_RMS:
+            return "audio_silent", "Voice recording is silent. Please check the microphone and record again."
+    return None
+
+
+# --- 3. 7/12 DOCUMENT ---
+def check_document(data, mime_type):
+    magics = DOCUMENT_MIMES.get(mime_type)
+    if magics is None:
+        return "document_type", f"7/12 extract must be a PDF, JPG or PNG (got {mime_type})."
+    if len(data) < DOCUMENT_MIN_BYTES:
+        return "document_empty", "7/12 extract file is empty or damaged. Please upload it again."
+    if not data.startswith(magics):
+        return "document_corrupt", "7/12 extract file does not match its type (damaged or renamed file). Please upload it again."
+    return None
+
+
+def check_claim_inputs(audio_bytes, audio_mime, land_bytes, land_mime, crop_bytes, crop_mime):
+    """
+    Runs every local check. Returns None if the claim may go to the model,
+    else {"check": name, "reason": farmer-facing message}.
+    """
+    started = time.perf_counter()
+    # Sizes are checked per stage once pre-processing has shrunk the uploads (check_payload)
+    problem = check_document(land_bytes, land_mime) or check_photo(crop_bytes) or check_audio(audio_bytes, audio_mime)
+
+    with _stats_lock:
+        _stats["checked"] += 1
+        _stats["gate_seconds"] += time.perf_counter() - started
+        if problem:
+            _stats["rejected"] += 1
+            _reasons[problem[0]] += 1
+            _stats["model_seconds_saved"] += _model_latency["ewma"] or 0.0
+    if problem:
+        return {"check": problem[0], "reason": problem[1]}
+    return None
+
+
+# --- 4. PREPARED PAYLOAD (per model call) ---
+class PayloadTooLargeError(ValueError):
+    """A stage's upload is still over the inline request limit after pre-processing."""
+
+    def __init__(self, stage, size):
+        self.check = "upload_too_large"
+        self.reason = (f"{STAGE_UPLOADS.get(stage, stage)} is {size / 1e6:.1f} MB even after compression; "
+                       f"the limit is {MAX_UPLOAD_BYTES / 1e6:.0f} MB. Please upload a smaller file.")
+        super().__init__(self.reason)
+
+
+def check_payload(stage, data):
+    """Each stage is its own model request: raises PayloadTooLargeError if its prepared bytes exceed the limit."""
+    if len(data) > MAX_UPLOAD_BYTES:
+        raise PayloadTooLargeError(stage, len(data))
+
+
+def note_rejection(check):
+    """Counts a claim turned away after check_claim_inputs passed (once per claim, whichever stage raised)."""
+    with _stats_lock:
+        _stats["rejected"] += 1
+        _reasons[check] += 1
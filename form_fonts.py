@@ -0,0 +1,296 @@
+# form_fonts.py
+# Pre-subsetted Marathi font for the claim forms: built once, embedded without per-form subsetting.
+#
+# fpdf subsets and re-saves the whole TTF for every document it writes (about half of a form's render
+# time) and every bulk page carried its own copy. Instead:
+#
+#   python form_fonts.py                          -> assets/MarathiFont.forms.ttf
+#   python form_fonts.py batch_output/results.jsonl   (also cover the names / villages in past claims)
+#
+# builds a subset with the glyphs our forms actually use (layout text, Devanagari letters with every
+# matra, two-letter conjuncts, ASCII), keeping the original glyph ids. A layout font opts in with
+# "subset": "assets/MarathiFont.forms.ttf". FormRenderer then writes glyph ids as character codes
+# (GlyphIdMap), so one font object fits any form: render() attaches the subset (compressed once per
+# process), bulk_forms writes a single shared copy per file. A form with a glyph outside the subset
+# falls back to fpdf's usual embedding of the full font.
+
+import io
+import os
+import re
+import sys
+import zlib
+import argparse
+import threading
+
+from fontTools.ttLib import TTFont
+from fontTools import subset as ftsubset
+from fpdf import FPDF
+from fpdf.fonts import SubsetMap
+from pypdf.generic import (ArrayObject, DictionaryObject, NameObject, NumberObject, FloatObject,
+                           TextStringObject, StreamObject, DecodedStreamObject)
+
+# --- SETTINGS (override via .env) ---
+PRESUBSET_FONTS = os.getenv("FORM_PRESUBSET_FONTS", "1") == "1"  # 0: always let fpdf subset the full font
+SUBSET_TAG = "VKFORM"  # PDF subset prefix: /BaseFont /VKFORM+NotoSansDevanagari-Regular
+
+# Devanagari the forms can print, beyond what the layouts spell out
+CONSONANTS = [chr(c) for c in range(0x0915, 0x093A)] + [chr(c) for c in range(0x0958, 0x0960)]
+MATRAS = [chr(c) for c in range(0x093E, 0x094D)] + ["ॢ", "ॣ"]
+SIGNS = ["ँ", "ं", "ः"]
+VIRAMA, ZWJ, RA = "्", "‍", "र"
+EXTRA_TEXT = "".join(chr(c) for c in range(0x20, 0x7F)) + "₹–।॥ॐऽॲ०१२३४५६७८९" + \
+    "".join(chr(c) for c in range(0x0904, 0x0915))
+
+_stats = {"presubset": 0, "fallback": 0}
+_stats_lock = threading.Lock()
+
+
+# --- 1. BUILD THE SUBSET ---
+def form_texts(plans):
+    """Every string the layouts print themselves (constants and format text, placeholders removed)."""
+    texts = []
+    for plan in plans:
+        for entry in plan.spec.get("fields", []):
+            if "text" in entry: texts.append(str(entry["text"]))
+            if "format" in entry: texts.append(re.sub(r"\{[^}]*\}", " ", entry["format"]))
+    return texts
+
+
+def alphabet_texts():
+    """
+    Each consonant alone, with every matra / sign, as a half form, with rakar / reph / ya, and every
+    two-consonant conjunct (bare and with the i-matra, whose glyph depends on the width of its base).
+    """
+    texts = [EXTRA_TEXT]
+    for c in CONSONANTS:
+        texts += [c, c + VIRAMA, c + VIRAMA + ZWJ, c + VIRAMA + RA, RA + VIRAMA + c, c + VIRAMA + "य",
+                  RA + VIRAMA + ZWJ + c]
+        texts += [c + m for m in MATRAS + SIGNS] + [c + "ि" + sign for sign in SIGNS]
+        texts += [c + VIRAMA + d + tail for d in CONSONANTS[:36] for tail in ("", "ि", "िं")]
+    return texts
+
+
+def shaped_glyph_ids(font_path, texts):
+    """Glyph ids HarfBuzz picks for the texts (what fpdf will ask the font for)."""
+    import uharfbuzz as hb
+    with open(font_path, "rb") as f:
+        font = hb.Font(hb.Face(f.read()))
+    gids = set()
+    for text in texts:
+        for word in text.split():
+            buf = hb.Buffer()
+            buf.add_str(word)
+            buf.guess_segment_properties()
+            hb.shape(font, buf, {})
+            gids.update(info.codepoint for info in buf.glyph_infos)
+    return gids
+
+
+def build_subset(font_path, out_path, texts):
+    """Writes the subset (original glyph ids kept, layout tables dropped); returns (glyphs kept, bytes)."""
+    ttfont = TTFont(font_path, recalcTimestamp=False)  # Same input, same bytes
+    gids = shaped_glyph_ids(font_path, texts)
+    options = ftsubset.Options(retain_gids=True, notdef_outline=True, recommended_glyphs=True)
+    options.layout_features = []
+    options.drop_tables += ["GSUB", "GPOS", "GDEF", "STAT", "FFTM", "hdmx", "meta"]
+    subsetter = ftsubset.Subsetter(options)
+    subsetter.populate(gids=sorted(gids))
+    subsetter.subset(ttfont)
+    ttfont.save(out_path)
+    return len(gids), os.path.getsize(out_path)
+
+
+# --- 2. GLYPH IDS AS CHARACTER CODES ---
+class GlyphIdMap(SubsetMap):
+    """fpdf SubsetMap whose character codes are the font's own glyph ids: same code, same glyph, in every form."""
+
+    def __init__(self, font):
+        super().__init__(font)
+        self._char_id_per_glyph = {glyph: glyph.glyph_id for glyph in self._char_id_per_glyph if glyph is not None}
+
+    def pick_glyph(self, glyph):
+        if glyph is None: return None
+        return self._char_id_per_glyph.setdefault(glyph, glyph.glyph_id)
+
+
+# --- 3. EMBEDDING ---
+def _utf16_hex(codepoints):
+    return "".join(chr(c).encode("utf-16-be").hex().upper() for c in codepoints)
+
+
+def _to_unicode(glyphs):
+    """ToUnicode CMap (copy / search text) for {glyph id: (codepoints, width)}."""
+    entries = [f"<{gid:04X}> <{_utf16_hex(text)}>" for gid, (text, _) in sorted(glyphs.items()) if text]
+    blocks = "".join(f"{len(entries[i:i + 100])} beginbfchar\n" + "\n".join(entries[i:i + 100]) + "\nendbfchar\n"
+                     for i in range(0, len(entries), 100))
+    return ("/CIDInit /ProcSet findresource begin\n12 dict begin\nbegincmap\n"
+            "/CIDSystemInfo\n<</Registry (Adobe)\n/Ordering (UCS)\n/Supplement 0\n>> def\n"
+            "/CMapName /Adobe-Identity-UCS def\n/CMapType 2 def\n1 begincodespacerange\n<0000> <FFFF>\n"
+            f"endcodespacerange\n{blocks}endcmap\nCMapName currentdict /CMap defineresource pop\nend\nend").encode("latin-1")
+
+
+def _name_text(glyph_name):
+    """'uni093F0902.08' -> (0x093F, 0x0902); () for names that do not spell their characters."""
+    base = glyph_name.split(".")[0]
+    if base.startswith("uni") and len(base) > 3 and (len(base) - 3) % 4 == 0:
+        try:
+            return tuple(int(base[i:i + 4], 16) for i in range(3, len(base), 4))
+        except ValueError:
+            return ()
+    return ()
+
+
+def _widths(glyphs):
+    """CIDFont /W array: runs of consecutive glyph ids -> [first [w1 w2 ...] ...]."""
+    widths, run, last = ArrayObject(), None, None
+    for gid in sorted(glyphs):
+        width = NumberObject(glyphs[gid][1])
+        if run is not None and gid == last + 1:
+            run.append(width)
+        else:
+            run = ArrayObject([width])
+            widths += [NumberObject(gid), run]
+        last = gid
+    return widths
+
+
+class PresubsetFont:
+    """
+    A built subset ready to embed: the glyph ids it covers, its descriptor, and its FontFile2 (compressed
+    once). source_path: the full font, whose blank glyphs (zero-width marks, spaces) count as covered and
+    whose glyph names ("uni0920094D0920" = ठ्ठ) give ligatures and matra variants their text.
+    """
+
+    def __init__(self, path, source_path=None):
+        self.path = path
+        with open(path, "rb") as f:
+            data = f.read()
+        ttfont = TTFont(io.BytesIO(data))
+        glyf = ttfont["glyf"]
+        cmap = {ttfont.getGlyphID(name): (cp,) for cp, name in sorted(ttfont.getBestCmap().items(), reverse=True)}
+        self.glyph_ids = {0} | set(cmap)
+        self.glyph_ids |= {gid for gid, name in enumerate(ttfont.getGlyphOrder()) if glyf[name].numberOfContours != 0}
+        self.text = {}  # glyph id -> codepoints (ToUnicode)
+        if source_path:
+            source = TTFont(source_path, lazy=True)
+            for gid, name in enumerate(source.getGlyphOrder()):
+                if source["glyf"][name].numberOfContours == 0: self.glyph_ids.add(gid)
+                if gid in self.glyph_ids and _name_text(name): self.text[gid] = _name_text(name)
+        self.text.update(cmap)  # A glyph's own character beats its name
+
+        parsed = FPDF()
+        parsed.add_font("presubset", style="", fname=path)
+        font = parsed.fonts["presubset"]
+        self.base_font = NameObject(f"/{SUBSET_TAG}+{font.name}")
+        self.desc = font.desc
+        self.font_file = zlib.compress(data)
+        self.length1 = len(data)
+
+    def covers(self, subset):
+        """True if every glyph a document picked (GlyphIdMap) is in this subset."""
+        return all(glyph.glyph_id in self.glyph_ids for glyph, _ in subset.items() if glyph is not None)
+
+    def glyphs(self, subset):
+        """
+        {glyph id: (codepoints, width)} a document used, for ToUnicode / W. One code per glyph, so a glyph
+        gets its own character(s) if known, else the first non-empty cluster text fpdf gave it.
+        """
+        glyphs = {}
+        for glyph, _ in subset.items():
+            if glyph is None: continue
+            text = self.text.get(glyph.glyph_id) or (tuple(glyph.unicode) if isinstance(glyph.unicode, tuple) else ())
+            merge_glyphs(glyphs, {glyph.glyph_id: (text, glyph.glyph_width)})
+        return glyphs
+
+    def font_dict(self, add, glyphs):
+        """
+        The Type0 font for `glyphs` (pypdf objects). add(obj) -> indirect reference writes its parts
+        (PdfWriter._add_object, StreamingPdfWriter._add); the caller adds the returned dict itself.
+        """
+        font_file = StreamObject()
+        font_file._data = self.font_file  # Already Flate-compressed
+        font_file.update({NameObject("/Filter"): NameObject("/FlateDecode"),
+                          NameObject("/Length1"): NumberObject(self.length1)})
+        descriptor = DictionaryObject({
+            NameObject("/Type"): NameObject("/FontDescriptor"), NameObject("/FontName"): self.base_font,
+            NameObject("/Ascent"): NumberObject(self.desc.ascent), NameObject("/Descent"): NumberObject(self.desc.descent),
+            NameObject("/CapHeight"): NumberObject(self.desc.cap_height), NameObject("/Flags"): NumberObject(self.desc.flags.value),
+            NameObject("/FontBBox"): ArrayObject(NumberObject(int(v)) for v in self.desc.font_b_box.strip("[]").split()),
+            NameObject("/ItalicAngle"): FloatObject(self.desc.italic_angle), NameObject("/StemV"): NumberObject(self.desc.stem_v),
+            NameObject("/MissingWidth"): NumberObject(self.desc.missing_width), NameObject("/FontFile2"): add(font_file),
+        })
+        cid_font = DictionaryObject({
+            NameObject("/Type"): NameObject("/Font"), NameObject("/Subtype"): NameObject("/CIDFontType2"),
+            NameObject("/BaseFont"): self.base_font, NameObject("/FontDescriptor"): add(descriptor),
+            NameObject("/CIDSystemInfo"): DictionaryObject({NameObject("/Registry"): TextStringObject("Adobe"),
+                                                            NameObject("/Ordering"): TextStringObject("Identity"),
+                                                            NameObject("/Supplement"): NumberObject(0)}),
+            NameObject("/DW"): NumberObject(self.desc.missing_width), NameObject("/W"): _widths(glyphs),
+            NameObject("/CIDToGIDMap"): NameObject("/Identity"),  # Codes are glyph ids (GlyphIdMap)
+        })
+        to_unicode = DecodedStreamObject()
+        to_unicode.set_data(_to_unicode(glyphs))
+        return DictionaryObject({
+            NameObject("/Type"): NameObject("/Font"), NameObject("/Subtype"): NameObject("/Type0"),
+            NameObject("/BaseFont"): self.base_font, NameObject("/Encoding"): NameObject("/Identity-H"),
+            NameObject("/DescendantFonts"): ArrayObject([add(cid_font)]),
+            NameObject("/ToUnicode"): add(to_unicode.flate_encode()),
+        })
+
+
+def merge_glyphs(into, glyphs):
+    """Adds a document's glyphs to a running set (bulk_forms: one per file); keeps non-empty text."""
+    for gid, (text, width) in glyphs.items():
+        if gid not in into or (text and not into[gid][0]):
+            into[gid] = (text, width)
+    return into
+
+
+_presubsets = {}
+_presubsets_lock = threading.Lock()
+
+
+def load_presubset(path, source_path=None):
+    """Process-wide PresubsetFont per file; None (with a warning) if it is missing or unreadable."""
+    with _presubsets_lock:
+        if path not in _presubsets:
+            try:
+                _presubsets[path] = PresubsetFont(path, source_path)
+            except Exception as e:
+                print(f"⚠️ Font subset unusable ({path}: {e}); embedding the full font")
+                _presubsets[path] = None
+        return _presubsets[path]
+
+
+def record(presubset):
+    with _stats_lock:
+        _stats["presubset" if presubset else "fallback"] += 1
+
+
+def get_font_stats():
+    """Forms embedded from the pre-built subset vs forms that needed the full font."""
+    with _stats_lock:
+        return dict(_stats)
+
+
+def main(argv=None):
+    import form_layouts
+    parser = argparse.ArgumentParser(description="Build the pre-subsetted Marathi font the claim forms embed.")
+    parser.add_argument("results", nargs="*", help="batch_claims results.jsonl files whose values should be covered")
+    parser.add_argument("--font", default="assets/MarathiFont.ttf")
+    parser.add_argument("--out", default="assets/MarathiFont.forms.ttf")
+    args = parser.parse_args(argv)
+
+    texts = form_texts(form_layouts.list_layouts()) + alphabet_texts()
+    if args.results:
+        from bulk_forms import iter_results_file
+        for path in args.results:
+            for fields in iter_results_file(path):
+                texts += [str(value) for value in fields.values() if isinstance(value, (str, int, float))]
+    glyphs, size = build_subset(args.font, args.out, texts)
+    print(f"🔠 {args.out}: {glyphs} glyphs, {size / 1024:.0f} KB (full font {os.path.getsize(args.font) / 1024:.0f} KB)")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
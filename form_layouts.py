@@ -0,0 +1,190 @@
+# form_layouts.py
+# Claim form layouts as data instead of code.
+#
+# Each assets/layouts/*.json describes one printed form: its template PDF, fonts, and where every
+# value goes. compile_layout() turns it into a RenderPlan once; pdf_generator.FormRenderer then
+# just walks the plan for every claim (no per-field branching on the hot path).
+#
+#   {"id": "pmfby-maharashtra-2019", "scheme": "PMFBY", "state": "Maharashtra", "year": 2019,
+#    "template": "assets/template.pdf",
+#    "fonts":  {"main": {"family": "Marathi", "file": "assets/MarathiFont.ttf", "size": 8,
+#                        "subset": "assets/MarathiFont.forms.ttf"},        <- optional, see form_fonts.py
+#               "latin": {"family": "Helvetica", "size": 6.5}},
+#    "fields": [{"x": 250, "y": 146, "field": "farmer_full_name"},                 <- form_fields value
+#               {"x": 210, "y": 165, "format": "मु. पो. {address_village}, ..."},  <- several values
+#               {"x": 220, "y": 297, "text": "NA"},                                 <- constant
+#               {"x": 158, "y": 539, "now": "%d/%m/%Y | %I:%M %p"},                 <- IST timestamp
+#               {"x": 426, "y": 181, "field": "email", "font": "latin"}],           <- font (default "main")
+#    "boxes":  [{"field": "mobile_number", "x": 213, "y": 181, "gap": 14, "count": 10}],  <- one char per box
+#    "checkboxes": [{"field": "cause_of_loss", "mark": "tick",
+#                    "options": [{"match": ["flood", "पाणी"], "x": 335, "y": 470}, ...]}]}  <- first match ticked
+#
+# A revised PMFBY form or another state's form is a new JSON file; get_layout(scheme, state, year)
+# picks the newest layout in force for the claim's year.
+
+import os
+import glob
+import json
+import threading
+from datetime import datetime
+
+import pytz
+
+from scale_of_finance import MARATHI_DIGITS
+
+# --- SETTINGS (override via .env) ---
+LAYOUT_DIR = os.getenv("FORM_LAYOUT_DIR", "assets/layouts")
+DEFAULT_SCHEME = "PMFBY"
+DEFAULT_STATE = os.getenv("FORM_STATE", "Maharashtra")
+MARKS = ("tick",)
+IST = pytz.timezone('Asia/Kolkata')
+
+
+class _Blank(dict):
+    """format_map() source: a missing or empty form field prints as nothing."""
+
+    def __missing__(self, key):
+        return ""
+
+
+# --- 1. COMPILE ---
+class RenderPlan:
+    """
+    A compiled layout. text_groups: [(font_key, [(x, y, value_fn), ...])] grouped by font, so the
+    renderer switches fonts once per group; value_fn(fields) -> str. checkboxes: [(field, mark, options)]
+    with options [(lowercase needles, x, y)].
+    """
+
+    def __init__(self, spec, fonts, text_groups, checkboxes):
+        self.spec = spec
+        self.id = spec["id"]
+        self.scheme, self.state, self.year = spec["scheme"], spec["state"], int(spec["year"])
+        self.template = spec["template"]
+        self.fonts = fonts  # font_key -> {"family", "size", "file" (optional)}
+        self.text_groups = text_groups
+        self.checkboxes = checkboxes
+
+    def __repr__(self):
+        ops = sum(len(ops) for _, ops in self.text_groups)
+        return f"RenderPlan({self.id}: {ops} text ops, {len(self.checkboxes)} checkbox groups)"
+
+
+def _value_fn(entry):
+    if "field" in entry:
+        key = entry["field"]
+        return lambda fields: fields.get(key) or ""
+    if "format" in entry:
+        template = entry["format"]
+        return lambda fields: template.format_map(_Blank((k, v) for k, v in fields.items() if v))
+    if "text" in entry:
+        text = str(entry["text"])
+        return lambda fields: text
+    if "now" in entry:
+        fmt = entry["now"]
+        return lambda fields: datetime.now(IST).strftime(fmt)
+    raise ValueError(f"Layout field needs one of field / format / text / now: {entry}")
+
+
+def _box_fn(key, index):
+    return lambda fields: str(fields.get(key) or "")[index:index + 1]
+
+
+def compile_layout(spec):
+    """Validates a layout dict and compiles it into a RenderPlan."""
+    for key in ("id", "scheme", "state", "year", "template", "fonts"):
+        if key not in spec:
+            raise ValueError(f"Layout {spec.get('id', '?')}: missing '{key}'")
+    fonts = {name: dict(font) for name, font in spec["fonts"].items()}
+    if "main" not in fonts:
+        raise ValueError(f"Layout {spec['id']}: fonts needs a 'main' entry")
+
+    ops = []  # (font_key, x, y, value_fn)
+    for entry in spec.get("fields", []):
+        ops.append((entry.get("font", "main"), entry["x"], entry["y"], _value_fn(entry)))
+    for box in spec.get("boxes", []):
+        # Digit boxes become one op per box, each reading its own character
+        for i in range(box["count"]):
+            ops.append((box.get("font", "main"), box["x"] + i * box["gap"], box["y"], _box_fn(box["field"], i)))
+
+    text_groups = []
+    for font_key in fonts:
+        group = [(x, y, fn) for key, x, y, fn in ops if key == font_key]
+        if group: text_groups.append((font_key, group))
+    unknown = {key for key, _, _, _ in ops} - set(fonts)
+    if unknown:
+        raise ValueError(f"Layout {spec['id']}: unknown font(s) {sorted(unknown)}")
+
+    checkboxes = []
+    for group in spec.get("checkboxes", []):
+        mark = group.get("mark", "tick")
+        if mark not in MARKS:
+            raise ValueError(f"Layout {spec['id']}: unknown mark '{mark}'")
+        options = [(tuple(m.lower() for m in opt["match"]), opt["x"], opt["y"]) for opt in group["options"]]
+        checkboxes.append((group["field"], mark, options))
+    return RenderPlan(spec, fonts, text_groups, checkboxes)
+
+
+def load_layout(path):
+    with open(path, "r", encoding="utf-8") as f:
+        return compile_layout(json.load(f))
+
+
+# --- 2. REGISTRY (scheme / state / year) ---
+_layouts = {}  # (scheme, state) -> [RenderPlan] sorted by year
+_layouts_lock = threading.Lock()
+_loaded = False
+
+
+def register_layout(plan):
+    """Adds a compiled layout (replacing one with the same id)."""
+    with _layouts_lock:
+        plans = [p for p in _layouts.get((plan.scheme.upper(), plan.state.lower()), []) if p.id != plan.id]
+        plans.append(plan)
+        _layouts[(plan.scheme.upper(), plan.state.lower())] = sorted(plans, key=lambda p: p.year)
+    return plan
+
+
+def _load_all():
+    global _loaded
+    if _loaded: return
+    for path in sorted(glob.glob(os.path.join(LAYOUT_DIR, "*.json"))):
+        try:
+            register_layout(load_layout(path))
+        except Exception as e:
+            print(f"⚠️ Form layout skipped ({path}): {e}")
+    _loaded = True
+
+
+def list_layouts():
+    _load_all()
+    with _layouts_lock:
+        return [p for plans in _layouts.values() for p in plans]
+
+
+def get_layout(scheme=DEFAULT_SCHEME, state=DEFAULT_STATE, year=None):
+    """Newest layout in force in `year` (None: newest). Older claims than any layout get the oldest one."""
+    _load_all()
+    with _layouts_lock:
+        plans = _layouts.get((scheme.upper(), state.lower()))
+    if not plans:
+        raise LookupError(f"No form layout for {scheme} / {state} in {LAYOUT_DIR}")
+    if year is None: return plans[-1]
+    in_force = [p for p in plans if p.year <= int(year)]
+    return in_force[-1] if in_force else plans[0]
+
+
+def find_layout(layout_id):
+    """Registered layout by id (e.g. from another process); None if unknown."""
+    return next((p for p in list_layouts() if p.id == layout_id), None)
+
+
+def claim_year(fields):
+    """'२०१९-२०' / '2025-26' / '2025' -> 2019 / 2025 / 2025 (the year the season started); None if unknown."""
+    value = str(fields.get("financial_year") or "").translate(MARATHI_DIGITS).strip()
+    head = value.split("-")[0].strip()
+    return int(head) if head.isdigit() and len(head) == 4 else None
+
+
+def layout_for_claim(fields, scheme=DEFAULT_SCHEME, state=DEFAULT_STATE):
+    """Layout for a claim's form_fields (by its financial year)."""
+    return get_layout(scheme, state, claim_year(fields))
@@ -0,0 +1,110 @@
+# image_prep.py
+# Shrinks evidence photos and image-based 7/12 scans before they are uploaded to Gemini.
+# Phone cameras produce 8-12 MP JPEGs (3-6 MB); the model does not need that many pixels,
+# and rural uplinks pay for every byte. EXIF is read first (capture time / GPS) and then
+# dropped from the upload.
+
+import os
+import io
+from PIL import Image, ImageOps
+
+# --- SETTINGS (override via .env) ---
+# Evidence photo: scene recognition only, so it can be small
+PHOTO_MAX_SIDE = int(os.getenv("PHOTO_MAX_SIDE", 1600))
+PHOTO_JPEG_QUALITY = int(os.getenv("PHOTO_JPEG_QUALITY", 80))
+# 7/12 scans: Devanagari matras and digits must stay legible, so keep more pixels
+DOCUMENT_MAX_SIDE = int(os.getenv("DOCUMENT_MAX_SIDE", 2200))
+DOCUMENT_JPEG_QUALITY = int(os.getenv("DOCUMENT_JPEG_QUALITY", 88))
+
+EXIF_IFD = 0x8769
+GPS_IFD = 0x8825
+EXIF_TAGS = {271: "make", 272: "model", 306: "datetime"}
+EXIF_SUB_TAGS = {36867: "datetime_original"}
+
+
+def _gps_to_decimal(values, ref):
+    try:
+        deg, minutes, seconds = (float(v) for v in values)
+    except (TypeError, ValueError):
+        return None
+    decimal = deg + minutes / 60 + seconds / 3600
+    return round(-decimal if ref in ("S", "W") else decimal, 6)
+
+
+def capture_exif(img):
+    """Pulls the few EXIF fields worth keeping (camera, capture time, GPS) before they are stripped."""
+    meta = {}
+    try:
+        exif = img.getexif()
+    except Exception:
+        return meta
+    for tag, key in EXIF_TAGS.items():
+        if exif.get(tag): meta[key] = str(exif[tag]).strip("\x00 ")
+    try:
+        sub = exif.get_ifd(EXIF_IFD)
+        for tag, key in EXIF_SUB_TAGS.items():
+            if sub.get(tag): meta[key] = str(sub[tag]).strip("\x00 ")
+        gps = exif.get_ifd(GPS_IFD)
+        if gps.get(2) and gps.get(4):
+            lat = _gps_to_decimal(gps[2], gps.get(1))
+            lon = _gps_to_decimal(gps[4], gps.get(3))
+            if lat is not None and lon is not None:
+                meta["gps"] = {"lat": lat, "lon": lon}
+    except Exception:
+        pass
+    return meta
+
+
+def prepare_image(data, mime_type, max_side=PHOTO_MAX_SIDE, quality=PHOTO_JPEG_QUALITY, subsampling=-1):
+    """
+    Downsizes to max_side (longest edge) and recompresses as an EXIF-free JPEG.
+    subsampling=0 keeps full chroma resolution (sharper text edges on coloured scans).
+    Non-images (PDF etc.) and undecodable files are passed through untouched.
+    Returns (bytes, mime_type, info).
+    """
+    info = {"bytes_in": len(data), "bytes_out": len(data), "bytes_saved": 0}
+    if not str(mime_type).startswith("image/"):
+        info["skipped"] = "not an image"
+        return data, mime_type, info
+
+    try:
+        img = Image.open(io.BytesIO(data))
+        info["exif"] = capture_exif(img)
+        info["size_in"] = list(img.size)
+
+        img = ImageOps.exif_transpose(img)  # Bake in rotation before the orientation tag is dropped
+        img.thumbnail((max_side, max_side), Image.LANCZOS)
+        if img.mode not in ("RGB", "L"):
+            # Flatten transparency onto white (PNG screenshots / scans)
+            background = Image.new("RGB", img.size, (255, 255, 255))
+            rgba = img.convert("RGBA")
+            background.paste(rgba, mask=rgba.getchannel("A"))
+            img = background
+
+        out = io.BytesIO()
+        img.save(out, format="JPEG", quality=quality, optimize=True, subsampling=subsampling)  # No exif= -> metadata stripped
+        prepared = out.getvalue()
+    except Exception as e:
+        info["skipped"] = f"decode failed: {e}"
+        return data, mime_type, info
+
+    # A small, already-compressed upload can grow when re-encoded; keep the original then
+    if len(prepared) >= len(data) and not info["exif"] and list(img.size) == info["size_in"]:
+        info["skipped"] = "already compact"
+        return data, mime_type, info
+
+    info.update(size_out=list(img.size), bytes_out=len(prepared), bytes_saved=len(data) - len(prepared))
+    return prepared, "image/jpeg", info
+
+
+def prepare_photo(data, mime_type):
+    return prepare_image(data, mime_type, PHOTO_MAX_SIDE, PHOTO_JPEG_QUALITY)
+
+
+def prepare_document(data, mime_type):
+    return prepare_image(data, mime_type, DOCUMENT_MAX_SIDE, DOCUMENT_JPEG_QUALITY, subsampling=0)
+
+
+def settings_fingerprint():
+    """Part of the stage cache key: results from differently-prepared uploads are not reused."""
+    return f"photo={PHOTO_MAX_SIDE}/{PHOTO_JPEG_QUALITY};doc={DOCUMENT_MAX_SIDE}/{DOCUMENT_JPEG_QUALITY}"
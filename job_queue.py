@@ -0,0 +1,272 @@
+# job_queue.py
+# Durable claim queue on SQLite (stdlib only), shared by the Streamlit UI and claim_worker.py processes.
+#
+#   UI:      app_id = JobQueue().enqueue(uploads, mobile, date_of_loss, profile)   -> returns at once
+#            JobQueue().get(app_id)                                               -> poll status / progress
+#   Worker:  job = queue.claim(worker_id) ... queue.complete(app_id, worker_id, result)
+#
+# Uploads are written to JOB_DIR/<application_id>/ in the batch_claims folder layout, so a stuck
+# claim can also be replayed with:  python batch_claims.py claim_jobs
+# Jobs are claimed earliest-72h-deadline-first (claim_scheduler.claim_deadline); claims already past
+# their deadline follow the ones that can still make it, oldest first. A job whose worker
+# stops heart-beating for JOB_LEASE_SECONDS (process killed, machine rebooted) goes back to the queue.
+# Farmers' uploads are deleted as soon as a claim is done; a finished claim's folder (generated PDFs,
+# or the uploads of a failed claim kept for replay) is deleted JOB_RETENTION_HOURS after it finished.
+
+import os
+import glob
+import json
+import time
+import shutil
+import sqlite3
+from contextlib import closing
+
+import resilience
+from agent_engine import new_application_id
+from claim_scheduler import claim_deadline
+
+# --- SETTINGS (override via .env) ---
+JOB_DB_PATH = os.getenv("JOB_DB_PATH", "claim_jobs.sqlite3")
+JOB_DIR = os.getenv("JOB_DIR", "claim_jobs")
+JOB_LEASE_SECONDS = float(os.getenv("JOB_LEASE_SECONDS", 300))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", 3))
+JOB_RETENTION_HOURS = float(os.getenv("JOB_RETENTION_HOURS", 72))  # 0 = keep finished claim folders forever
+PURGE_INTERVAL_SECONDS = 300
+# Everything resilience.write_claim_folder stores about the farmer
+UPLOAD_FILES = ("audio.*", "land.*", "photo.*", "mime_types.json", "mobile.txt", "date_of_loss.txt")
+WORKER_SEEN_SECONDS = 60  # A worker that has not polled or heart-beaten for this long is not counted
+DEFAULT_SERVICE_SECONDS = float(os.getenv("SCHEDULER_SERVICE_SECONDS", 20))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    application_id TEXT PRIMARY KEY,
+    status TEXT NOT NULL,              -- queued | running | done | failed
+    deadline REAL NOT NULL,            -- 72h intimation deadline (epoch s): lowest goes first
+    not_before REAL NOT NULL DEFAULT 0,-- retry delay (e.g. model circuit open)
+    mobile TEXT,
+    date_of_loss TEXT,
+    job_dir TEXT NOT NULL,             -- '' once the folder has been purged (JOB_RETENTION_HOURS)
+    profile TEXT,                      -- JSON: farmer fields for the documents
+    progress TEXT,                     -- JSON: early updates (voice_response, verification...)
+    result TEXT,                       -- JSON: status, reason, report_path, form_path...
+    error TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    worker TEXT,
+    created_at REAL NOT NULL,
+    started_at REAL,
+    heartbeat_at REAL,
+    finished_at REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_ready ON jobs (status, deadline);
+CREATE TABLE IF NOT EXISTS workers (
+    worker_id TEXT PRIMARY KEY,
+    pid INTEGER,
+    last_seen REAL NOT NULL
+);
+"""
+
+JSON_COLUMNS = ("profile", "progress", "result")
+
+# Claim order, given :now. Live claims by deadline, then overdue ones in arrival order: a claim that
+# missed its deadline has the smallest one and would otherwise starve every claim that can still make it
+OVERDUE = "(deadline < :now)"
+RANK = "(CASE WHEN deadline < :now THEN created_at ELSE deadline END)"
+
+
+def remove_uploads(claim_dir):
+    """Deletes the farmer's uploads from a claim folder (generated PDFs stay until purge_expired)."""
+    for pattern in UPLOAD_FILES:
+        for path in glob.glob(os.path.join(claim_dir, pattern)):
+            try:
+                os.remove(path)
+            except OSError as e:
+                print(f"⚠️ Could not delete {path}: {e}")
+
+
+class JobQueue:
+    def __init__(self, db_path=JOB_DB_PATH, job_dir=JOB_DIR):
+        self.db_path = db_path
+        self.job_dir = job_dir
+        self._next_purge = 0.0
+        with closing(self._connect()) as conn:
+            conn.execute("PRAGMA journal_mode=WAL")  # Readers (UI polling) never block the workers
+            conn.executescript(SCHEMA)
+
+    def _connect(self):
+        # One short-lived connection per call: safe across threads and processes
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    # --- 1. SUBMIT ---
+    def enqueue(self, uploads, mobile, date_of_loss=None, profile=None):
+        """
+        uploads: {"audio": (bytes, mime), "land": (bytes, mime), "photo": (bytes, mime)}
+        Returns the application_id the farmer keeps (the claim is processed later by a worker).
+        """
+        app_id = new_application_id()
+        claim_dir = os.path.join(self.job_dir, app_id)
+        resilience.write_claim_folder(claim_dir, uploads, mobile, date_of_loss)
+        now = time.time()
+        with closing(self._connect()) as conn:
+            conn.execute(
+                "INSERT INTO jobs (application_id, status, deadline, mobile, date_of_loss, job_dir, profile, created_at) "
+                "VALUES (?, 'queued', ?, ?, ?, ?, ?, ?)",
+                (app_id, claim_deadline(date_of_loss).timestamp(), mobile, date_of_loss, claim_dir,
+                 json.dumps(profile or {}, ensure_ascii=False, default=str), now))
+        print(f"📥 Claim {app_id} queued")
+        return app_id
+
+    # --- 2. WORKER SIDE ---
+    def claim(self, worker_id):
+        """Atomically takes the most urgent ready job (or None). Expired leases are re-queued first."""
+        now = time.time()
+        with closing(self._connect()) as conn:
+            conn.execute("BEGIN IMMEDIATE")  # One writer at a time: two workers never get the same job
+            try:
+                conn.execute("INSERT OR REPLACE INTO workers (worker_id, pid, last_seen) VALUES (?, ?, ?)",
+                             (worker_id, os.getpid(), now))
+                conn.execute("UPDATE jobs SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'queued' END, "
+                             "finished_at = CASE WHEN attempts >= ? THEN ? ELSE NULL END, "
+                             "error = 'worker lost' WHERE status = 'running' AND heartbeat_at < ?",
+                             (JOB_MAX_ATTEMPTS, JOB_MAX_ATTEMPTS, now, now - JOB_LEASE_SECONDS))
+                row = conn.execute(f"SELECT * FROM jobs WHERE status = 'queued' AND not_before <= :now "
+                                   f"ORDER BY {OVERDUE}, {RANK}, created_at LIMIT 1", {"now": now}).fetchone()
+                if row is not None:
+                    conn.execute("UPDATE jobs SET status = 'running', worker = ?, attempts = attempts + 1, "
+                                 "started_at = ?, heartbeat_at = ? WHERE application_id = ?",
+                                 (worker_id, now, now, row["application_id"]))
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        if now >= self._next_purge:
+            self._next_purge = now + PURGE_INTERVAL_SECONDS
+            self.purge_expired()
+        if row is None: return None
+        job = self._decode(row)
+        job.update(status="running", worker=worker_id, attempts=job["attempts"] + 1, started_at=now, heartbeat_at=now)
+        return job
+
+    def heartbeat(self, app_id, worker_id, progress=None):
+        """
+        Keeps the lease; optionally merges early updates into the job's progress.
+        Returns False once the job is no longer this worker's (lease expired and re-claimed).
+        """
+        now = time.time()
+        with closing(self._connect()) as conn:
+            conn.execute("UPDATE workers SET last_seen = ? WHERE worker_id = ?", (now, worker_id))
+            if progress is None:
+                cur = conn.execute("UPDATE jobs SET heartbeat_at = ? "
+                                   "WHERE application_id = ? AND worker = ? AND status = 'running'",
+                                   (now, app_id, worker_id))
+            else:
+                cur = conn.execute("UPDATE jobs SET heartbeat_at = ?, progress = ? "
+                                   "WHERE application_id = ? AND worker = ? AND status = 'running'",
+                                   (now, json.dumps(progress, ensure_ascii=False, default=str), app_id, worker_id))
+        return cur.rowcount > 0
+
+    def complete(self, app_id, worker_id, result):
+        if not self._finish(app_id, worker_id, "done", result=result): return False
+        # Nothing will replay a finished claim: the farmer's documents need not stay on disk
+        job = self.get(app_id)
+        if job and job["job_dir"]: remove_uploads(job["job_dir"])
+        return True
+
+    def fail(self, app_id, worker_id, error):
+        return self._finish(app_id, worker_id, "failed", error=str(error))
+
+    def retry_later(self, app_id, worker_id, delay_seconds, error, count_attempt=False):
+        """
+        Back to the queue, keeping its deadline (so it is first in line again once the delay has passed).
+        count_attempt=False (model service down): the claim itself is fine, so no attempt is used up.
+        Otherwise it fails for good once JOB_MAX_ATTEMPTS have been made.
+        """
+        now = time.time()
+        with closing(self._connect()) as conn:
+            cur = conn.execute(
+                "UPDATE jobs SET status = CASE WHEN ? AND attempts >= ? THEN 'failed' ELSE 'queued' END, "
+                "finished_at = CASE WHEN ? AND attempts >= ? THEN ? ELSE NULL END, "
+                "attempts = attempts - ?, not_before = ?, error = ? "
+                "WHERE application_id = ? AND worker = ? AND status = 'running'",
+                (count_attempt, JOB_MAX_ATTEMPTS, count_attempt, JOB_MAX_ATTEMPTS, now, 0 if count_attempt else 1,
+                 now + delay_seconds, str(error), app_id, worker_id))
+        return self._owned(cur, app_id, worker_id)
+
+    def _finish(self, app_id, worker_id, status, result=None, error=None):
+        with closing(self._connect()) as conn:
+            cur = conn.execute(
+                "UPDATE jobs SET status = ?, result = ?, error = ?, finished_at = ? "
+                "WHERE application_id = ? AND worker = ? AND status = 'running'",
+                (status, json.dumps(result, ensure_ascii=False, default=str) if result is not None else None,
+                 error, time.time(), app_id, worker_id))
+        return self._owned(cur, app_id, worker_id)
+
+    def _owned(self, cur, app_id, worker_id):
+        # No row: the lease expired and the job was re-queued (or taken) meanwhile; its new owner decides
+        if cur.rowcount: return True
+        print(f"⚠️ {app_id}: no longer held by {worker_id}, result dropped")
+        return False
+
+    def purge_expired(self, retention_hours=JOB_RETENTION_HOURS):
+        """Deletes the folders of claims finished more than retention_hours ago. Returns how many."""
+        if retention_hours <= 0: return 0
+        cutoff = time.time() - retention_hours * 3600
+        with closing(self._connect()) as conn:
+            rows = conn.execute("SELECT application_id, job_dir FROM jobs WHERE status IN ('done', 'failed') "
+                                "AND finished_at < ? AND job_dir != ''", (cutoff,)).fetchall()
+            for row in rows:
+                shutil.rmtree(row["job_dir"], ignore_errors=True)
+                conn.execute("UPDATE jobs SET job_dir = '' WHERE application_id = ?", (row["application_id"],))
+        if rows: print(f"🧹 Deleted {len(rows)} finished claim folder(s) older than {retention_hours:g}h")
+        return len(rows)
+
+    # --- 3. UI SIDE ---
+    def _decode(self, row):
+        job = dict(row)
+        for key in JSON_COLUMNS:
+            job[key] = json.loads(job[key]) if job[key] else None
+        return job
+
+    def get(self, app_id):
+        with closing(self._connect()) as conn:
+            row = conn.execute("SELECT * FROM jobs WHERE application_id = ?", (app_id,)).fetchone()
+        return self._decode(row) if row is not None else None
+
+    def position(self, app_id):
+        """Queued jobs that will be claimed before this one (None if it is not queued)."""
+        with closing(self._connect()) as conn:
+            params = {"now": time.time(), "app_id": app_id}
+            row = conn.execute(f"SELECT {OVERDUE} AS overdue, {RANK} AS rank, created_at FROM jobs "
+                               "WHERE application_id = :app_id AND status = 'queued'", params).fetchone()
+            if row is None: return None
+            params.update(row)
+            return conn.execute(f"SELECT COUNT(*) FROM jobs WHERE status = 'queued' AND ({OVERDUE} < :overdue OR "
+                                f"({OVERDUE} = :overdue AND ({RANK} < :rank OR ({RANK} = :rank AND created_at < :created_at))))",
+                                params).fetchone()[0]
+
+    def get_stats(self, window=50):
+        """Queue depth, live workers and the recent average service time."""
+        now = time.time()
+        with closing(self._connect()) as conn:
+            counts = dict(conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+            workers = conn.execute("SELECT COUNT(*) FROM workers WHERE last_seen > ?",
+                                   (now - WORKER_SEEN_SECONDS,)).fetchone()[0]
+            recent = [r[0] for r in conn.execute(
+                "SELECT finished_at - started_at FROM jobs WHERE status = 'done' ORDER BY finished_at DESC LIMIT ?",
+                (window,)).fetchall()]
+        return {
+            "queued": counts.get("queued", 0), "running": counts.get("running", 0),
+            "done": counts.get("done", 0), "failed": counts.get("failed", 0),
+            "workers": workers,
+            "avg_service_seconds": round(sum(recent) / len(recent), 2) if recent else DEFAULT_SERVICE_SECONDS,
+        }
+
+    def predicted_wait(self, app_id):
+        """Seconds until a worker picks this job up (0 once it is running). None: no worker is alive."""
+        ahead = self.position(app_id)
+        if ahead is None: return 0.0
+        stats = self.get_stats()
+        if not stats["workers"]: return None
+        backlog = ahead + stats["running"] - stats["workers"] + 1
+        return max(0.0, backlog / stats["workers"] * stats["avg_service_seconds"])
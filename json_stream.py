@@ -0,0 +1,67 @@
+# json_stream.py
+# Incremental parser for a streamed JSON object (the model's answer arrives in text chunks).
+# Reports each top-level field the moment its value is complete, so e.g. voice_response
+# can be shown to the farmer while the rest of the answer is still being generated.
+#
+#   parser = IncrementalJSONParser()
+#   for chunk in stream:
+#       for key, value in parser.feed(chunk).items(): ...
+
+import json
+
+
+class IncrementalJSONParser:
+    def __init__(self):
+        self.text = ""
+        self.fields = {}        # Every completed top-level field so far
+        self._pos = 0           # Next character to scan (each character is scanned once)
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+        self._member_start = None  # Start of the current "key": value inside the top-level object
+        self.done = False
+
+    def feed(self, chunk):
+        """Adds a chunk; returns {key: value} for the top-level fields completed by it."""
+        if not chunk or self.done: return {}
+        self.text += chunk
+        completed = {}
+        text = self.text
+        for i in range(self._pos, len(text)):
+            ch = text[i]
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif ch == "\\":
+                    self._escaped = True
+                elif ch == '"':
+                    self._in_string = False
+                continue
+
+            if ch == '"':
+                self._in_string = True
+            elif ch in "{[":
+                self._depth += 1
+                if self._depth == 1 and ch == "{":
+                    self._member_start = i + 1
+            elif ch in "}]":
+                if self._depth == 1:
+                    self._complete(text[self._member_start:i] if self._member_start is not None else "", completed)
+                    self.done = True
+                    break
+                self._depth -= 1
+            elif ch == "," and self._depth == 1 and self._member_start is not None:
+                self._complete(text[self._member_start:i], completed)
+                self._member_start = i + 1
+        self._pos = len(text)
+        return completed
+
+    def _complete(self, member, completed):
+        member = member.strip()
+        if not member: return
+        try:
+            field = json.loads("{" + member + "}")
+        except ValueError:
+            return  # Malformed member: the final full parse will report it
+        self.fields.update(field)
+        completed.update(field)
@@ -0,0 +1,246 @@
+# llm_backend.py
+# The model behind agent_engine's stages, behind one small interface.
+#
+#   GeminiBackend - the real thing (google-genai async client, created lazily)
+#   FakeBackend   - in-process stand-in that replays canned JSON with configurable
+#                   latency / error distributions, for load tests and offline benchmarks
+#
+# Select with LLM_BACKEND=gemini|fake (default gemini), or call agent_engine.set_backend().
+
+import os
+import json
+import random
+import asyncio
+
+import audio_prep
+
+
+class LLMResponse:
+    def __init__(self, text, model, usage=None):
+        self.text = text
+        self.model = model
+        self.usage = usage or {}  # input_tokens / output_tokens / thinking_tokens / cached_tokens / total_tokens
+
+
+def usage_from_metadata(meta):
+    """Flattens Gemini's usage_metadata into plain ints (missing counts are 0)."""
+    if meta is None: return {}
+    count = lambda field: getattr(meta, field, None) or 0
+    return {
+        "input_tokens": count("prompt_token_count"),
+        "output_tokens": count("candidates_token_count"),
+        "thinking_tokens": count("thoughts_token_count"),  # Billed as output on 2.5 models
+        "cached_tokens": count("cached_content_token_count"),
+        "total_tokens": count("total_token_count"),
+    }
+
+
+class LLMBackend:
+    name = "base"
+
+    async def generate(self, stage, prompt, data, mime_type, model, temperature=0.2, schema=None):
+        """
+        Runs one prompt over one inline blob; returns an LLMResponse with JSON text.
+        schema: optional response schema (structured_output.SCHEMAS) the answer must follow.
+        """
+        raise NotImplementedError
+
+    async def generate_stream(self, stage, prompt, data, mime_type, model, temperature=0.2, schema=None):
+        """
+        Async iterator of LLMResponse chunks (text pieces; usage on the last one).
+        Backends without real streaming yield the whole answer as a single chunk.
+        """
+        yield await self.generate(stage, prompt, data, mime_type, model, temperature, schema)
+
+
+# --- 1. REAL BACKEND ---
+class GeminiBackend(LLMBackend):
+    name = "gemini"
+
+    def __init__(self, api_key=None):
+        self._api_key = api_key
+        self._client = None
+
+    @property
+    def client(self):
+        # Created on first use, so importing agent_engine needs no API key (tests, batch dry runs)
+        if self._client is None:
+            from google import genai
+            self._client = genai.Client(api_key=self._api_key or os.getenv("GOOGLE_API_KEY"))
+        return self._client
+
+    def _request(self, prompt, data, mime_type, model, temperature, schema):
+        from google.genai import types
+
+        return dict(
+            model=model,
+            contents=[
+                prompt,
+                types.Part.from_bytes(data=data, mime_type=mime_type)
+            ],
+            config=types.GenerateContentConfig(
+                response_mime_type="application/json",
+                response_schema=schema,  # Constrained decoding: always parseable, always our shape
+                temperature=temperature
+            )
+        )
+
+    async def generate(self, stage, prompt, data, mime_type, model, temperature=0.2, schema=None):
+        response = await self.client.aio.models.generate_content(**self._request(prompt, data, mime_type, model, temperature, schema))
+        return LLMResponse(response.text, model, usage=usage_from_metadata(getattr(response, "usage_metadata", None)))
+
+    async def generate_stream(self, stage, prompt, data, mime_type, model, temperature=0.2, schema=None):
+        stream = await self.client.aio.models.generate_content_stream(**self._request(prompt, data, mime_type, model, temperature, schema))
+        async for chunk in stream:
+            # usage_metadata is cumulative: the last chunk carries the final counts
+            yield LLMResponse(chunk.text or "", model, usage=usage_from_metadata(getattr(chunk, "usage_metadata", None)))
+
+
+# --- 2. FAKE BACKEND (Offline load testing) ---
+# Canned answers modelled on the Kondiba Tambe demo claim (config.MOCK_DB)
+DEFAULT_FAKE_RESPONSES = {
+    "document": {
+        "occupants": [
+            {"name": "कोंडिबा सबाजी तांबे", "name_english": "Kondiba Sabaji Tambe", "khate_number": "330", "area_hectare": "०.३८.००"}
+        ],
+        "address_village": "शिरदाळेवाडी",
+        "address_village_english": "Shirdalewadi",
+        "address_taluka": "आंबेगाव",
+        "address_taluka_english": "Ambegaon",
+        "address_district": "पुणे",
+        "survey_number": "१०२",
+        "crop_history": [
+            {"year": "2025-26", "season": "खरीप", "crop_name": "बटाटा", "crop_name_english": "Potato", "area_hectare": "०.३८.००"}
+        ]
+    },
+    "voice": {
+        "voice_response": "काळजी करू नका, तुमचा अर्ज नोंदवला आहे.",
+        "language": "Marathi",
+        "farmer_name": "कोंडिबा तांबे",
+        "farmer_name_english": "Kondiba Tambe",
+        "crop_name": "बटाटा",
+        "crop_name_english": "Potato",
+        "cause_of_loss": "पूर",
+        "cause_of_loss_english": "Flood"
+    },
+    "visual": {
+        "is_valid": True,
+        "visual_finding": "Standing water over a potato field",
+        "rejection_reason": ""
+    }
+}
+
+FAKE_ERRORS = (
+    "503 UNAVAILABLE. The model is overloaded. Please try again later.",
+    "429 RESOURCE_EXHAUSTED. Quota exceeded.",
+    "500 INTERNAL. An internal error has occurred.",
+)
+
+
+class FakeBackendError(Exception):
+    pass
+
+
+def estimate_usage(prompt, data, mime_type, text):
+    """
+    Rough Gemini token counts for the fake backend, so accounting reports have plausible numbers:
+    ~4 characters per text token, 258 tokens per image / PDF page, 32 tokens per second of audio.
+    """
+    if mime_type.startswith("audio/"):
+        seconds = audio_prep.audio_seconds(data)  # FLAC / Opus after trimming: bytes say little about length
+        media = int(32 * (seconds if seconds is not None else len(data) / 32000))  # else assume 16 kHz 16-bit WAV
+    elif mime_type == "application/pdf":
+        media = 258 * max(1, data.count(b"/Type /Page") - data.count(b"/Type /Pages"))
+    else:
+        media = 258
+    input_tokens = len(prompt) // 4 + media
+    output_tokens = len(text) // 4
+    return {"input_tokens": input_tokens, "output_tokens": output_tokens, "thinking_tokens": 0,
+            "cached_tokens": 0, "total_tokens": input_tokens + output_tokens}
+
+
+class FakeBackend(LLMBackend):
+    """
+    latency: "fixed" (always median), "uniform" (0.5x-1.5x median) or "lognormal"
+    (median with a long right tail controlled by sigma - closest to real API behaviour).
+    error_rate: probability that a call raises one of FAKE_ERRORS after the latency.
+    malformed_rate: probability that the answer comes back damaged (code fence, trailing or
+    missing comma, truncation) - exercises structured_output's repair / retry path.
+    """
+    name = "fake"
+
+    def __init__(self, responses=None, median_latency_s=1.0, latency="lognormal", sigma=0.5,
+                 error_rate=0.0, malformed_rate=0.0, seed=None):
+        self.responses = dict(DEFAULT_FAKE_RESPONSES)
+        self.responses.update(responses or {})
+        self.median_latency_s = median_latency_s
+        self.latency = latency
+        self.sigma = sigma
+        self.error_rate = error_rate
+        self.malformed_rate = malformed_rate
+        self._rng = random.Random(seed)
+        self.calls = 0
+        self.errors = 0
+
+    def sample_latency(self):
+        if self.latency == "fixed":
+            return self.median_latency_s
+        if self.latency == "uniform":
+            return self._rng.uniform(0.5, 1.5) * self.median_latency_s
+        return self._rng.lognormvariate(0, self.sigma) * self.median_latency_s
+
+    def _answer(self, stage):
+        text = json.dumps(self.responses[stage], ensure_ascii=False, indent=1)
+        if self._rng.random() >= self.malformed_rate:
+            return text
+        damage = self._rng.choice(("fence", "trailing_comma", "missing_comma", "truncate"))
+        if damage == "fence":
+            return f"```json\n{text}\n```"
+        if damage == "trailing_comma":
+            return text[:text.rindex("}")].rstrip() + ",\n}"
+        if damage == "missing_comma":
+            return text.replace(",\n", "\n", 1)
+        return text[: self._rng.randint(len(text) // 3, len(text) - 2)]
+
+    async def generate(self, stage, prompt, data, mime_type, model, temperature=0.2, schema=None):
+        self.calls += 1
+        await asyncio.sleep(self.sample_latency())
+        if self._rng.random() < self.error_rate:
+            self.errors += 1
+            raise FakeBackendError(self._rng.choice(FAKE_ERRORS))
+        text = self._answer(stage)
+        return LLMResponse(text, f"fake-{model}", usage=estimate_usage(prompt, data, mime_type, text))
+
+    async def generate_stream(self, stage, prompt, data, mime_type, model, temperature=0.2, schema=None, chunk_chars=24):
+        """Time to first chunk is ~30% of the sampled latency; the rest is spread over the chunks."""
+        self.calls += 1
+        latency = self.sample_latency()
+        await asyncio.sleep(0.3 * latency)
+        if self._rng.random() < self.error_rate:
+            self.errors += 1
+            raise FakeBackendError(self._rng.choice(FAKE_ERRORS))
+        text = self._answer(stage)
+        pieces = [text[i:i + chunk_chars] for i in range(0, len(text), chunk_chars)]
+        for i, piece in enumerate(pieces):
+            await asyncio.sleep(0.7 * latency / len(pieces))
+            last = i == len(pieces) - 1
+            yield LLMResponse(piece, f"fake-{model}", usage=estimate_usage(prompt, data, mime_type, text) if last else None)
+
+
+def backend_from_env():
+    """LLM_BACKEND=fake plus FAKE_LATENCY_S / FAKE_LATENCY_DIST / FAKE_ERROR_RATE / FAKE_MALFORMED_RATE / FAKE_RESPONSES_PATH."""
+    if os.getenv("LLM_BACKEND", "gemini").lower() != "fake":
+        return GeminiBackend()
+
+    responses = None
+    if os.getenv("FAKE_RESPONSES_PATH"):
+        with open(os.getenv("FAKE_RESPONSES_PATH"), "r", encoding="utf-8") as f:
+            responses = json.load(f)
+    print("🧪 Using FAKE LLM backend (no Gemini calls)")
+    return FakeBackend(
+        responses=responses,
+        median_latency_s=float(os.getenv("FAKE_LATENCY_S", 1.0)),
+        latency=os.getenv("FAKE_LATENCY_DIST", "lognormal"),
+        error_rate=float(os.getenv("FAKE_ERROR_RATE", 0.0)),
+        malformed_rate=float(os.getenv("FAKE_MALFORMED_RATE", 0.0)),
+    )
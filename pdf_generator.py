@@ -1,216 +1,238 @@
 from fpdf import FPDF
+from fpdf.fonts import CoreFont, SubsetMap
+from fontTools.ttLib import TTFont
 from pypdf import PdfReader, PdfWriter
+from pypdf.generic import NameObject
+import io
 import os
-from pytz import timezone
-from datetime import datetime
-import pytz
-
-def generate_filled_pdf(json_data, original_pdf_path="assets/template.pdf", output_path="test_output.pdf"):
-    
-    print("🎨 Starting PDF Generation...")
-    
-    # 1. SETUP FPDF
-    # A4 size is 595pt wide x 842pt tall
-    pdf = FPDF(orientation='P', unit='pt', format='A4')
-
-    # --- THE MAGIC FIX: ENABLE TEXT SHAPING ---
-    try:
-        pdf.set_text_shaping(True) 
-        print("✅ Text Shaping Enabled (Marathi will look perfect)")
-    except Exception as e:
-        print(f"⚠️ Shaping Error: {e}")
-        print("   (Did you run 'pip install uharfbuzz'?)")
-
-    pdf.add_page()
-    
-    # 2. REGISTER MARATHI FONT
-    font_path = "assets/MarathiFont.ttf"
-    # Fallback to Helvetica if Marathi font is missing
-    main_font = "Helvetica"
-    
-    if os.path.exists(font_path):
+import copy
+import threading
+from tracing import traced
+import form_layouts
+import form_fonts
+from shaping_cache import use_shaping_cache
+
+FALLBACK_FONT = "Helvetica"  # If a layout's TTF is missing / broken
+
+
+class FormRenderer:
+    """
+    Fills a claim form from a compiled layout (form_layouts.RenderPlan). Its fonts and template PDF
+    are loaded and parsed once; every render() reuses that state. One per layout (get_form_renderer).
+    presubset=False ignores the layout fonts' pre-built subsets (form_fonts) and lets fpdf subset per form.
+    """
+
+    def __init__(self, plan=None, original_pdf_path=None, presubset=form_fonts.PRESUBSET_FONTS):
+        self.plan = plan or form_layouts.get_layout()
+        self.template_path = original_pdf_path or self.plan.template
+        self.shaping = self._check_shaping()
+        self.presubset = presubset
+        self._ttf = {}  # family -> (parsed fpdf font, raw bytes, path)
+        self._presubsets = {}  # family -> form_fonts.PresubsetFont
+        self._fonts = {key: self._load_font(font) for key, font in self.plan.fonts.items()}  # key -> (family, size)
+        self._template = self._load_template(self.template_path)
+        self._template_lock = threading.Lock()  # PdfReader is not thread-safe; the post pool renders in threads
+
+    # --- 1. CACHED RESOURCES ---
+    def _check_shaping(self):
+        # --- THE MAGIC FIX: ENABLE TEXT SHAPING ---
         try:
-            pdf.add_font("Marathi", style="", fname=font_path)
-            # Use Marathi font if loaded successfully
-            main_font = "Marathi"
-            print("✅ Marathi Font Loaded")
+            FPDF().set_text_shaping(True)
+            print("✅ Text Shaping Enabled (Marathi will look perfect)")
+            return True
         except Exception as e:
-            print(f"⚠️ Font Error: {e}")
-            
-    else:
-        print(f"⚠️ Font File Missing: {font_path}")
-    
-    # Set the font (either Marathi or Helvetica)
-    pdf.set_font(main_font, size=8)
-
-    # 3. COORDINATE FUNCTION (SIMPLIFIED)
-    # Now (0,0) is TOP-LEFT. 
-    # X = Distance from Left. Y = Distance from Top.
-    def text_at(x, y, txt):
-        if not txt: return
-        pdf.set_xy(x, y)
+            print(f"⚠️ Shaping Error: {e}")
+            print("   (Did you run 'pip install uharfbuzz'?)")
+            return False
+
+    def _load_font(self, font):
+        """Parses a layout font's TTF once -> (family, size). Core fonts need no file; FALLBACK_FONT if it fails."""
+        family, size, font_path = font["family"], font["size"], font.get("file")
+        if not font_path or family in self._ttf:
+            return family, size
+        if not os.path.exists(font_path):
+            print(f"⚠️ Font File Missing: {font_path}")
+            return FALLBACK_FONT, size
         try:
-            pdf.cell(0, 0, str(txt))
-        except:
-            pass
-
-    # Extract fields ONCE here to use throughout the function
-    fields = json_data.get("form_fields", {})
-# --- 4. MAP YOUR FIELDS (YOUR MANUAL COORDINATES) ---
-    
-    # Farmer Name
-    text_at(250, 146, str(fields.get("farmer_full_name", "")))
-    
-    # Address
-    village = fields.get('address_village', '')
-    taluka = fields.get('address_taluka', '')
-    district = fields.get('address_district', '')
-    
-    formatted_address = f"मु. पो. {village}, ता. {taluka}, जि. {district}"
-    text_at(210, 165, formatted_address)
-
-    # --- UPDATED: Mobile Number (Dynamic) ---
-    mobile = str(fields.get("mobile_number", "")) # Fetch from DB data
-    
-    # Starting position for the first box
-    start_x = 213 
-    y_pos = 181
-    gap = 14
-
-    # Loop through digits (handle if mobile is shorter than 10)
-    for digit in mobile[:10]: 
-        text_at(start_x, y_pos, digit)
-        start_x += gap
-    
-    # --- UPDATED: Email (Dynamic) ---
-    email = str(fields.get("email", "")) # Fetch from DB data
-    
-    # Switch to Helvetica for Email (English text)
-    pdf.set_font("Helvetica", size=6.5) 
-    text_at(426, 181, email) 
-    
-    # Reset back to main font
-    pdf.set_font(main_font, size=8) 
-
-    # Shetkari ID (ID / Proposal No) - Printing "NA"
-    text_at(220, 297, "NA")
-    
-    # Financial Year
-    text_at(479, 207, str(fields.get("financial_year", "")))
-    
-    # Season
-    text_at(339, 207, str(fields.get("season", "")))
-
-    # --- UPDATED: Bank Details (Dynamic) ---
-    # Bank Account
-    text_at(202, 243, str(fields.get("bank_account_number", "")))
-    
-    # Bank Name
-    text_at(395, 243, str(fields.get("bank_name", "")))
-
-    # Premium Amount
-    text_at(200, 264, str(fields.get("premium_amount", "")))
-
-    # --- FARM LOCATION DETAILS (Middle Block) ---
-    loc_y = 343.5 
-    
-    text_at(103, loc_y, str(fields.get("address_village", "")))   # Village
-    text_at(195, loc_y, str(fields.get("address_village", "")))   # Mandal
-    text_at(320, loc_y, str(fields.get("address_taluka", "")))    # Taluka
-    text_at(457, loc_y, str(fields.get("address_district", "")))  # District
-
-    # --- CROP TABLE ---
-    row_y = 405 
-    text_at(120, row_y, str(fields.get("survey_number", "")))
-    text_at(180, row_y, str(fields.get("crop_name", "")))
-    text_at(255, row_y, str(fields.get("sown_area_hectare", "")))
-    text_at(325, row_y, str(fields.get("sown_area_hectare", "")))
-    text_at(483, row_y, "100%")
-
-    # --- LOSS DETAILS (Checkboxes) ---
-    def draw_tick_mark(x, y):
-        # Set line thickness
-        pdf.set_line_width(2)
-        # Draw "V" shape
-        pdf.line(x, y, x + 3, y + 3)
-        pdf.line(x + 3, y + 3, x + 10, y - 8)
-        # Reset line width
-        pdf.set_line_width(1)
-
-    cause = str(fields.get("cause_of_loss", "")).lower()
-    
-    # 1. Flood (Pura)
-    if "pur" in cause or "flood" in cause or "पाणी" in cause:
-        draw_tick_mark(335, 470) 
-        
-    # 2. Hailstorm (Garpit)
-    elif "garpit" in cause or "hail" in cause or "गारपीट" in cause:
-        draw_tick_mark(420, 470)
-        
-    # 3. Landslide (Bhusakhalan)
-    elif "land" in cause or "bhus" in cause or "भुस्खलन" in cause:
-        draw_tick_mark(518, 471)
-
-    # 4. Cyclone (Chakrivadal)
-    elif "cyclone" in cause or "chakri" in cause or "चक्रीवादळ" in cause:
-        draw_tick_mark(228, 513)
-
-    # 5. Unseasonal Rain (Avakali Paus)
-    elif "rain" in cause or "paus" in cause or "पाऊस" in cause:
-        draw_tick_mark(442, 513)
-        
-    text_at(108, 607, str(fields.get("date_of_loss", "")))
-
-    # Fix: Explicitly get time in Indian Standard Time (IST)
-    ist = timezone('Asia/Kolkata')
-    now_str = datetime.now(ist).strftime("%d/%m/%Y | %I:%M %p")
-    
-    # Print it at the bottom left
-    text_at(158, 539, now_str)
-
-    # 5. SAVE OVERLAY
-    overlay_filename = "temp_overlay.pdf"
-    pdf.output(overlay_filename)
-
-    # 6. MERGE WITH ORIGINAL
-    try:
-        # Check if template exists before trying to open it
-        if not os.path.exists(original_pdf_path):
-             print(f"❌ Error: Template PDF '{original_pdf_path}' not found in folder.")
-             return None
+            proto = FPDF(orientation='P', unit='pt', format='A4')
+            proto.add_font(family, style="", fname=font_path)
+            # Shaped strings are memoized per process; every per-document copy shares that cache
+            parsed = use_shaping_cache(proto.fonts[family.lower()])
+            with open(font_path, "rb") as f:
+                self._ttf[family] = (parsed, f.read(), font_path)
+            print(f"✅ {family} Font Loaded")
+            if self.presubset and font.get("subset"):
+                presubset = form_fonts.load_presubset(font["subset"], font_path)
+                if presubset: self._presubsets[family] = presubset
+            return family, size
+        except Exception as e:
+            print(f"⚠️ Font Error: {e}")
+            return FALLBACK_FONT, size
 
+    def _load_template(self, original_pdf_path):
+        if not os.path.exists(original_pdf_path):
+            print(f"❌ Error: Template PDF '{original_pdf_path}' not found in folder.")
+            return None
         with open(original_pdf_path, "rb") as f:
-            original = PdfReader(f)
-            page = original.pages[0]
-            with open(overlay_filename, "rb") as f_ov:
-                overlay = PdfReader(f_ov).pages[0]
-                page.merge_page(overlay)
-                
-                writer = PdfWriter()
-                writer.add_page(page)
-                
-                # Add extra pages
-                for i in range(1, len(original.pages)):
-                    writer.add_page(original.pages[i])
-                
-                with open(output_path, "wb") as f_out:
-                    writer.write(f_out)
-                    
+            reader = PdfReader(io.BytesIO(f.read()))
+        len(reader.pages)  # Parse the page tree now, not on the first claim
+        return reader
+
+    def _attach_fonts(self, pdf):
+        """Gives this document its own copy of each parsed font (cmap / widths shared, subset state fresh)."""
+        for family, (parsed, font_bytes, font_path) in self._ttf.items():
+            try:
+                font = copy.copy(parsed)
+                # fpdf subsets ttfont in place when writing, so each document needs its own
+                font.ttfont = TTFont(io.BytesIO(font_bytes), recalcTimestamp=False, lazy=True)
+                font.missing_glyphs = []
+                font.biggest_size_pt = 0
+                # With a pre-built subset, character codes are glyph ids so its one font object fits
+                font.subset = form_fonts.GlyphIdMap(font) if family in self._presubsets else SubsetMap(font)
+                pdf.fonts[font.fontkey] = font
+            except Exception as e:
+                print(f"⚠️ Cached font unusable ({e}), loading from disk")
+                pdf.add_font(family, style="", fname=font_path)
+
+    # --- 2. RENDER ---
+    def render_overlay(self, json_data, detach_fonts=False):
+        """
+        Just the filled-in values (no template) as a one-page PDF; bulk_forms merges these itself.
+        detach_fonts=True returns (bytes, {resource name: (family, glyphs)}): fonts covered by their
+        pre-built subset are left out (a placeholder under that name) for the caller to attach.
+        """
+        # 1. SETUP FPDF
+        # A4 size is 595pt wide x 842pt tall
+        pdf = FPDF(orientation='P', unit='pt', format='A4')
+        if self.shaping:
+            pdf.set_text_shaping(True)
+        pdf.add_page()
+
+        # 2. FONTS (parsed once in __init__)
+        self._attach_fonts(pdf)
+
+        # 3. COORDINATE FUNCTION (SIMPLIFIED)
+        # Now (0,0) is TOP-LEFT. 
+        # X = Distance from Left. Y = Distance from Top.
+        def text_at(x, y, txt):
+            if not txt: return
+            pdf.set_xy(x, y)
+            try:
+                pdf.cell(0, 0, str(txt))
+            except:
+                pass
+
+        def draw_tick_mark(x, y):
+            # Set line thickness
+            pdf.set_line_width(2)
+            # Draw "V" shape
+            pdf.line(x, y, x + 3, y + 3)
+            pdf.line(x + 3, y + 3, x + 10, y - 8)
+            # Reset line width
+            pdf.set_line_width(1)
+
+        # Extract fields ONCE here to use throughout the function
+        fields = json_data.get("form_fields", {})
+
+        # 4. RUN THE COMPILED LAYOUT (coordinates live in assets/layouts/*.json)
+        for font_key, ops in self.plan.text_groups:
+            family, size = self._fonts[font_key]
+            pdf.set_font(family, size=size)
+            for x, y, value in ops:
+                text_at(x, y, value(fields))
+
+        # Checkboxes (e.g. cause of loss): first option whose keywords match is ticked
+        for field, mark, options in self.plan.checkboxes:
+            answer = str(fields.get(field) or "").lower()
+            for needles, x, y in options:
+                if any(needle in answer for needle in needles):
+                    draw_tick_mark(x, y)
+                    break
+
+        # 5. PRE-BUILT FONT SUBSETS: skip fpdf's per-form subsetting, unless a glyph is missing from them
+        detached = {}
+        if detach_fonts:
+            for family, presubset in self._presubsets.items():
+                font = pdf.fonts.get(family.lower())
+                if font is None or not hasattr(font, "subset"): continue
+                covered = presubset.covers(font.subset)
+                form_fonts.record(covered)
+                if not covered:
+                    print(f"⚠️ Glyphs outside {presubset.path}, embedding the full {family} font")
+                    continue
+                detached[f"/F{font.i}"] = (family, presubset.glyphs(font.subset))
+                pdf.fonts[font.fontkey] = CoreFont(font.i, "helvetica", "")  # Placeholder, swapped by the caller
+
+        data = bytes(pdf.output())
+        return (data, detached) if detach_fonts else data
+
+    def _attach_presubsets(self, overlay_page, detached, add):
+        """Puts the pre-built subsets back under their names in an overlay page; add(obj) writes objects."""
+        fonts = overlay_page["/Resources"]["/Font"].get_object()
+        for name, (family, glyphs) in detached.items():
+            if name in fonts:
+                fonts[NameObject(name)] = add(self._presubsets[family].font_dict(add, glyphs))
+
+    def render(self, json_data, output_path=None):
+        """Returns the filled form as PDF bytes; with output_path, writes it there and returns the path."""
+        print("🎨 Starting PDF Generation...")
+
+        # 6. OVERLAY + MERGE, IN MEMORY (no temp files: concurrent renders cannot collide)
+        try:
+            if self._template is None:
+                print(f"❌ Error: Template PDF '{self.template_path}' not found in folder.")
+                return None
+
+            overlay_data, detached = self.render_overlay(json_data, detach_fonts=True)
+            overlay = PdfReader(io.BytesIO(overlay_data)).pages[0]
+            writer = PdfWriter()
+            self._attach_presubsets(overlay, detached, writer._add_object)
+            with self._template_lock:
+                # Copies of the cached template pages: merging must never touch the cache
+                for template_page in self._template.pages:
+                    writer.add_page(template_page)
+            writer.pages[0].merge_page(overlay)
+            out = io.BytesIO()
+            writer.write(out)
+            data = out.getvalue()
+        except Exception as e:
+            print(f"❌ Merge Error: {e}")
+            return None
+
+        # 7. RETURN BYTES (or save them, if a file is wanted)
+        if output_path is None:
+            print(f"🚀 SUCCESS: PDF Created in memory ({len(data) // 1024} KB)")
+            return data
+        try:
+            with open(output_path, "wb") as f_out:
+                f_out.write(data)
+        except PermissionError:
+            print("❌ Error: Close the PDF file! It is currently open and locked.")
+            return None
         print(f"🚀 SUCCESS: PDF Created at {output_path}")
-        
-        # Clean up temp file
-        if os.path.exists(overlay_filename):
-            os.remove(overlay_filename)
-            
         # --- CRITICAL FIX: RETURN THE PATH ---
         return output_path
-    
-    except FileNotFoundError:
-        print(f"❌ Error: '{original_pdf_path}' not found.")
-        return None
-    except PermissionError:
-        print("❌ Error: Close the PDF file! It is currently open and locked.")
-        return None
-    except Exception as e:
-        print(f"❌ Merge Error: {e}")
-        return None
\ No newline at end of file
+
+
+_renderers = {}
+_renderers_lock = threading.Lock()
+
+
+def get_form_renderer(plan=None, original_pdf_path=None):
+    """Process-wide renderer per layout (fonts + template parsed on first use). plan=None: default layout."""
+    plan = plan or form_layouts.get_layout()
+    key = (plan.id, original_pdf_path)
+    with _renderers_lock:
+        if key not in _renderers:
+            _renderers[key] = FormRenderer(plan, original_pdf_path)
+        return _renderers[key]
+
+
+@traced("pdf.form")
+def generate_filled_pdf(json_data, original_pdf_path=None, output_path="test_output.pdf", layout=None):
+    """
+    layout: a form_layouts.RenderPlan (default: the layout in force for the claim's financial year).
+    original_pdf_path: overrides the layout's template. output_path=None: return the PDF bytes instead.
+    """
+    plan = layout or form_layouts.layout_for_claim(json_data.get("form_fields", {}))
+    return get_form_renderer(plan, original_pdf_path).render(json_data, output_path)
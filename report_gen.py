@@ -1,6 +1,7 @@
 from fpdf import FPDF
 import random
 import os
+from tracing import traced
 import re
 from pytz import timezone
 from datetime import datetime
@@ -48,8 +49,10 @@ class ClaimReportPDF(FPDF):
         with self.rotation(45, 105, 148):
             self.text(35, 150, "AI GENERATED DRAFT")
 
+@traced("pdf.report")
 def generate_best_report(json_data, image_path, output_filename="Claim_Report_FINAL.pdf"):
-    print(f"Creating PDF: {output_filename}...")
+    """output_filename=None: return the PDF bytes instead of writing a file."""
+    print(f"Creating PDF: {output_filename or 'in memory'}...")
     pdf = ClaimReportPDF()
     main_font = 'Helvetica' 
 
@@ -90,7 +93,7 @@ def generate_best_report(json_data, image_path, output_filename="Claim_Report_FI
     # 1. Get Names
     owner_name = form.get('farmer_full_name_english') or clean_text(form.get('farmer_full_name'))
     # This is the Login Name passed from app.py
-    filer_name = clean_text(json_data.get('filer_name', owner_name)) 
+    filer_name = clean_text(json_data.get('filer_name') or owner_name)  # No profile name: the owner filed
     
     # 2. Get Location
     village_val = form.get('address_village_english') or clean_text(form.get('address_village'))
@@ -98,7 +101,8 @@ def generate_best_report(json_data, image_path, output_filename="Claim_Report_FI
     crop_val = form.get('crop_name_english') or clean_text(form.get('crop_name'))
     # 3. Agent Logic
     # If the login name is roughly the same as owner name -> Self Filed
-    if filer_name.lower().split()[0] in owner_name.lower():
+    filer_first = filer_name.lower().split()[:1]
+    if filer_first and filer_first[0] in owner_name.lower():
         badge_text = "SELF-FILED"
         badge_color = (0, 128, 0) # Green
     else:
@@ -280,6 +284,11 @@ def generate_best_report(json_data, image_path, output_filename="Claim_Report_FI
     pdf.set_font(main_font, 'B', 8)
     pdf.cell(60, 5, "Farmer Signature / Angtha", align='C')
 
+    if output_filename is None:  # In-memory mode: bytes for st.download_button / storage, no file written
+        data = bytes(pdf.output())
+        print(f"✅ Success! Report built in memory ({len(data) // 1024} KB)")
+        return data
+
     try:
         pdf.output(output_filename)
         print(f"✅ Success! PDF saved as: {output_filename}")
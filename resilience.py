@@ -0,0 +1,355 @@
+# resilience.py
+# Keeps one slow or failing upstream call from tying up a farmer's claim.
+#
+#   deadlines        - every attempt has a timeout, and retries stop at the stage deadline; waiting
+#                      for a local slot (admit) happens before an attempt's clock starts
+#   retries          - only for transient errors (429 / 5xx / timeouts), with full-jitter exponential backoff
+#   hedged requests  - optional: if an attempt is slower than HEDGE_AFTER_SECONDS, send a duplicate
+#                      and keep whichever answers first (costs extra calls, cuts the latency tail)
+#   rate limit       - token bucket sized to the Gemini quota (MODEL_CALLS_PER_MINUTE, 0 = off)
+#   circuit breaker  - after BREAKER_FAILURE_THRESHOLD consecutive transient failures, calls fail fast
+#                      for BREAKER_RESET_SECONDS; claims arriving meanwhile are spooled to disk
+#                      (SPOOL_DIR) and can be replayed later with:  python batch_claims.py claim_spool
+#
+# Everything is testable offline with llm_backend.FakeBackend(error_rate=..., latency=...).
+
+import os
+import json
+import time
+import uuid
+import random
+import asyncio
+import mimetypes
+import itertools
+import threading
+import contextlib
+from datetime import datetime
+
+# --- SETTINGS (override via .env) ---
+MAX_ATTEMPTS = int(os.getenv("MODEL_MAX_ATTEMPTS", 3))
+RETRY_BASE_DELAY = float(os.getenv("MODEL_RETRY_BASE_DELAY", 1.0))   # s, doubled per attempt
+RETRY_MAX_DELAY = float(os.getenv("MODEL_RETRY_MAX_DELAY", 16.0))
+STAGE_DEADLINE_SECONDS = float(os.getenv("STAGE_DEADLINE_SECONDS", 180))  # All attempts of one stage
+HEDGE_AFTER_SECONDS = float(os.getenv("HEDGE_AFTER_SECONDS", 0))    # 0 = hedging off
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("BREAKER_FAILURE_THRESHOLD", 5))
+BREAKER_RESET_SECONDS = float(os.getenv("BREAKER_RESET_SECONDS", 30))
+SPOOL_DIR = os.getenv("SPOOL_DIR", "claim_spool")
+MODEL_CALLS_PER_MINUTE = float(os.getenv("MODEL_CALLS_PER_MINUTE", 0))  # Gemini RPM quota; 0 = unlimited
+MODEL_CALLS_BURST = int(os.getenv("MODEL_CALLS_BURST", 10))
+
+# Upstream trouble worth retrying; anything else (400 INVALID_ARGUMENT, bad key...) fails at once
+TRANSIENT_CODES = {408, 429, 500, 502, 503, 504}
+TRANSIENT_MARKERS = ("429", "500", "502", "503", "504", "UNAVAILABLE", "RESOURCE_EXHAUSTED",
+                     "INTERNAL", "DEADLINE_EXCEEDED", "overloaded", "timed out")
+
+_stats_lock = threading.Lock()
+_stats = {"calls": 0, "attempts": 0, "retries": 0, "timeouts": 0, "hedges": 0, "hedge_wins": 0,
+          "fast_failures": 0, "spooled": 0, "rate_limited": 0, "rate_limit_seconds": 0.0}
+
+
+def _count(**kwargs):
+    with _stats_lock:
+        for key, value in kwargs.items():
+            _stats[key] += value
+
+
+class CircuitOpenError(Exception):
+    """The breaker is open: the upstream is known to be failing, so the call was not attempted."""
+
+
+def is_transient(error):
+    if isinstance(error, (TimeoutError, asyncio.TimeoutError, ConnectionError)):
+        return True
+    code = getattr(error, "code", None) or getattr(error, "status_code", None)
+    if isinstance(code, int):
+        return code in TRANSIENT_CODES
+    return any(marker in str(error) for marker in TRANSIENT_MARKERS)
+
+
+# --- 1. BACKOFF ---
+class RetryPolicy:
+    def __init__(self, max_attempts=MAX_ATTEMPTS, base_delay=RETRY_BASE_DELAY, max_delay=RETRY_MAX_DELAY,
+                 deadline_seconds=STAGE_DEADLINE_SECONDS, seed=None):
+        self.max_attempts = max(1, max_attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline_seconds = deadline_seconds
+        self._rng = random.Random(seed)
+
+    def backoff(self, attempt):
+        """Full jitter: uniform(0, base * 2^attempt), capped. Spreads a surge of retries apart."""
+        return self._rng.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+
+# --- 2. RATE LIMIT ---
+class TokenBucket:
+    """
+    rate_per_minute tokens refill continuously up to burst; one model call costs one token.
+    Thread-safe and loop-agnostic: every session and event loop in the process shares the quota.
+    """
+
+    def __init__(self, rate_per_minute=MODEL_CALLS_PER_MINUTE, burst=MODEL_CALLS_BURST):
+        self.rate = rate_per_minute / 60.0
+        self.burst = max(1, burst)
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.rate > 0
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, cost=1):
+        """Takes the tokens now (possibly going negative) and returns how long to wait before using them."""
+        if not self.enabled: return 0.0
+        with self._lock:
+            self._refill()
+            self.tokens -= cost
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def refund(self, cost=1):
+        """Gives back a reservation that was never used (its call was cancelled while waiting)."""
+        if not self.enabled: return
+        with self._lock:
+            self._refill()
+            self.tokens = min(self.burst, self.tokens + cost)
+
+    def predicted_wait(self, cost=1):
+        """Seconds until `cost` more tokens would be available (no reservation)."""
+        if not self.enabled: return 0.0
+        with self._lock:
+            self._refill()
+            return max(0.0, (cost - self.tokens) / self.rate)
+
+    async def acquire_async(self, cost=1):
+        wait = self.reserve(cost)
+        if wait > 0:
+            _count(rate_limited=1, rate_limit_seconds=wait)
+            try:
+                await asyncio.sleep(wait)
+            except asyncio.CancelledError:
+                self.refund(cost)  # Else every cancelled wait would push the backlog further out
+                raise
+
+    def acquire(self, cost=1):
+        wait = self.reserve(cost)
+        if wait > 0:
+            _count(rate_limited=1, rate_limit_seconds=wait)
+            time.sleep(wait)
+
+
+# --- 3. CIRCUIT BREAKER ---
+class CircuitBreaker:
+    """
+    closed    -> calls flow; consecutive transient failures are counted
+    open      -> calls fail fast with CircuitOpenError until reset_seconds have passed
+    half_open -> one trial call; success closes the breaker, failure re-opens it. A trial that never
+                 reports back (cancelled, or stuck past its timeout) is released so another call can try
+    Thread-safe, so every Streamlit session / event loop shares one view of upstream health.
+    """
+
+    def __init__(self, failure_threshold=BREAKER_FAILURE_THRESHOLD, reset_seconds=BREAKER_RESET_SECONDS):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.opens = 0
+        self._trial_in_flight = False
+        self._trial_id = None
+        self._trial_expires = 0.0
+        self._trial_ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def _refresh(self):
+        now = time.monotonic()
+        if self.state == "open" and now - self.opened_at >= self.reset_seconds:
+            self.state = "half_open"
+            self._trial_in_flight = False
+        elif self.state == "half_open" and self._trial_in_flight and now >= self._trial_expires:
+            print("🟡 Circuit trial call never reported back: allowing another")
+            self._trial_in_flight = False
+
+    def is_open(self):
+        """True while calls would be refused (used to spool a claim before any work is done)."""
+        with self._lock:
+            self._refresh()
+            return self.state == "open" or (self.state == "half_open" and self._trial_in_flight)
+
+    def retry_after(self):
+        with self._lock:
+            return max(0.0, self.reset_seconds - (time.monotonic() - self.opened_at)) if self.state == "open" else 0.0
+
+    def before_call(self, trial_timeout=STAGE_DEADLINE_SECONDS):
+        """
+        Raises CircuitOpenError while calls are refused. Returns a trial id if this call is the
+        half-open trial (hand it back with release_trial), else None.
+        """
+        with self._lock:
+            self._refresh()
+            if self.state == "open" or (self.state == "half_open" and self._trial_in_flight):
+                _count(fast_failures=1)
+                raise CircuitOpenError(f"Model service unavailable (circuit open after {self.failures} failures)")
+            if self.state != "half_open": return None
+            self._trial_in_flight, self._trial_id = True, next(self._trial_ids)
+            self._trial_expires = time.monotonic() + trial_timeout
+            return self._trial_id
+
+    def release_trial(self, trial_id):
+        """Ends a trial that produced no verdict (e.g. cancelled); no-op once it was recorded or expired."""
+        with self._lock:
+            if self.state == "half_open" and self._trial_in_flight and self._trial_id == trial_id:
+                self._trial_in_flight = False
+
+    def record_success(self):
+        with self._lock:
+            if self.state != "closed":
+                print("🟢 Circuit closed: model service recovered")
+            self.state, self.failures, self._trial_in_flight = "closed", 0, False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == "half_open" or (self.state == "closed" and self.failures >= self.failure_threshold):
+                self.state, self.opened_at, self._trial_in_flight = "open", time.monotonic(), False
+                self.opens += 1
+                print(f"🔴 Circuit open: failing fast for {self.reset_seconds:g}s")
+
+    def snapshot(self):
+        with self._lock:
+            self._refresh()
+            return {"state": self.state, "consecutive_failures": self.failures, "opens": self.opens}
+
+
+# --- 4. RESILIENT CALL ---
+async def _with_timeout(make_attempt, timeout, name, admit=None):
+    # Queueing for a local slot is not upstream slowness: the deadline starts once admitted
+    async with (admit() if admit else contextlib.nullcontext()):
+        _count(attempts=1)
+        try:
+            return await asyncio.wait_for(make_attempt(), timeout=timeout)
+        except asyncio.TimeoutError:
+            _count(timeouts=1)
+            raise TimeoutError(f"{name} timed out after {timeout:g}s")
+
+
+async def _hedged(make_attempt, timeout, hedge_after, name, admit=None):
+    primary = asyncio.ensure_future(_with_timeout(make_attempt, timeout, name, admit))
+    if not hedge_after:
+        return await primary
+
+    done, _ = await asyncio.wait({primary}, timeout=hedge_after)
+    if done:
+        return primary.result()
+
+    _count(hedges=1)
+    backup = asyncio.ensure_future(_with_timeout(make_attempt, timeout, name, admit))
+    pending, errors = {primary, backup}, []
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    if task is backup: _count(hedge_wins=1)
+                    return task.result()
+                errors.append(task.exception())
+        raise errors[0]
+    finally:
+        for task in pending:
+            task.cancel()  # The slower copy is no longer needed
+
+
+async def call(make_attempt, name="model call", timeout=90.0, policy=None, breaker=None, hedge_after=None,
+               admit=None):
+    """
+    Runs make_attempt() (a zero-argument coroutine factory) under the full policy.
+    admit: optional zero-argument async context manager factory (e.g. a concurrency slot), entered
+    before each attempt's timeout starts and exited after it; its waits never count as failures.
+    Raises CircuitOpenError (fast), the first non-transient error, or the last transient one.
+    """
+    policy = policy or RetryPolicy()
+    started = time.monotonic()
+    _count(calls=1)
+    for attempt in range(policy.max_attempts):
+        # A hedged attempt can run hedge_after + timeout; the breaker frees a trial stuck longer than that
+        trial = breaker.before_call(timeout + (hedge_after or 0)) if breaker else None
+        remaining = policy.deadline_seconds - (time.monotonic() - started)
+        try:
+            result = await _hedged(make_attempt, min(timeout, max(remaining, 0.001)), hedge_after, name, admit)
+        except Exception as e:
+            if not is_transient(e):
+                if breaker: breaker.record_success()  # Upstream answered; the request itself was bad
+                raise
+            if breaker: breaker.record_failure()
+            delay = policy.backoff(attempt)
+            out_of_time = time.monotonic() - started + delay >= policy.deadline_seconds
+            if attempt == policy.max_attempts - 1 or out_of_time or (breaker and breaker.is_open()):
+                raise
+            _count(retries=1)
+            print(f"🔁 {name}: {e} -> retry {attempt + 2}/{policy.max_attempts} in {delay:.1f}s")
+            await asyncio.sleep(delay)
+            continue
+        else:
+            if breaker: breaker.record_success()
+            return result
+        finally:
+            # Cancelled (e.g. a sibling stage failed) before success / failure was recorded
+            if trial is not None: breaker.release_trial(trial)
+
+
+# --- 5. SPOOL (claims that arrive while the breaker is open) ---
+# Browser recordings mimetypes doesn't map everywhere
+AUDIO_EXTENSIONS = {"audio/wav": ".wav", "audio/x-wav": ".wav", "audio/webm": ".webm", "audio/mp4": ".m4a",
+                    "audio/mpeg": ".mp3", "audio/ogg": ".ogg"}
+
+
+def write_claim_folder(claim_dir, uploads, mobile_number, date_of_loss=None):
+    """
+    Writes a claim as a batch_claims directory-manifest folder:
+    <claim_dir>/{audio,land,photo}.<ext> + mime_types.json + mobile.txt [+ date_of_loss.txt]
+    uploads: {"audio": (bytes, mime), "land": (bytes, mime), "photo": (bytes, mime)}
+    Returns {role: path}.
+    """
+    os.makedirs(claim_dir, exist_ok=True)
+    paths = {}
+    for role, (data, mime_type) in uploads.items():
+        ext = AUDIO_EXTENSIONS.get(mime_type) or mimetypes.guess_extension(mime_type or "") or ".bin"
+        paths[role] = os.path.join(claim_dir, f"{role}{ext}")
+        with open(paths[role], "wb") as f:
+            f.write(data)
+    # The exact upload MIME types (the extension alone is ambiguous, e.g. .webm)
+    with open(os.path.join(claim_dir, "mime_types.json"), "w", encoding="utf-8") as f:
+        json.dump({role: mime_type for role, (_, mime_type) in uploads.items()}, f)
+    with open(os.path.join(claim_dir, "mobile.txt"), "w", encoding="utf-8") as f:
+        f.write(str(mobile_number or ""))
+    if date_of_loss:  # Keeps the claim's place in the deadline order when it is replayed
+        with open(os.path.join(claim_dir, "date_of_loss.txt"), "w", encoding="utf-8") as f:
+            f.write(str(date_of_loss))
+    return paths
+
+
+def spool_claim(uploads, mobile_number, reason, spool_dir=None, date_of_loss=None):
+    """Saves a claim's raw uploads to <SPOOL_DIR>/<spool_id>/ (write_claim_folder + spool.json)."""
+    spool_dir = spool_dir or SPOOL_DIR
+    spool_id = f"{datetime.now():%Y%m%d-%H%M%S}-{uuid.uuid4().hex[:6]}"
+    claim_dir = os.path.join(spool_dir, spool_id)
+    write_claim_folder(claim_dir, uploads, mobile_number, date_of_loss)
+    with open(os.path.join(claim_dir, "spool.json"), "w", encoding="utf-8") as f:
+        json.dump({"spool_id": spool_id, "spooled_at": datetime.now().isoformat(), "reason": reason}, f)
+    _count(spooled=1)
+    print(f"📥 Claim spooled to {claim_dir} ({reason})")
+    return spool_id
+
+
+def get_resilience_stats(breaker=None):
+    with _stats_lock:
+        s = dict(_stats)
+    s["rate_limit_seconds"] = round(s["rate_limit_seconds"], 2)
+    if breaker is not None:
+        s["breaker"] = breaker.snapshot()
+    return s
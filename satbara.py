@@ -0,0 +1,279 @@
+# satbara.py
+# Local handling of the 7/12 extract (Satbara) before it reaches Gemini.
+#
+# 1. Page pruning: only the Namuna 7 (ownership) and Namuna 12 (crop history) pages are sent.
+# 2. Text-layer fast path: digitally issued 7/12s (Mahabhumi) carry real Unicode text.
+#    When every field the claim needs can be read from it, the model call is skipped entirely;
+#    the "_english" fields the model would have written are transliterated locally.
+# Scanned PDFs and photos fall back to the model (images via image_prep).
+
+import io
+import re
+import threading
+from pypdf import PdfReader, PdfWriter
+
+import image_prep
+from scale_of_finance import normalize_crop, MARATHI_DIGITS
+
+# Bump when the parsing rules below change (part of the document stage cache key)
+PARSER_VERSION = "4"
+
+# A page needs at least this many Devanagari letters to count as a real text layer
+MIN_TEXT_LAYER_CHARS = 80
+
+NAMUNA_7_MARKERS = ("नमुना सात", "नमुना ७", "नमुना 7", "गाव नमुना सात")
+NAMUNA_12_MARKERS = ("नमुना बारा", "नमुना १२", "नमुना 12", "गाव नमुना बारा")
+
+# The Namuna 7 header names all three, in this order: "गाव :- वडगाव शिंदे   तालुका :- हवेली   जिल्हा :- पुणे".
+# Read together, so a stray "ता." (तारीख, a date) or "जि. प." elsewhere on the page is never taken for them.
+ADDRESS_HEADER = re.compile(
+    r"गाव\s*[:：\-]+\s*(?P<village>[^\n:：]+?)\s+(?:तालुका|ता\.)\s*[:：\-]+\s*(?P<taluka>[^\n:：]+?)\s+"
+    r"(?:जिल्हा|जि\.)\s*[:：\-]+\s*(?P<district>[^\n:：]+?)\s*$", re.M)
+PLACE_NAME = re.compile(r"^[\u0900-\u0963\u0970-\u097F]+(?: [\u0900-\u0963\u0970-\u097F]+){0,2}$")
+SURVEY_NUMBER = re.compile(r"(?:भूमापन क्रमांक|गट क्रमांक|सर्व्हे क्रमांक)[^:：\n]*[:：]\s*([\d०-९/अबकड]+)")
+# Maharashtra's districts (old and new names): anything else is a misread header, left to the model
+DISTRICTS = (
+    "मुंबई शहर", "मुंबई उपनगर", "ठाणे", "पालघर", "रायगड", "रत्नागिरी", "सिंधुदुर्ग", "नाशिक", "धुळे", "नंदुरबार",
+    "जळगाव", "अहमदनगर", "अहिल्यानगर", "पुणे", "सातारा", "सांगली", "कोल्हापूर", "सोलापूर", "औरंगाबाद",
+    "छत्रपती संभाजीनगर", "जालना", "बीड", "लातूर", "उस्मानाबाद", "धाराशिव", "नांदेड", "परभणी", "हिंगोली",
+    "बुलढाणा", "अकोला", "वाशिम", "अमरावती", "यवतमाळ", "नागपूर", "वर्धा", "भंडारा", "गोंदिया", "चंद्रपूर", "गडचिरोली",
+)
+# "<khate> <name ...> <H.R.sqm>"  e.g. "३३० कोंडिबा सबाजी तांबे ०.३८.००"
+OCCUPANT_ROW = re.compile(r"^\s*([\d०-९]{1,5})\s+([^\d०-९\n]{3,80}?)\s+([\d०-९]+\.[\d०-९]{2}(?:\.[\d०-९]{2})?)\s*$", re.M)
+# "<year> <season> <crop> <area>"  e.g. "२०२५-२६ खरीप बटाटा ०.३८.००"
+CROP_ROW = re.compile(r"([\d०-९]{4}\s*-\s*[\d०-९]{2,4})\s+(खरीप|रब्बी|उन्हाळी|kharif|rabi)\s+([^\d०-९\s]+(?:\s[^\d०-९\s]+)?)\s*([\d०-९]+\.[\d०-९]{2}(?:\.[\d०-९]{2})?)?", re.I)
+CANCELLED_NAME = re.compile(r"^\s*[\[(].*[\])]\s*$")
+
+_stats_lock = threading.Lock()
+_stats = {"documents": 0, "pdfs": 0, "text_layer_fast_path": 0, "pruned": 0, "pages_total": 0, "pages_sent": 0}
+
+
+def _count(**kwargs):
+    with _stats_lock:
+        for key, value in kwargs.items():
+            _stats[key] += value
+
+
+def get_document_stats():
+    """How many 7/12s took the text-layer fast path, and how many pages pruning saved."""
+    with _stats_lock:
+        s = dict(_stats)
+    s["fast_path_rate"] = round(s["text_layer_fast_path"] / s["documents"], 3) if s["documents"] else 0.0
+    return s
+
+
+def _devanagari_chars(text):
+    return sum(1 for ch in text if "ऀ" <= ch <= "ॿ")
+
+
+def _has_marker(text, markers):
+    return any(m in text for m in markers)
+
+
+# --- 1. TRANSLITERATION ---
+# Marathi -> the plain Latin spelling used on forms ("कोंडिबा सबाजी तांबे" -> "Kondiba Sabaji Tambe")
+VOWELS = {"अ": "a", "आ": "a", "इ": "i", "ई": "i", "उ": "u", "ऊ": "u", "ऋ": "ru", "ए": "e", "ऐ": "ai",
+          "ओ": "o", "औ": "au", "ऍ": "e", "ऑ": "o"}
+MATRAS = {"ा": "a", "ि": "i", "ी": "i", "ु": "u", "ू": "u", "ृ": "ru", "े": "e", "ै": "ai", "ो": "o", "ौ": "au",
+          "ॅ": "e", "ॉ": "o"}
+CONSONANTS = {"क": "k", "ख": "kh", "ग": "g", "घ": "gh", "ङ": "n", "च": "ch", "छ": "chh", "ज": "j", "झ": "jh",
+              "ञ": "n", "ट": "t", "ठ": "th", "ड": "d", "ढ": "dh", "ण": "n", "त": "t", "थ": "th", "द": "d",
+              "ध": "dh", "न": "n", "प": "p", "फ": "ph", "ब": "b", "भ": "bh", "म": "m", "य": "y", "र": "r",
+              "ल": "l", "ळ": "l", "व": "v", "श": "sh", "ष": "sh", "स": "s", "ह": "h"}
+NUKTA_FORMS = {"ड": "r", "ढ": "rh", "फ": "f", "ज": "z", "क": "k", "ख": "kh", "ग": "g"}
+LABIALS = {"p", "ph", "b", "bh", "m"}
+VIRAMA, NUKTA, ANUSVARA, CHANDRABINDU, VISARGA = "्", "़", "ं", "ँ", "ः"
+INHERENT = "ə"  # The unwritten 'a' after a bare consonant, which Marathi often drops
+
+
+def _transliterate_word(word):
+    # Syllables: [sound, vowel (INHERENT, a written vowel, or '' = none), nasal, is_consonant]
+    units = []
+    chars = list(word)
+    i = 0
+    while i < len(chars):
+        ch = chars[i]
+        if ch in CONSONANTS:
+            sound = CONSONANTS[ch]
+            if i + 1 < len(chars) and chars[i + 1] == NUKTA:
+                sound, i = NUKTA_FORMS.get(ch, sound), i + 1
+            if ch == "ज" and chars[i + 1:i + 3] == [VIRAMA, "ञ"]:  # ज्ञ is "dny" in Marathi
+                sound, i = "dny", i + 2
+            units.append([sound, INHERENT, "", True])
+        elif ch in VOWELS:
+            units.append([VOWELS[ch], "", "", False])
+        elif ch in MATRAS and units:
+            units[-1][1] = MATRAS[ch]
+        elif ch == VIRAMA and units:
+            units[-1][1] = ""
+        elif ch in (ANUSVARA, CHANDRABINDU) and units:
+            units[-1][2] = "n"
+        elif ch == VISARGA and units:
+            units[-1][2] = "h"
+        elif ch.isascii():
+            units.append([ch, "", "", False])
+        i += 1
+
+    # Schwa deletion: the final inherent 'a' is silent, and so is a medial one between two voiced
+    # syllables, scanning left to right ("वडगाव" -> vadgav, "अहमदनगर" -> ahmadnagar, but "कमल" -> kamal)
+    if len(units) > 1 and units[-1][3] and units[-1][1] == INHERENT and not units[-1][2]:
+        units[-1][1] = ""
+    for j in range(1, len(units) - 1):
+        if not units[j][3] or units[j][1] != INHERENT or units[j][2]: continue
+        if (units[j - 1][1] or not units[j - 1][3]) and units[j + 1][3] and units[j + 1][1]:
+            units[j][1] = ""
+
+    out = []
+    for j, (sound, vowel, nasal, _) in enumerate(units):
+        if nasal == "n" and j + 1 < len(units) and units[j + 1][0] in LABIALS:
+            nasal = "m"
+        out.append(sound + ("a" if vowel == INHERENT else vowel) + nasal)
+    return "".join(out)
+
+
+def transliterate(text):
+    """Devanagari (Marathi) -> Latin, title-cased per word. Latin / digits pass through unchanged."""
+    if not text: return text
+    words = str(text).translate(MARATHI_DIGITS).split()
+    return " ".join(_transliterate_word(w).capitalize() for w in words)
+
+
+# --- 2. TEXT-LAYER EXTRACTION ---
+def _read_address(namuna_7_text):
+    """(village, taluka, district) from the Namuna 7 header, or None unless all three look right."""
+    for m in ADDRESS_HEADER.finditer(namuna_7_text):
+        village, taluka, district = (re.sub(r"\s+", " ", m.group(k)).strip() for k in ("village", "taluka", "district"))
+        if all(PLACE_NAME.match(v) for v in (village, taluka, district)) and district in DISTRICTS:
+            return village, taluka, district
+    return None
+
+
+def parse_text_layer(namuna_7_text, namuna_12_text):
+    """
+    Reads the document-stage fields from a digital 7/12's text.
+    Returns a dict in the same shape the document prompt returns (English fields transliterated),
+    or None if anything required is missing or implausible - the model reads those.
+    """
+    address = _read_address(namuna_7_text)
+    survey = SURVEY_NUMBER.search(namuna_7_text)
+    if address is None or survey is None:
+        return None
+    village, taluka, district = address
+    result = {"address_village": village, "address_taluka": taluka, "address_district": district,
+              "survey_number": survey.group(1).strip()}
+
+    occupants = []
+    for khate, name, area in OCCUPANT_ROW.findall(namuna_7_text):
+        if CANCELLED_NAME.match(name): continue  # [Name] / (Name) = cancelled entry
+        name = name.strip()
+        occupants.append({"name": name, "name_english": transliterate(name), "khate_number": khate,
+                          "area_hectare": area})
+
+    crop_history = []
+    for year, season, crop, area in CROP_ROW.findall(namuna_12_text):
+        crop_key = normalize_crop(crop)
+        crop_history.append({
+            "year": re.sub(r"\s", "", year),
+            "season": season,
+            "crop_name": crop.strip(),
+            "crop_name_english": crop_key.title() if crop_key != "other" else None,
+            "area_hectare": area,
+        })
+    # Latest year first (the prompt contract)
+    crop_history.sort(key=lambda row: row["year"].translate(MARATHI_DIGITS), reverse=True)
+
+    if not occupants or not crop_history:
+        return None
+    # The crop check and the Scale of Finance rate need the English crop: a crop we cannot map goes to the model
+    if not crop_history[0]["crop_name_english"]:
+        return None
+
+    result.update(occupants=occupants, crop_history=crop_history, source="text_layer",
+                  address_village_english=transliterate(village), address_taluka_english=transliterate(taluka))
+    return result
+
+
+# --- 3. PAGE PRUNING ---
+def _select_pages(page_texts):
+    """
+    Indexes of the pages from the first Namuna 7 marker through the last Namuna 12 marker and its
+    continuation, so a form that runs onto a second page (many co-owners, long crop history) stays whole.
+    Every page when the markers do not find both (scans have no text layer, so nothing is known
+    about which page is which).
+    """
+    n7 = [i for i, t in enumerate(page_texts) if _has_marker(t, NAMUNA_7_MARKERS)]
+    n12 = [i for i, t in enumerate(page_texts) if _has_marker(t, NAMUNA_12_MARKERS)]
+    if not (n7 and n12) or n12[-1] < n7[0]:
+        return list(range(len(page_texts)))
+    last = n12[-1]
+    # Unmarked pages after Namuna 12 that still hold crop rows (or no readable text) continue it
+    while last + 1 < len(page_texts) and (CROP_ROW.search(page_texts[last + 1])
+                                          or _devanagari_chars(page_texts[last + 1]) < MIN_TEXT_LAYER_CHARS):
+        last += 1
+    return list(range(n7[0], last + 1))
+
+
+def prepare_pdf(data):
+    """
+    Returns (bytes, mime_type, info). info['local_result'] is set when the text layer
+    was good enough to skip the model call.
+    """
+    info = {"bytes_in": len(data), "bytes_out": len(data), "bytes_saved": 0}
+    _count(documents=1, pdfs=1)
+    try:
+        reader = PdfReader(io.BytesIO(data))
+        page_texts = []
+        for page in reader.pages:
+            try:
+                page_texts.append(page.extract_text() or "")
+            except Exception:
+                page_texts.append("")
+    except Exception as e:
+        info["skipped"] = f"unreadable PDF: {e}"
+        return data, "application/pdf", info
+
+    total = len(page_texts)
+    info["pages_total"] = total
+    _count(pages_total=total)
+    if not total:
+        return data, "application/pdf", info
+
+    # --- Fast path: real text layer ---
+    text_pages = [t for t in page_texts if _devanagari_chars(t) >= MIN_TEXT_LAYER_CHARS]
+    if text_pages:
+        n7_text = "\n".join(t for t in page_texts if _has_marker(t, NAMUNA_7_MARKERS)) or page_texts[0]
+        n12_text = "\n".join(t for t in page_texts if _has_marker(t, NAMUNA_12_MARKERS)) or page_texts[-1]
+        local_result = parse_text_layer(n7_text, n12_text)
+        if local_result:
+            info.update(pages_sent=0, bytes_out=0, bytes_saved=len(data), local_result=local_result)
+            _count(text_layer_fast_path=1)
+            return data, "application/pdf", info
+
+    # --- Model path: send only the relevant pages ---
+    keep = _select_pages(page_texts)
+    info["pages_sent"] = len(keep)
+    _count(pages_sent=len(keep))
+    if len(keep) == total:
+        return data, "application/pdf", info
+
+    writer = PdfWriter()
+    for i in keep:
+        writer.add_page(reader.pages[i])
+    out = io.BytesIO()
+    writer.write(out)
+    pruned = out.getvalue()
+    _count(pruned=1)
+    info.update(bytes_out=len(pruned), bytes_saved=len(data) - len(pruned), pages_kept=[i + 1 for i in keep])
+    return pruned, "application/pdf", info
+
+
+def prepare_land_document(data, mime_type):
+    """Document-stage pre-processing: PDFs are pruned / parsed locally, images are downsized."""
+    if mime_type == "application/pdf" or data[:5] == b"%PDF-":
+        return prepare_pdf(data)
+    _count(documents=1)
+    return image_prep.prepare_document(data, mime_type)
+
+
+def settings_fingerprint():
+    return f"satbara={PARSER_VERSION};{image_prep.settings_fingerprint()}"
@@ -0,0 +1,243 @@
+# scale_of_finance.py
+# Deterministic Scale-of-Finance maths (sum insured, premium, payout).
+# The model only extracts crop / area / season; every rupee is computed here.
+#
+# Re-estimate historical claims after a rate change:
+#   python scale_of_finance.py --version 2025            (dry run, prints totals)
+#   python scale_of_finance.py --version 2025 --apply    (writes back to MongoDB)
+
+import re
+import numpy as np
+
+# --- 1. VERSIONED RATE TABLES ---
+# Add a new entry (never edit an old one) when DLC rates change, then bump CURRENT_VERSION.
+SCALE_OF_FINANCE = {
+    "2025": {
+        "rates": {  # Rs per Hectare
+            "cotton": 60000, "potato": 60000, "onion": 60000,
+            "soybean": 45000, "rice": 45000, "maize": 45000,
+            "jowar": 35000, "bajra": 35000, "wheat": 35000,
+        },
+        "default_rate": 40000,
+        "commercial_crops": ("cotton", "potato"),
+        "premium": {"commercial": 0.05, "kharif": 0.02, "rabi": 0.015},
+        "loss_fraction": 1.0,  # Assuming Full Loss
+    },
+}
+CURRENT_VERSION = "2025"
+
+# Marathi / Hindi / colloquial names -> rate table key
+CROP_ALIASES = {
+    "कापूस": "cotton", "kapus": "cotton", "kapas": "cotton",
+    "बटाटा": "potato", "batata": "potato", "आलू": "potato",
+    "कांदा": "onion", "kanda": "onion", "प्याज": "onion",
+    "सोयाबीन": "soybean", "soyabean": "soybean", "soya": "soybean",
+    "भात": "rice", "धान": "rice", "paddy": "rice",
+    "मका": "maize", "makka": "maize", "मक्का": "maize", "corn": "maize",
+    "ज्वारी": "jowar", "ज्वार": "jowar", "sorghum": "jowar",
+    "बाजरी": "bajra", "बाजरा": "bajra", "millet": "bajra",
+    "गहू": "wheat", "गेहूं": "wheat", "gahu": "wheat",
+}
+
+SEASON_ALIASES = {"खरीप": "kharif", "खरीफ": "kharif", "रब्बी": "rabi", "रबी": "rabi"}
+
+MARATHI_DIGITS = str.maketrans("०१२३४५६७८९", "0123456789")
+
+
+# --- 2. NORMALIZATION HELPERS ---
+AREA_HRS = re.compile(r"^(\d+)\.(\d{2})\.(\d{2})$")  # 7/12 H.R.sqm: '0.38.00'
+AREA_DECIMAL = re.compile(r"^(?:\d+(?:\.\d*)?|\.\d+)$")
+# Unit words printed with an area ('हे.आर.चौ.मी', 'Ha.', 'hectare'), with the dots that abbreviate them
+AREA_UNITS = re.compile(r"(?:[A-Za-z\u0900-\u0965\u0970-\u097F]+\.?)+")
+
+def parse_area_hectare(text):
+    """
+    7/12 areas are written as H.R.sqm (e.g. '०.३८.०० हे.आर.चौ.मी' = 0 Ha 38 R 00 sq.m = 0.38 Ha).
+    Plain decimals ('0.5', '1.5 Ha.') and numbers are returned as-is.
+    Raises ValueError for a missing or unreadable area (never a silent 0 Ha).
+    """
+    if isinstance(text, (int, float)) and not isinstance(text, bool):
+        if not np.isfinite(text) or text < 0: raise ValueError(f"Unreadable area: {text!r}")
+        return float(text)
+    value = AREA_UNITS.sub(" ", str(text or "").translate(MARATHI_DIGITS)).strip()
+    m = AREA_HRS.match(value)
+    if m:
+        return int(m.group(1)) + int(m.group(2)) / 100 + int(m.group(3)) / 10000
+    if AREA_DECIMAL.match(value):
+        return float(value)
+    raise ValueError(f"Unreadable area: {text!r}")
+
+def parse_area_or_none(text):
+    try:
+        return parse_area_hectare(text)
+    except ValueError:
+        return None
+
+def _words(text):
+    return [w for w in re.split(r"[^\w\u0900-\u097F]+", str(text or "").lower()) if w]
+
+def normalize_crop(name, version=CURRENT_VERSION):
+    """Maps any spelling of a crop to its rate-table key, or 'other'. Whole words only: 'Price' is not rice."""
+    rates = SCALE_OF_FINANCE[version]["rates"]
+    for word in _words(name):
+        if word in rates: return word
+        if word in CROP_ALIASES: return CROP_ALIASES[word]
+    return "other"
+
+def normalize_season(name):
+    text = str(name or "").lower()
+    for alias, key in SEASON_ALIASES.items():
+        if alias in text: return key
+    return "rabi" if "rabi" in text else "kharif"
+
+def _factorize(values):
+    """(distinct_values, codes) - cheaper than np.unique on object arrays and keeps first-seen order."""
+    seen = {}
+    codes = np.fromiter((seen.setdefault(str(v or ""), len(seen)) for v in values), dtype=np.intp, count=len(values))
+    return list(seen), codes
+
+def format_rupees(amount):
+    return f"₹{amount:,.0f}"
+
+
+# --- 3. VECTORIZED CALCULATOR ---
+def estimate_claims(crops, areas, seasons=None, version=CURRENT_VERSION, loss_fraction=None):
+    """
+    Computes rate, sum insured, premium and payout for N claims at once.
+    crops/seasons: sequences of names (any language); areas: numbers or 7/12 area strings.
+    Returns a dict of NumPy arrays of length N; rows with area_ok False (area unreadable) are NaN.
+    """
+    table = SCALE_OF_FINANCE[version]
+    crops = list(crops)
+    n = len(crops)
+    seasons = list(seasons) if seasons is not None else [""] * n
+    if loss_fraction is None: loss_fraction = table["loss_fraction"]
+
+    # Crop and season names repeat heavily across a taluka: normalize each distinct name once
+    unique_crops, crop_idx = _factorize(crops)
+    unique_keys = [normalize_crop(c, version) for c in unique_crops]
+    crop_keys = np.asarray(unique_keys, dtype=object)[crop_idx]
+    rate = np.asarray([table["rates"].get(k, table["default_rate"]) for k in unique_keys], dtype=np.float64)[crop_idx]
+    is_commercial = np.asarray([k in table["commercial_crops"] for k in unique_keys], dtype=bool)[crop_idx]
+
+    unique_seasons, season_idx = _factorize(seasons)
+    is_rabi = np.asarray([normalize_season(s) == "rabi" for s in unique_seasons], dtype=bool)[season_idx]
+
+    area = np.asarray(areas)
+    if area.dtype.kind in "biuf":  # Already numeric (e.g. a DataFrame column)
+        area = area.astype(np.float64)
+    else:  # Strings, None, mixed: float(None) would be a silent NaN
+        area = np.asarray([parse_area_or_none(a) for a in areas], dtype=np.float64)
+    # Missing / unreadable areas stay NaN here and are flagged, never priced as 0 Ha
+    area_ok = np.isfinite(area) & (area >= 0)
+
+    # Commercial crops override the season rule
+    pct = np.where(is_rabi, table["premium"]["rabi"], table["premium"]["kharif"])
+    pct = np.where(is_commercial, table["premium"]["commercial"], pct)
+
+    sum_insured = area * rate
+    return {
+        "crop_key": crop_keys,
+        "area_ha": area,
+        "rate": rate,
+        "sum_insured": sum_insured,
+        "premium_pct": pct,
+        "premium": sum_insured * pct,
+        "payout": sum_insured * np.asarray(loss_fraction, dtype=np.float64),
+        "is_commercial": is_commercial,
+        "is_rabi": is_rabi,
+        "area_ok": area_ok,
+    }
+
+def estimate_claim(crop, area, season=None, version=CURRENT_VERSION):
+    """
+    Single-claim convenience wrapper.
+    Returns the 'claim_estimation' block used by the report, plus 'premium_amount' for the form.
+    """
+    r = estimate_claims([crop], [area], [season], version=version)
+    rate, area_ha, pct = r["rate"][0], r["area_ha"][0], r["premium_pct"][0]
+    if r["is_commercial"][0]:
+        rule = f"{pct * 100:g}% (Commercial Crop)"
+    else:
+        rule = f"{pct * 100:g}% ({'Rabi' if r['is_rabi'][0] else 'Kharif'} Strategy)"
+    if r["area_ok"][0]:
+        payout, premium = format_rupees(r["payout"][0]), format_rupees(r["premium"][0])
+        logic, disclaimer = f"{area_ha:g} Ha * ₹{rate:,.0f}", "This is an estimate based on district averages."
+    else:  # Never a silent ₹0: the area has to be checked by hand
+        print(f"⚠️ Area {area!r} could not be read: estimate left for manual assessment")
+        payout = premium = "Under Assessment"
+        logic = f"Area '{area}' could not be read from the 7/12"
+        disclaimer = "The cultivated area must be verified before an estimate can be made."
+    return {
+        "estimated_payout": payout,
+        "rate_applied": f"₹ {rate:,.0f} / Ha ({crop or 'Other'})",
+        "deductible_rule": rule,
+        "premium_amount": premium,
+        "logic": logic,
+        "disclaimer": disclaimer,
+        "scale_of_finance_version": version,
+    }
+
+
+# --- 4. BULK RE-ESTIMATION OF HISTORICAL CLAIMS ---
+def _claim_fields(doc):
+    # app.py stores the form under 'submitted_data', agent_engine under 'claim_data'
+    return doc.get("submitted_data") or doc.get("claim_data") or {}
+
+def reestimate_claims(claim_docs, version=CURRENT_VERSION):
+    """
+    Recomputes payouts for many stored claim documents in one vectorized pass.
+    Returns (results_dict_of_arrays, docs_list).
+    """
+    docs = list(claim_docs)
+    fields = [_claim_fields(d) for d in docs]
+    results = estimate_claims(
+        [f.get("crop_name_english") or f.get("crop_name") or f.get("crop") for f in fields],
+        [f.get("sown_area_hectare") for f in fields],
+        [f.get("season") for f in fields],
+        version=version
+    )
+    return results, docs
+
+def reestimate_claims_in_db(claims_col, version=CURRENT_VERSION, apply=False, query=None):
+    """Re-estimates every matching claim in MongoDB; writes back only when apply=True."""
+    from pymongo import UpdateOne
+
+    projection = {"application_id": 1, "submitted_data": 1, "claim_data": 1}
+    results, docs = reestimate_claims(claims_col.find(query or {}, projection), version)
+    ok = results["area_ok"]
+    print(f"🧮 Re-estimated {len(docs)} claim(s) with Scale of Finance {version}: "
+          f"total payout {format_rupees(results['payout'][ok].sum())}, total premium {format_rupees(results['premium'][ok].sum())}")
+    if not ok.all():
+        print(f"⚠️ {int((~ok).sum())} claim(s) have no readable area and are left unchanged")
+
+    if apply and docs:
+        ops = []
+        for i, doc in enumerate(docs):
+            if not ok[i]: continue
+            prefix = "submitted_data" if doc.get("submitted_data") else "claim_data"
+            ops.append(UpdateOne({"_id": doc["_id"]}, {"$set": {
+                f"{prefix}.estimated_payout": format_rupees(results["payout"][i]),
+                f"{prefix}.premium_amount": format_rupees(results["premium"][i]),
+                "scale_of_finance_version": version,
+            }}))
+        if ops:  # bulk_write refuses an empty batch
+            claims_col.bulk_write(ops, ordered=False)
+        print(f"✅ Updated {len(ops)} claim(s)")
+    return results
+
+
+if __name__ == "__main__":
+    import os
+    import argparse
+    from pymongo import MongoClient
+    from dotenv import load_dotenv
+
+    parser = argparse.ArgumentParser(description="Re-estimate stored claims with a Scale of Finance version.")
+    parser.add_argument("--version", default=CURRENT_VERSION, choices=sorted(SCALE_OF_FINANCE))
+    parser.add_argument("--apply", action="store_true", help="Write new estimates back to MongoDB")
+    args = parser.parse_args()
+
+    load_dotenv()
+    col = MongoClient(os.getenv("MONGO_URI"))["viksit_kisan_db"]["claims"]
+    reestimate_claims_in_db(col, version=args.version, apply=args.apply)
@@ -0,0 +1,121 @@
+# shaping_cache.py
+# Memoized HarfBuzz shaping for the claim form renderer.
+#
+# fpdf2 shapes every Marathi string through HarfBuzz - and more than once per cell (width, then
+# layout). Across a batch the same strings come back again and again: field labels, "NA", village /
+# taluka / district names, crop names, seasons. The shaped glyphs only depend on (font file, size,
+# text, shaping params), so they are kept in a bounded LRU and reused by every form the process renders.
+#
+#   pdf_generator.FormRenderer attaches it to its TTF fonts (use_shaping_cache); nothing else changes.
+#   get_shaping_stats() -> hits / misses / evictions / shaping seconds spent and saved.
+
+import os
+import time
+import threading
+from collections import OrderedDict, namedtuple
+
+from fpdf.fonts import TTFFont
+
+# --- SETTINGS (override via .env) ---
+SHAPING_CACHE_SIZE = int(os.getenv("SHAPING_CACHE_SIZE", 4096))  # Shaped strings kept per process
+
+# Plain copies of HarfBuzz's GlyphInfo / GlyphPosition (the fields fpdf reads), safe to share
+GlyphInfo = namedtuple("GlyphInfo", "codepoint cluster")
+GlyphPosition = namedtuple("GlyphPosition", "x_advance y_advance x_offset y_offset")
+
+
+def _freeze(value):
+    """Shaping params -> hashable key part (dicts of features, enums, strings)."""
+    if isinstance(value, dict):
+        return tuple(sorted((k, _freeze(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    try:
+        hash(value)
+        return value
+    except TypeError:
+        return repr(value)
+
+
+class ShapingCache:
+    """LRU of shaped strings: (font, size, text, params) -> (glyph infos, glyph positions)."""
+
+    def __init__(self, max_entries=SHAPING_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.enabled = max_entries > 0
+
+        self._entries = OrderedDict()  # key -> (cost_seconds, infos, positions)
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0, "shaping_seconds": 0.0, "seconds_saved": 0.0}
+
+    def get(self, key):
+        if not self.enabled: return None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._stats["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._stats["hits"] += 1
+            self._stats["seconds_saved"] += entry[0]
+            return entry[1], entry[2]
+
+    def put(self, key, infos, positions, cost_seconds):
+        with self._lock:
+            self._stats["shaping_seconds"] += cost_seconds
+            if not self.enabled: return
+            self._entries[key] = (cost_seconds, infos, positions)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._stats["evictions"] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self._stats["hits"] + self._stats["misses"]
+            return {**self._stats, "entries": len(self._entries),
+                    "hit_rate": round(self._stats["hits"] / lookups, 3) if lookups else 0.0}
+
+    def reset_stats(self):
+        with self._lock:
+            for key in self._stats:
+                self._stats[key] = 0.0 if isinstance(self._stats[key], float) else 0
+
+
+shaping_cache = ShapingCache()
+
+
+class CachedShapingFont(TTFFont):
+    """fpdf TTF font whose HarfBuzz calls go through shaping_cache (layout and width both use it)."""
+
+    __slots__ = ()
+
+    def perform_harfbuzz_shaping(self, text, font_size_pt, text_shaping_params):
+        key = (str(self.ttffile), font_size_pt, text, _freeze(text_shaping_params))
+        hit = shaping_cache.get(key)
+        if hit is not None:
+            return hit
+
+        started = time.perf_counter()
+        infos, positions = super().perform_harfbuzz_shaping(text, font_size_pt, text_shaping_params)
+        if infos is not None:
+            infos = tuple(GlyphInfo(g.codepoint, g.cluster) for g in infos)
+        if positions is not None:
+            positions = tuple(GlyphPosition(p.x_advance, p.y_advance, p.x_offset, p.y_offset) for p in positions)
+        shaping_cache.put(key, infos, positions, time.perf_counter() - started)
+        return infos, positions
+
+
+def use_shaping_cache(font):
+    """Switches a parsed fpdf TTF font (and every copy.copy of it) to cached shaping."""
+    if type(font) is TTFFont:
+        font.__class__ = CachedShapingFont
+    return font
+
+
+def get_shaping_stats():
+    return shaping_cache.stats()
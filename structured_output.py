@@ -0,0 +1,294 @@
+# structured_output.py
+# Response schemas for the three model stages, a validator compiled once per schema,
+# and cheap local repair of near-valid JSON - so a stray fence, trailing comma or
+# missing comma does not cost the farmer a second (paid) model call.
+#
+# Schemas use Gemini's OpenAPI subset (sent as response_schema) and are also the
+# contract the local validator checks, so both sides agree by construction.
+
+import re
+import json
+import threading
+
+# --- 1. STAGE SCHEMAS ---
+def _string(nullable=False):
+    return {"type": "STRING", "nullable": True} if nullable else {"type": "STRING"}
+
+SCHEMAS = {
+    "document": {
+        "type": "OBJECT",
+        "properties": {
+            "occupants": {
+                "type": "ARRAY",
+                "items": {
+                    "type": "OBJECT",
+                    "properties": {
+                        "name": _string(),
+                        "name_english": _string(nullable=True),
+                        "khate_number": _string(nullable=True),
+                        "area_hectare": _string(nullable=True),
+                    },
+                    "required": ["name"],
+                    "property_ordering": ["name", "name_english", "khate_number", "area_hectare"],
+                },
+            },
+            "address_village": _string(nullable=True),
+            "address_village_english": _string(nullable=True),
+            "address_taluka": _string(nullable=True),
+            "address_taluka_english": _string(nullable=True),
+            "address_district": _string(nullable=True),
+            "survey_number": _string(nullable=True),
+            "crop_history": {
+                "type": "ARRAY",
+                "items": {
+                    "type": "OBJECT",
+                    "properties": {
+                        "year": _string(nullable=True),
+                        "season": _string(nullable=True),
+                        "crop_name": _string(nullable=True),
+                        "crop_name_english": _string(nullable=True),
+                        "area_hectare": _string(nullable=True),
+                    },
+                    "required": ["year", "crop_name"],
+                    "property_ordering": ["year", "season", "crop_name", "crop_name_english", "area_hectare"],
+                },
+            },
+        },
+        "required": ["occupants", "crop_history"],
+        "property_ordering": ["occupants", "address_village", "address_village_english", "address_taluka",
+                              "address_taluka_english", "address_district", "survey_number", "crop_history"],
+    },
+    "voice": {
+        "type": "OBJECT",
+        "properties": {
+            "voice_response": _string(),
+            "language": _string(nullable=True),
+            "farmer_name": _string(nullable=True),
+            "farmer_name_english": _string(nullable=True),
+            "crop_name": _string(nullable=True),
+            "crop_name_english": _string(nullable=True),
+            "cause_of_loss": _string(nullable=True),
+            "cause_of_loss_english": _string(nullable=True),
+        },
+        "required": ["voice_response", "crop_name"],
+        # voice_response first: it is streamed to the farmer while the rest is generated
+        "property_ordering": ["voice_response", "language", "farmer_name", "farmer_name_english",
+                              "crop_name", "crop_name_english", "cause_of_loss", "cause_of_loss_english"],
+    },
+    "visual": {
+        "type": "OBJECT",
+        "properties": {
+            "is_valid": {"type": "BOOLEAN"},
+            "visual_finding": _string(nullable=True),
+            "rejection_reason": _string(nullable=True),
+        },
+        "required": ["is_valid"],
+        "property_ordering": ["is_valid", "visual_finding", "rejection_reason"],
+    },
+}
+
+
+# --- 2. COMPILED VALIDATOR ---
+_PY_TYPES = {"STRING": str, "BOOLEAN": bool, "INTEGER": int, "NUMBER": (int, float)}
+
+
+def compile_validator(schema):
+    """
+    Walks the schema ONCE and returns check(value, path, errors).
+    Validating an answer is then a handful of isinstance calls, no schema interpretation.
+    """
+    kind = schema["type"]
+    nullable = schema.get("nullable", False)
+
+    if kind == "OBJECT":
+        props = {key: compile_validator(sub) for key, sub in schema.get("properties", {}).items()}
+        required = tuple(schema.get("required", ()))
+
+        def check(value, path, errors):
+            if value is None:
+                if not nullable: errors.append(f"{path}: null")
+                return
+            if not isinstance(value, dict):
+                errors.append(f"{path}: expected object")
+                return
+            for key in required:
+                if key not in value: errors.append(f"{path}.{key}: missing")
+            for key, sub_check in props.items():
+                if key in value: sub_check(value[key], f"{path}.{key}", errors)
+        return check
+
+    if kind == "ARRAY":
+        item_check = compile_validator(schema["items"])
+
+        def check(value, path, errors):
+            if value is None:
+                if not nullable: errors.append(f"{path}: null")
+                return
+            if not isinstance(value, list):
+                errors.append(f"{path}: expected array")
+                return
+            for i, item in enumerate(value):
+                item_check(item, f"{path}[{i}]", errors)
+        return check
+
+    py_type = _PY_TYPES[kind]
+
+    def check(value, path, errors):
+        if value is None:
+            if not nullable: errors.append(f"{path}: null")
+        elif not isinstance(value, py_type) or (kind != "BOOLEAN" and isinstance(value, bool)):
+            errors.append(f"{path}: expected {kind.lower()}")
+    return check
+
+
+VALIDATORS = {stage: compile_validator(schema) for stage, schema in SCHEMAS.items()}
+
+
+def validate(stage, value):
+    """Returns a list of schema violations (empty = valid)."""
+    errors = []
+    VALIDATORS[stage](value, "$", errors)
+    return errors
+
+
+# --- 3. LOCAL JSON REPAIR ---
+_FENCE = re.compile(r"```(?:json)?", re.I)
+_PY_LITERALS = re.compile(r'(:\s*|[\[,]\s*)(True|False|None)\b')
+_TRAILING_COMMA = re.compile(r",(\s*[}\]])")
+# A value ending a line, followed by a new "key": on the next line, with no comma between
+_MISSING_COMMA = re.compile(r'((?:"|\d|true|false|null|[}\]]))(\s*\n\s*)("[^"\n]*"\s*:)')
+
+
+def _extract_object(text):
+    text = _FENCE.sub("", text)
+    start = text.find("{")
+    if start == -1: return text.strip()
+    text = text[start:]
+    end = text.rfind("}")
+    # Drop chatter after the object, but not the tail of a truncated answer
+    if end != -1 and not re.search(r'["\[\]{,:]', text[end + 1:]):
+        text = text[:end + 1]
+    return text.strip()
+
+
+def _close_truncated(text):
+    """
+    Closes an answer cut off mid-way (max tokens / dropped stream).
+    Only cuts between values are repaired: a half-written string VALUE could be a
+    wrong crop or name, so that case is left for a retry.
+    """
+    stack, in_string, escaped, quote_at = [], False, False, -1
+    for i, ch in enumerate(text):
+        if in_string:
+            if escaped: escaped = False
+            elif ch == "\\": escaped = True
+            elif ch == '"': in_string = False
+        elif ch == '"': in_string, quote_at = True, i
+        elif ch in "{[": stack.append("}" if ch == "{" else "]")
+        elif ch in "}]" and stack: stack.pop()
+    if not stack: return text
+    if in_string:
+        before = text[:quote_at].rstrip()
+        if not (stack[-1] == "}" and before.endswith(("{", ","))):
+            return text  # Cut inside a value
+        text = before  # Cut inside a key: drop it
+    text = re.sub(r'[,:]\s*$', "", text.rstrip())  # Dangling separator
+    if stack[-1] == "}":
+        text = re.sub(r'([{,])\s*"[^"]*"$', r"\1", text).rstrip(",")  # Key that never got a value
+    return text + "".join(reversed(stack))
+
+
+REPAIRS = (
+    ("extract_object", _extract_object),
+    ("python_literals", lambda t: _PY_LITERALS.sub(lambda m: m.group(1) + {"True": "true", "False": "false", "None": "null"}[m.group(2)], t)),
+    ("trailing_comma", lambda t: _TRAILING_COMMA.sub(r"\1", t)),
+    ("missing_comma", lambda t: _MISSING_COMMA.sub(r"\1,\2\3", t)),
+    ("close_truncated", _close_truncated),
+)
+
+
+def repair_json(text):
+    """
+    Applies the repairs cumulatively until json.loads succeeds.
+    Returns (value, [repair names applied]); raises ValueError if still not JSON.
+    """
+    try:
+        return json.loads(text), []
+    except ValueError:
+        pass
+    applied = []
+    for name, fix in REPAIRS:
+        fixed = fix(text)
+        if fixed == text: continue
+        text = fixed
+        applied.append(name)
+        try:
+            return json.loads(text), applied
+        except ValueError:
+            continue
+    raise ValueError(f"not JSON after repairs {applied or '(none applicable)'}")
+
+
+# --- 4. STAGE OUTPUT PARSING + STATS ---
+class StageOutputError(ValueError):
+    """The model answer is unusable even after local repair (the caller may retry the call)."""
+
+
+_stats_lock = threading.Lock()
+_stats = {"responses": 0, "clean": 0, "repaired": 0, "invalid": 0, "retries": 0, "retry_recovered": 0, "failed": 0}
+_repair_counts = {}
+
+
+def _count(**kwargs):
+    with _stats_lock:
+        for key, value in kwargs.items():
+            _stats[key] += value
+
+
+def note_retry(recovered=None):
+    """agent_engine reports a re-issued model call, and later whether it produced usable output."""
+    if recovered is None:
+        _count(retries=1)
+    elif recovered:
+        _count(retry_recovered=1)
+    else:
+        _count(failed=1)
+
+
+def parse_stage_output(stage, text):
+    """
+    Model text -> validated dict. Repairs near-valid JSON locally.
+    Returns (value, repairs_applied); raises StageOutputError.
+    """
+    try:
+        value, repairs = repair_json(text or "")
+    except ValueError as e:
+        _count(responses=1, invalid=1)
+        raise StageOutputError(f"{stage}: {e}")
+
+    errors = validate(stage, value)
+    if "close_truncated" in repairs:
+        # A cut-off answer is only usable if every top-level field made it (nothing silently dropped)
+        missing = [key for key in SCHEMAS[stage]["properties"] if key not in value]
+        if missing: errors.append(f"truncated before {', '.join(missing)}")
+    if errors:
+        _count(responses=1, invalid=1)
+        raise StageOutputError(f"{stage}: schema violation {'; '.join(errors[:3])}")
+
+    with _stats_lock:
+        _stats["responses"] += 1
+        _stats["repaired" if repairs else "clean"] += 1
+        for name in repairs:
+            _repair_counts[name] = _repair_counts.get(name, 0) + 1
+    return value, repairs
+
+
+def get_output_stats():
+    """How often model answers needed local repair or a second (paid) call."""
+    with _stats_lock:
+        s = dict(_stats)
+        s["repairs"] = dict(_repair_counts)
+    n = s["responses"] or 1
+    s["repair_rate"] = round(s["repaired"] / n, 3) if s["responses"] else 0.0
+    s["retry_rate"] = round(s["retries"] / n, 3) if s["responses"] else 0.0
+    return s
@@ -0,0 +1,65 @@
+# tests/test_resilience.py
+# Circuit breaker recovery when its half-open trial call never reports back.
+#
+#   python -m pytest -q tests
+
+import os
+import sys
+import time
+import asyncio
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import resilience
+from resilience import CircuitBreaker, RetryPolicy
+
+
+def _half_open_breaker():
+    breaker = CircuitBreaker(failure_threshold=1, reset_seconds=0.05)
+    breaker.record_failure()
+    assert breaker.is_open()
+    time.sleep(0.06)
+    assert breaker.snapshot()["state"] == "half_open"
+    return breaker
+
+
+def test_cancelled_trial_is_released():
+    breaker = _half_open_breaker()
+
+    async def hang():
+        await asyncio.sleep(60)
+
+    async def ok():
+        return "answer"
+
+    async def scenario():
+        trial = asyncio.ensure_future(resilience.call(hang, timeout=30, breaker=breaker, policy=RetryPolicy()))
+        await asyncio.sleep(0.01)
+        assert breaker.is_open()  # The trial is in flight: everyone else fails fast
+        trial.cancel()  # e.g. a sibling stage failed and process_claim_async cancels this one
+        try:
+            await trial
+        except asyncio.CancelledError:
+            pass
+        assert not breaker.is_open()
+        return await resilience.call(ok, timeout=30, breaker=breaker)
+
+    assert asyncio.run(scenario()) == "answer"
+    assert breaker.snapshot()["state"] == "closed"
+
+
+def test_stuck_trial_expires():
+    breaker = _half_open_breaker()
+    assert breaker.before_call(trial_timeout=0.05) is not None
+    assert breaker.is_open()
+    time.sleep(0.06)
+    assert not breaker.is_open()
+
+
+def test_stale_release_keeps_the_new_trial():
+    breaker = _half_open_breaker()
+    first = breaker.before_call(trial_timeout=0.05)
+    time.sleep(0.06)
+    second = breaker.before_call(trial_timeout=30)
+    breaker.release_trial(first)
+    assert second != first and breaker.is_open()
@@ -0,0 +1,89 @@
+# tests/test_satbara.py
+# Text-layer fast path on Mahabhumi 7/12 text, and which pages pruning keeps.
+#
+#   python -m pytest -q tests
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from satbara import parse_text_layer, transliterate, _select_pages
+
+# Text layer of a digitally signed 7/12 from bhulekh.mahabhumi.gov.in (as pypdf extracts it)
+NAMUNA_7 = """महाराष्ट्र शासन
+गाव नमुना सात
+अधिकार अभिलेख पत्रक
+[ महाराष्ट्र जमीन महसूल अधिकार अभिलेख आणि नोंदवह्या (तयार करणे व सुस्थितीत ठेवणे ) नियम, १९७१ यातील नियम ३,५,६ आणि ७ ]
+गाव :- वडगाव शिंदे   तालुका :- हवेली   जिल्हा :- पुणे
+भूमापन क्रमांक व उपविभाग : १२३/२अ
+भूधारणा पद्धती : भोगवटादार वर्ग -1
+भोगवटादाराचे नाव क्षेत्र आकार पो ख फे फार
+३३० कोंडिबा सबाजी तांबे ०.३८.००
+३३० [गणपत सबाजी तांबे]
+३३१ रामदास गणपत पाटील ०.२०.००
+"""
+
+NAMUNA_12 = """गाव नमुना बारा
+पिकांची नोंदवही
+[ महाराष्ट्र जमीन महसूल अधिकार अभिलेख आणि नोंदवह्या (तयार करणे व सुस्थितीत ठेवणे ) नियम, १९७१ यातील नियम २९ ]
+वर्ष हंगाम पिकाचे नाव क्षेत्र जल सिंचनाचे साधन
+२०२४-२५ रब्बी गहू ०.३८.००
+२०२५-२६ खरीप बटाटा ०.३८.००
+"""
+
+
+def test_reads_a_mahabhumi_7_12():
+    result = parse_text_layer(NAMUNA_7, NAMUNA_12)
+    assert result["address_village"] == "वडगाव शिंदे"
+    assert result["address_taluka"] == "हवेली"
+    assert result["address_district"] == "पुणे"
+    assert result["survey_number"] == "१२३/२अ"
+    assert [o["name"] for o in result["occupants"]] == ["कोंडिबा सबाजी तांबे", "रामदास गणपत पाटील"]
+    assert result["crop_history"][0]["crop_name_english"] == "Potato"
+
+
+def test_fills_the_english_fields():
+    result = parse_text_layer(NAMUNA_7, NAMUNA_12)
+    assert result["occupants"][0]["name_english"] == "Kondiba Sabaji Tambe"
+    assert result["address_village_english"] == "Vadgav Shinde"
+    assert result["address_taluka_english"] == "Haveli"
+
+
+def test_stray_abbreviations_are_not_read_as_the_address():
+    # "ता." is also तारीख (a date) and "जि. प." is the Zilla Parishad: neither is the taluka / district
+    text = NAMUNA_7.replace("गाव :- वडगाव शिंदे   तालुका :- हवेली   जिल्हा :- पुणे\n", "")
+    text = "फेरफार क्र. ४५६ ता. २८/०९/२०२५\nजि. प. शाळा वडगाव\n" + text
+    assert parse_text_layer(text, NAMUNA_12) is None
+
+
+def test_a_header_with_an_unknown_district_goes_to_the_model():
+    text = NAMUNA_7.replace("जिल्हा :- पुणे", "जिल्हा :- पुणेहवेली")
+    assert parse_text_layer(text, NAMUNA_12) is None
+    text = NAMUNA_7.replace("जिल्हा :- पुणे", "जिल्हा :- ---")
+    assert parse_text_layer(text, NAMUNA_12) is None
+
+
+def test_abbreviated_header():
+    text = NAMUNA_7.replace("तालुका :- हवेली   जिल्हा :- पुणे", "ता. :- जुन्नर   जि. :- पुणे")
+    result = parse_text_layer(text, NAMUNA_12)
+    assert (result["address_taluka"], result["address_district"]) == ("जुन्नर", "पुणे")
+    assert result["address_taluka_english"] == "Junnar"
+
+
+def test_transliterate():
+    assert transliterate("कोंडिबा सबाजी तांबे") == "Kondiba Sabaji Tambe"
+    assert transliterate("गणपत") == "Ganpat"
+    assert transliterate("अहमदनगर") == "Ahmadnagar"
+    assert transliterate("ज्ञानेश्वर") == "Dnyaneshvar"
+    assert transliterate("आंबेगाव") == "Ambegav"
+    assert transliterate("१२३/२") == "123/2"
+    assert transliterate(None) is None
+
+
+def test_select_pages_keeps_continuation_pages():
+    cover = "Digitally signed 7/12"
+    pages = [cover, NAMUNA_7, NAMUNA_12, "२०२३-२४ खरीप सोयाबीन ०.३८.००", "सूचना " * 40]
+    assert _select_pages(pages) == [1, 2, 3]
+    assert _select_pages([cover, NAMUNA_7, NAMUNA_12, ""]) == [1, 2, 3]
+    assert _select_pages(["", ""]) == [0, 1]
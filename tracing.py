@@ -0,0 +1,292 @@
+# tracing.py
+# Lightweight per-claim latency tracing (no external dependencies).
+#
+#   with claim_trace() as trace:          # one per claim submission
+#       with span("audio.normalize"): ...
+#       trace.bind(application_id=app_id)
+#
+#   @traced("pdf.form")                   # decorator for sync or async functions
+#   def generate_filled_pdf(...): ...
+#
+# Outputs:
+#   TRACE_LOG_PATH (default traces.jsonl)   one JSON line per finished claim, with every span
+#   METRICS_PATH   (default metrics.prom)   Prometheus text format histograms per stage, one file per
+#                                           process (metrics.<pid>.prom, pid label) so node-exporter's
+#                                           textfile collector sums the whole fleet
+#   METRICS_PORT   (optional)               http://<host>:<port>/metrics, started by the entry point
+#                                           (app.py, claim_worker.py) with start_metrics_server()
+
+import os
+import glob
+import json
+import time
+import uuid
+import atexit
+import tempfile
+import asyncio
+import threading
+import functools
+import contextlib
+import contextvars
+from datetime import datetime, timezone
+
+TRACE_LOG_PATH = os.getenv("TRACE_LOG_PATH", "traces.jsonl")
+METRICS_PATH = os.getenv("METRICS_PATH", "metrics.prom")
+METRICS_PORT = os.getenv("METRICS_PORT")
+
+# Seconds. Covers ms-level local work up to multi-minute model stalls.
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 60, 120, float("inf"))
+
+_current_trace = contextvars.ContextVar("claim_trace", default=None)
+
+
+class Trace:
+    def __init__(self, application_id=None, **attrs):
+        self.trace_id = uuid.uuid4().hex[:12]
+        self.application_id = application_id
+        self.attrs = attrs
+        self.started_at = datetime.now(timezone.utc)
+        self._t0 = time.perf_counter()
+        self.spans = []
+        self._lock = threading.Lock()  # Spans arrive from worker threads too
+
+    def bind(self, application_id=None, **attrs):
+        if application_id: self.application_id = application_id
+        self.attrs.update(attrs)
+
+    def add_span(self, name, start, duration, status):
+        with self._lock:
+            self.spans.append({"name": name, "start_ms": round((start - self._t0) * 1000, 1),
+                               "duration_ms": round(duration * 1000, 1), "status": status})
+
+    def to_dict(self, total_seconds):
+        with self._lock:
+            spans = sorted(self.spans, key=lambda s: s["start_ms"])
+        return {
+            "trace_id": self.trace_id,
+            "application_id": self.application_id,
+            "started_at": self.started_at.isoformat(),
+            "total_ms": round(total_seconds * 1000, 1),
+            "spans": spans,
+            **self.attrs,
+        }
+
+
+# --- 1. HISTOGRAMS ---
+METRICS_HEADER = (
+    "# HELP viksit_stage_duration_seconds Time spent per claim-processing stage.",
+    "# TYPE viksit_stage_duration_seconds histogram",
+)
+
+
+class _Histograms:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._data = {}  # (stage, status) -> [bucket_counts, sum, count]
+
+    def observe(self, stage, seconds, status="ok"):
+        with self._lock:
+            entry = self._data.setdefault((stage, status), [[0] * len(BUCKETS), 0.0, 0])
+            for i, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    entry[0][i] += 1
+                    break
+            entry[1] += seconds
+            entry[2] += 1
+
+    def render(self, extra_labels=""):
+        """extra_labels: e.g. 'pid="123",' prepended to every series (per-process files)."""
+        lines = list(METRICS_HEADER)
+        with self._lock:
+            items = sorted((k, (list(v[0]), v[1], v[2])) for k, v in self._data.items())
+        for (stage, status), (counts, total, count) in items:
+            labels = f'{extra_labels}stage="{stage}",status="{status}"'
+            cumulative = 0
+            for bound, c in zip(BUCKETS, counts):
+                cumulative += c
+                le = "+Inf" if bound == float("inf") else f"{bound:g}"
+                lines.append(f'viksit_stage_duration_seconds_bucket{{{labels},le="{le}"}} {cumulative}')
+            lines.append(f"viksit_stage_duration_seconds_sum{{{labels}}} {total:.6f}")
+            lines.append(f"viksit_stage_duration_seconds_count{{{labels}}} {count}")
+        return "\n".join(lines) + "\n"
+
+
+histograms = _Histograms()
+_log_lock = threading.Lock()
+
+
+def render_metrics():
+    """Prometheus text exposition of all stage histograms."""
+    return histograms.render()
+
+
+def process_metrics_path(path=METRICS_PATH, pid=None):
+    """metrics.prom -> metrics.<pid>.prom: every process (claim_worker --processes N) writes its own file."""
+    root, ext = os.path.splitext(path)
+    return f"{root}.{pid or os.getpid()}{ext or '.prom'}"
+
+
+def write_metrics_file(path=METRICS_PATH):
+    if not path: return
+    target = process_metrics_path(path)
+    tmp_path = None
+    try:
+        # Unique temp name: embedded worker threads of one process may write at the same moment
+        fd, tmp_path = tempfile.mkstemp(prefix=os.path.basename(target) + ".", suffix=".tmp",
+                                        dir=os.path.dirname(target) or ".")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(histograms.render(f'pid="{os.getpid()}",'))
+        os.replace(tmp_path, target)
+    except OSError as e:
+        print(f"⚠️ Metrics write failed: {e}")
+        if tmp_path and os.path.exists(tmp_path): os.remove(tmp_path)
+
+
+@atexit.register
+def _remove_metrics_file():
+    # A finished process's series should disappear, not be reported as live forever
+    if not METRICS_PATH: return
+    try:
+        os.remove(process_metrics_path(METRICS_PATH))
+    except OSError:
+        pass
+
+
+def render_fleet_metrics(path=METRICS_PATH):
+    """Every process's metrics file in one exposition (the claim_worker parent serves this)."""
+    root, ext = os.path.splitext(path)
+    lines = list(METRICS_HEADER)
+    for file_path in sorted(glob.glob(f"{glob.escape(root)}.*{ext or '.prom'}")):
+        try:
+            with open(file_path, "r", encoding="utf-8") as f:
+                lines.extend(line.rstrip("\n") for line in f if line.strip() and not line.startswith("#"))
+        except OSError:
+            continue
+    return "\n".join(lines) + "\n"
+
+
+def _export(record):
+    if not TRACE_LOG_PATH: return
+    try:
+        with _log_lock, open(TRACE_LOG_PATH, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record, ensure_ascii=False, default=str) + "\n")
+    except OSError as e:
+        print(f"⚠️ Trace log write failed: {e}")
+
+
+# --- 2. PUBLIC API ---
+def current_trace():
+    return _current_trace.get()
+
+
+def bind(application_id=None, **attrs):
+    """Attaches the application_id (known only after the DB write) or other attributes to the active trace."""
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.bind(application_id, **attrs)
+
+
+@contextlib.contextmanager
+def claim_trace(application_id=None, **attrs):
+    """
+    Starts a trace for one claim, or joins the one already active in this context
+    (so process_claim inside app.py's trace does not start a second one).
+    """
+    existing = _current_trace.get()
+    if existing is not None:
+        existing.bind(application_id, **attrs)
+        yield existing
+        return
+
+    trace = Trace(application_id, **attrs)
+    token = _current_trace.set(trace)
+    t0 = time.perf_counter()
+    status = "ok"
+    try:
+        yield trace
+    except BaseException:
+        status = "error"
+        raise
+    finally:
+        _current_trace.reset(token)
+        total = time.perf_counter() - t0
+        histograms.observe("claim.total", total, status)
+        record = trace.to_dict(total)
+        record["status"] = record.get("status") or status
+        _export(record)
+        write_metrics_file()
+
+
+@contextlib.contextmanager
+def span(name):
+    """Times a block; recorded on the active trace (if any) and in the stage histogram."""
+    start = time.perf_counter()
+    status = "ok"
+    try:
+        yield
+    except BaseException:
+        status = "error"
+        raise
+    finally:
+        duration = time.perf_counter() - start
+        histograms.observe(name, duration, status)
+        trace = _current_trace.get()
+        if trace is not None:
+            trace.add_span(name, start, duration, status)
+
+
+def traced(name):
+    """Decorator form of span() for plain and async functions."""
+    def decorator(fn):
+        if asyncio.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                with span(name):
+                    return await fn(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+# --- 3. OPTIONAL /metrics ENDPOINT ---
+_server_started = False
+
+
+def start_metrics_server(port, render=None):
+    """
+    Serves render() (default render_metrics) on http://0.0.0.0:<port>/metrics from a daemon thread
+    (idempotent). Call it from the entry point only: every process binding the port cannot work.
+    """
+    global _server_started
+    if _server_started: return
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.rstrip("/") != "/metrics":
+                self.send_error(404)
+                return
+            body = (render or render_metrics)().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass  # Keep scrapes out of the console
+
+    try:
+        server = ThreadingHTTPServer(("0.0.0.0", int(port)), MetricsHandler)
+    except OSError as e:
+        print(f"⚠️ Metrics endpoint not started on port {port}: {e}")
+        return
+    threading.Thread(target=server.serve_forever, daemon=True, name="metrics-server").start()
+    _server_started = True
+    print(f"📈 Metrics at http://0.0.0.0:{port}/metrics")
+
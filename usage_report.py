@@ -0,0 +1,106 @@
+# usage_report.py
+# Where do the tokens go? Aggregates the per-claim "usage" block that agent_engine stores
+# on every claims document (tokens, bytes sent, wall time) by day / district / crop.
+#
+#   python usage_report.py                         (last 30 days, by day + district + crop)
+#   python usage_report.py --by district --days 7
+#   python usage_report.py --by crop --json        (machine-readable)
+
+import os
+import json
+import argparse
+from datetime import datetime, timedelta
+
+STAGES = ("document", "voice", "visual")
+
+# Claims written by agent_engine keep fields under claim_data, app.py's ledger upsert under submitted_data
+GROUP_FIELDS = {
+    "day": {"$dateToString": {"format": "%Y-%m-%d", "date": "$timestamp", "timezone": "Asia/Kolkata"}},
+    "district": {"$ifNull": ["$claim_data.address_district", "$submitted_data.address_district"]},
+    "crop": {"$ifNull": ["$claim_data.crop_name_english", "$submitted_data.crop_name_english"]},
+    "model": "$usage.model",
+}
+
+
+def build_pipeline(by=("day", "district", "crop"), since=None):
+    """MongoDB aggregation pipeline: one row per group, most expensive first."""
+    match = {"usage.model": {"$exists": True}}
+    if since is not None:
+        match["timestamp"] = {"$gte": since}
+
+    group = {
+        "_id": {key: GROUP_FIELDS[key] for key in by},
+        "claims": {"$sum": 1},
+        "input_tokens": {"$sum": "$usage.input_tokens"},
+        "output_tokens": {"$sum": "$usage.output_tokens"},
+        "thinking_tokens": {"$sum": "$usage.thinking_tokens"},
+        "total_tokens": {"$sum": "$usage.total_tokens"},
+        "upload_bytes": {"$sum": {"$add": [{"$ifNull": [f"$usage.upload_bytes.{k}", 0]} for k in ("audio", "land", "photo")]}},
+        "bytes_sent": {"$sum": "$usage.bytes_sent"},
+        "avg_wall_seconds": {"$avg": "$usage.wall_seconds"},
+    }
+    for stage in STAGES:
+        group[f"{stage}_tokens"] = {"$sum": {"$ifNull": [f"$usage.stages.{stage}.total_tokens", 0]}}
+        group[f"{stage}_model_calls"] = {"$sum": {"$cond": [{"$eq": [f"$usage.stages.{stage}.source", "model"]}, 1, 0]}}
+
+    return [{"$match": match}, {"$group": group}, {"$sort": {"total_tokens": -1}}]
+
+
+def usage_report(claims_col, by=("day", "district", "crop"), days=30):
+    """Runs the aggregation and returns flat rows (group keys merged into each row)."""
+    since = datetime.now() - timedelta(days=days) if days else None
+    rows = []
+    for doc in claims_col.aggregate(build_pipeline(by, since)):
+        row = {key: doc["_id"].get(key) or "Unknown" for key in by}
+        row.update({k: v for k, v in doc.items() if k != "_id"})
+        row["tokens_per_claim"] = round(row["total_tokens"] / row["claims"]) if row["claims"] else 0
+        row["avg_wall_seconds"] = round(row["avg_wall_seconds"] or 0.0, 2)
+        rows.append(row)
+    return rows
+
+
+def print_report(rows, by):
+    if not rows:
+        print("No claims with usage data yet.")
+        return
+    total_tokens = sum(r["total_tokens"] for r in rows) or 1
+    header = [k.title() for k in by] + ["Claims", "Tokens in", "Tokens out", "Tok/claim", "Share",
+                                        "Doc/Voice/Photo tok", "MB sent", "Avg wall s"]
+    table = []
+    for r in rows:
+        table.append([str(r[k]) for k in by] + [
+            str(r["claims"]), str(r["input_tokens"]), str(r["output_tokens"] + r["thinking_tokens"]),
+            str(r["tokens_per_claim"]), f"{r['total_tokens'] / total_tokens:.0%}",
+            "/".join(str(r[f"{s}_tokens"]) for s in STAGES),
+            f"{r['bytes_sent'] / 1e6:.1f}", str(r["avg_wall_seconds"]),
+        ])
+    widths = [max(len(h), *(len(row[i]) for row in table)) for i, h in enumerate(header)]
+    print("  ".join(h.ljust(w) for h, w in zip(header, widths)))
+    print("  ".join("-" * w for w in widths))
+    for row in table:
+        print("  ".join(c.ljust(w) for c, w in zip(row, widths)))
+    print(f"\n🪙 {sum(r['total_tokens'] for r in rows)} tokens across {sum(r['claims'] for r in rows)} claims")
+
+
+if __name__ == "__main__":
+    from pymongo import MongoClient
+    from dotenv import load_dotenv
+
+    parser = argparse.ArgumentParser(description="Token / payload usage per day, district and crop.")
+    parser.add_argument("--by", default="day,district,crop", help=f"Comma-separated group keys from {sorted(GROUP_FIELDS)}")
+    parser.add_argument("--days", type=int, default=30, help="Look-back window (0 = all time)")
+    parser.add_argument("--json", action="store_true", help="Print rows as JSON instead of a table")
+    args = parser.parse_args()
+
+    by = tuple(k.strip() for k in args.by.split(",") if k.strip())
+    unknown = [k for k in by if k not in GROUP_FIELDS]
+    if unknown:
+        parser.error(f"unknown group key(s): {', '.join(unknown)}")
+
+    load_dotenv()
+    col = MongoClient(os.getenv("MONGO_URI"))["viksit_kisan_db"]["claims"]
+    rows = usage_report(col, by=by, days=args.days)
+    if args.json:
+        print(json.dumps(rows, ensure_ascii=False, indent=2, default=str))
+    else:
+        print_report(rows, by)